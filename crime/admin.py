@@ -1,15 +1,71 @@
 from myproject.crime.models import Incident, Victim, Suspect
+from myproject.crime import analytics, caching, clustering, heatmap, matching, stats
+from myproject.crime.pagination import CachedCountPaginator, cached_count, count_scope
+from django.conf.urls.defaults import patterns, url
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseBadRequest
+import simplejson
 
+AUTOCOMPLETE_PAGE_SIZE = 20
 
-class IncidentAdmin(admin.ModelAdmin):
+# Past this many distinct points, dropping every cached tile is
+# cheaper than working out which ones contain them.
+MAX_TILE_POINTS = 200
+
+
+class CachedCountChangeList(ChangeList):
+    """
+    Takes the "(N total)" figure from cached_count() too,
+    instead of counting the whole table on every request.
+    """
+    def get_results(self, request):
+        root = self.root_query_set
+        root.count = lambda: cached_count(root)
+        super(CachedCountChangeList, self).get_results(request)
+
+
+class ArchiveAdmin(admin.ModelAdmin):
+    """
+    Changelist settings for tables too big to count on every click.
+    Searches should use indexed prefix lookups ("^field").
+    """
+    paginator = CachedCountPaginator
+
+    def get_changelist(self, request, **kwargs):
+        return CachedCountChangeList
+
+
+def search_people(model, query):
+    """
+    Returns the people matching an autocomplete query: an id, a
+    "Last, First" prefix, or a prefix of either name. Every branch
+    is an indexed lookup.
+    """
+    query = query.strip()
+    people = model.objects.all()
+    if query.isdigit():
+        return people.filter(id=int(query))
+    if ',' in query:
+        last_name, first_name = [part.strip() for part in query.split(',', 1)]
+        return people.filter(last_name__istartswith=last_name, first_name__istartswith=first_name)
+    for word in query.split():
+        people = people.filter(Q(last_name__istartswith=word) | Q(first_name__istartswith=word))
+    return people
+
+
+class IncidentAdmin(ArchiveAdmin):
     list_display = ('headline', 'inc_date', 'is_homicide', 'victim_count', 'killed_count', 'suspect_count', 'is_suspects_unknown')
     list_filter = ['inc_date', 'is_homicide', 'is_suspects_unknown', 'is_victims_unknown']
-    date_hierarchy = 'inc_date'
-    search_fields = ['headline']
+    search_fields = ['^headline']
     ordering = ['-inc_date']
     prepopulated_fields = {"inc_slug": ("headline",)}
     raw_id_fields = ("victims", "suspects",)
+    # Kept in sync with the victims and suspects; see counters.py.
+    readonly_fields = ('victim_count', 'killed_count', 'is_victims_unknown', 'suspect_count', 'is_suspects_unknown')
     fieldsets = [
         ('Details',
             {'fields': [
@@ -51,15 +107,109 @@ class IncidentAdmin(admin.ModelAdmin):
     ]
     actions = ['mark_as_homicide']
 
+    class Media:
+        js = ('js/admin_autocomplete.js',)
+
+    def get_urls(self):
+        urls = patterns('',
+            url(r'^autocomplete/(?P<listing>victims|suspects)/$',
+                self.admin_site.admin_view(self.autocomplete),
+                name='crime_incident_autocomplete'),
+        )
+        return urls + super(IncidentAdmin, self).get_urls()
+
+    def formfield_for_manytomany(self, db_field, request=None, **kwargs):
+        field = super(IncidentAdmin, self).formfield_for_manytomany(db_field, request, **kwargs)
+        if db_field.name in self.raw_id_fields:
+            field.widget.attrs['data-autocomplete'] = reverse(
+                '%s:crime_incident_autocomplete' % self.admin_site.name, args=[db_field.name])
+        return field
+
+    def autocomplete(self, request, listing):
+        """
+        Victims or suspects matching ?q=, a page (?page=) at a time,
+        for attaching people to an incident without the raw id popup.
+        """
+        model = Victim if listing == 'victims' else Suspect
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            return HttpResponseBadRequest('page must be a number.')
+        query = request.GET.get('q', '')
+        results = []
+        if query.strip():
+            start = (page - 1) * AUTOCOMPLETE_PAGE_SIZE
+            people = search_people(model, query).order_by('last_name', 'first_name', 'id').values(
+                'id', 'last_name', 'first_name', 'age', 'sex')[start:start + AUTOCOMPLETE_PAGE_SIZE + 1]
+            results = [{
+                'id': person['id'],
+                'text': u'%s, %s (%s%s) #%d' % (person['last_name'], person['first_name'],
+                    person['age'] if person['age'] is not None else '?', person['sex'], person['id']),
+            } for person in people]
+        more = len(results) > AUTOCOMPLETE_PAGE_SIZE
+        return HttpResponse(simplejson.dumps({'results': results[:AUTOCOMPLETE_PAGE_SIZE], 'more': more}),
+            content_type='application/json')
+
     def mark_as_homicide(self, request, queryset):
-        queryset.update(is_homicide=True)
+        """
+        Flips is_homicide with one UPDATE. update() skips the save
+        signals, so the stats snapshot is adjusted by the same deltas
+        they would have applied, and only the caches covering the
+        changed incidents are dropped.
+        """
+        with transaction.commit_on_success():
+            rows = list(queryset.filter(is_homicide=False).values(
+                'id', 'inc_date', 'is_suspects_unknown', 'lat', 'lng'))
+            if not rows:
+                self.message_user(request, "Those incidents are already homicides.")
+                return
+            Incident.objects.filter(id__in=[row['id'] for row in rows]).update(is_homicide=True)
+            groups = {}
+            for row in rows:
+                key = (row['inc_date'], row['is_suspects_unknown'])
+                groups[key] = groups.get(key, 0) + 1
+            for (inc_date, is_suspects_unknown), count in groups.items():
+                stats.apply_incident_delta(inc_date, False, is_suspects_unknown, sign=-1, count=count)
+                stats.apply_incident_delta(inc_date, True, is_suspects_unknown, sign=1, count=count)
+
+        dates = set(row['inc_date'] for row in rows)
+        analytics.invalidate_dates(dates)
+        heatmap.invalidate_all()
+        points = set((row['lat'], row['lng']) for row in rows)
+        if len(points) > MAX_TILE_POINTS:
+            clustering.invalidate_all()
+        else:
+            for lat, lng in points:
+                clustering.invalidate_point(lat, lng)
+        caching.bump('search', count_scope(Incident), *['incident:%s' % row['id'] for row in rows])
+        caching.bump_frames('stats', dates)
+        caching.bump_frames('incidents', dates)
+        self.message_user(request, "Marked %d incidents as homicides." % len(rows))
     mark_as_homicide.short_description = "Mark incidents as homicides"
 
 
-class VictimAdmin(admin.ModelAdmin):
+class PersonAdmin(ArchiveAdmin):
+    actions = ['merge_people']
+
+    def merge_people(self, request, queryset):
+        """
+        Merges the selected people into the one entered first,
+        for repeats the match_people command proposes.
+        """
+        ids = sorted(queryset.values_list('id', flat=True))
+        if len(ids) < 2:
+            self.message_user(request, "Select at least two people to merge.")
+            return
+        matching.merge_people(self.model, [(ids[0], ids[1:])])
+        self.message_user(request, "Merged %d people into %s." % (
+            len(ids) - 1, self.model.objects.get(id=ids[0])))
+    merge_people.short_description = "Merge into the first entered"
+
+
+class VictimAdmin(PersonAdmin):
     list_display = ('last_name', 'first_name', 'age', 'sex', 'wound_location', 'is_unidentified', 'is_killed', 'id')
     list_filter = ['sex', 'is_killed', 'is_unidentified', 'wound_location']
-    search_fields = ['last_name', 'first_name']
+    search_fields = ['^last_name', '^first_name']
     prepopulated_fields = {'vic_slug': ('last_name', 'first_name')}
     fieldsets = [
         ('Bio.',
@@ -85,10 +235,10 @@ class VictimAdmin(admin.ModelAdmin):
     ]
 
 
-class SuspectAdmin(admin.ModelAdmin):
+class SuspectAdmin(PersonAdmin):
     list_display = ('last_name', 'first_name', 'age', 'sex', 'is_unidentified', 'arrest_date', 'id')
     list_filter = ['arrest_date', 'sex', 'is_unidentified']
-    search_fields = ['last_name', 'first_name']
+    search_fields = ['^last_name', '^first_name']
     prepopulated_fields = {'suspect_slug': ('last_name', 'first_name')}
     fieldsets = [
         ('Bio.',
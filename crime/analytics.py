@@ -0,0 +1,251 @@
+"""
+Trend analytics for the newsroom's charts.
+
+time_series() counts incidents per day, week or month, broken down by
+incident type, homicide and arrest (suspects known). The counts come
+from one GROUP BY over inc_date and are rolled up into buckets here,
+which works the same on every database backend. Each bucket is cached
+on its own. A bucket that ended before today is closed: it's kept until
+an incident in it is edited, so normally only the current period is
+ever recomputed.
+
+Age histograms and wound breakdowns are single GROUP BY queries too,
+cached under the versions of the victim and suspect listings.
+"""
+import datetime
+from django.core.cache import cache
+from django.db.models import Count, Min
+from myproject.crime.caching import VERSION_TIMEOUT, bump, frame_scope, get_versions
+from myproject.crime.helpers import get_since_date, monthdelta
+from myproject.crime.instrumentation import cache_event
+from myproject.crime.models import Incident, Suspect, Victim, WOUND_CHOICES
+
+PERIODS = ('day', 'week', 'month')
+MAX_BUCKETS = 1000
+AGE_BIN_WIDTH = 10
+OPEN_BUCKET_TIMEOUT = 60 * 5
+
+
+def bucket_start(date, period):
+    """
+    Returns the first day of the bucket containing a date.
+    Weeks start on Monday.
+    """
+    if period == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    if period == 'month':
+        return date.replace(day=1)
+    return date
+
+
+def next_bucket(start, period):
+    if period == 'week':
+        return start + datetime.timedelta(weeks=1)
+    if period == 'month':
+        return monthdelta(start, 1)
+    return start + datetime.timedelta(days=1)
+
+
+def bucket_starts(start, end, period):
+    """
+    Returns the starts of the buckets from the one containing
+    start through the one containing end.
+    """
+    starts = []
+    current = bucket_start(start, period)
+    while current <= end:
+        starts.append(current)
+        current = next_bucket(current, period)
+    return starts
+
+
+def _bucket_key(generation, period, start):
+    return 'crime:analytics:%s:%s:%s' % (generation, period, start.isoformat())
+
+
+def _empty_bucket(start, period, today):
+    end = next_bucket(start, period)
+    return {
+        'start': start.isoformat(),
+        'end': (end - datetime.timedelta(days=1)).isoformat(),
+        'closed': end <= today,
+        'total': 0,
+        'homicides': 0,
+        'arrests': 0,
+        'groups': [],
+    }
+
+
+def _compute_buckets(starts, period, today):
+    """
+    Counts the given buckets with one GROUP BY query over
+    the days they span.
+    """
+    buckets = dict((start, _empty_bucket(start, period, today)) for start in starts)
+    rows = Incident.objects.between(
+        min(starts), next_bucket(max(starts), period) - datetime.timedelta(days=1)
+    ).values('inc_date', 'inc_type', 'is_homicide', 'is_suspects_unknown').annotate(
+        n=Count('id')).order_by()
+
+    groups = {}
+    for row in rows:
+        start = bucket_start(row['inc_date'], period)
+        if start not in buckets:
+            continue
+        bucket = buckets[start]
+        bucket['total'] += row['n']
+        if row['is_homicide']:
+            bucket['homicides'] += row['n']
+        if not row['is_suspects_unknown']:
+            bucket['arrests'] += row['n']
+        key = (start, row['inc_type'], row['is_homicide'], row['is_suspects_unknown'])
+        groups[key] = groups.get(key, 0) + row['n']
+
+    for (start, inc_type, is_homicide, is_suspects_unknown), n in sorted(groups.items()):
+        buckets[start]['groups'].append({
+            'type': inc_type,
+            'homicide': is_homicide,
+            'suspects_unknown': is_suspects_unknown,
+            'count': n,
+        })
+    return buckets
+
+
+def time_series(period='month', start=None, end=None, today=None):
+    """
+    Returns a list of buckets, oldest first, from the one containing
+    start through the one containing end (default: today). Closed
+    buckets come from the cache when possible; the rest are computed
+    together.
+    """
+    if period not in PERIODS:
+        raise ValueError("period must be one of %s" % ', '.join(PERIODS))
+    if today is None:
+        today = datetime.date.today()
+    end = min(end or today, today)
+    if start is None:
+        start = Incident.objects.aggregate(first=Min('inc_date'))['first'] or today
+    starts = bucket_starts(start, end, period)
+    if len(starts) > MAX_BUCKETS:
+        raise ValueError("more than %d %s buckets requested" % (MAX_BUCKETS, period))
+    if not starts:
+        return []
+
+    generation = get_versions(['analytics'])[0]
+    keys = dict((_bucket_key(generation, period, start), start) for start in starts)
+    found = cache.get_many(keys.keys())
+    buckets = dict((keys[key], bucket) for key, bucket in found.items())
+
+    missing = [start for start in starts if start not in buckets]
+    for start in starts:
+        cache_event('analytics', start in buckets)
+    if missing:
+        computed = _compute_buckets(missing, period, today)
+        buckets.update(computed)
+        closed = dict((_bucket_key(generation, period, start), bucket)
+            for start, bucket in computed.items() if bucket['closed'])
+        if closed:
+            cache.set_many(closed, VERSION_TIMEOUT)
+        for start, bucket in computed.items():
+            if not bucket['closed']:
+                cache.set(_bucket_key(generation, period, start), bucket, OPEN_BUCKET_TIMEOUT)
+    return [buckets[start] for start in starts]
+
+
+def invalidate_dates(dates):
+    """
+    Drops the cached buckets, for every period, that contain the given
+    dates. Called when incidents are saved or deleted, since that's
+    the only way a closed bucket can change.
+    """
+    generation = get_versions(['analytics'])[0]
+    keys = set()
+    for date in dates:
+        if date is not None:
+            keys.update(_bucket_key(generation, period, bucket_start(date, period)) for period in PERIODS)
+    if keys:
+        cache.delete_many(list(keys))
+
+
+def invalidate_all():
+    """
+    Drops every cached bucket, for bulk changes.
+    """
+    bump('analytics')
+
+
+def _people(model, since_date, end=None):
+    dates = {}
+    if since_date is not None:
+        dates['incident__inc_date__gte'] = since_date
+    if end is not None:
+        dates['incident__inc_date__lte'] = end
+    if not dates:
+        return model.objects.all()
+    return model.objects.filter(**dates)
+
+
+def _period(time_frame, start, end):
+    """
+    Returns (first date, last date, cache name, scope time frame)
+    for a time frame, or for explicit dates when given.
+    """
+    if start or end:
+        return start, end, '%s:%s' % (start or '', end or ''), 'all'
+    return get_since_date(time_frame), None, time_frame, time_frame
+
+
+def _cached(name, scopes, compute):
+    key = 'crime:analytics:%s:%s' % (name, get_versions(scopes))
+    result = cache.get(key)
+    if result is None:
+        result = compute()
+        cache.set(key, result, VERSION_TIMEOUT)
+    return result
+
+
+def age_histogram(model, time_frame='all', width=AGE_BIN_WIDTH, start=None, end=None):
+    """
+    Counts the victims or suspects (model) in a time frame, or
+    between the start and end dates, by age, in bins `width` years
+    wide. People of unknown age are counted separately.
+    """
+    listing = 'victims' if model is Victim else 'suspects'
+    since_date, end, name, frame = _period(time_frame, start, end)
+
+    def compute():
+        rows = _people(model, since_date, end).values('age').annotate(
+            n=Count('id', distinct=True)).order_by()
+        bins, unknown = {}, 0
+        for row in rows:
+            if row['age'] is None:
+                unknown += row['n']
+            else:
+                low = row['age'] // width * width
+                bins[low] = bins.get(low, 0) + row['n']
+        return {
+            'bins': [{'from': low, 'to': low + width - 1, 'count': bins[low]} for low in sorted(bins)],
+            'unknown': unknown,
+        }
+    return _cached('ages:%s:%s:%d' % (listing, name, width),
+        [frame_scope(listing, frame)], compute)
+
+
+def wound_breakdown(time_frame='all', start=None, end=None):
+    """
+    Counts victims in a time frame, or between the start and end
+    dates, by wound location, split into killed and wounded.
+    """
+    since_date, end, name, frame = _period(time_frame, start, end)
+
+    def compute():
+        rows = _people(Victim, since_date, end).values(
+            'wound_location', 'is_killed').annotate(n=Count('id', distinct=True)).order_by()
+        locations = dict((code, {'location': code, 'label': label, 'killed': 0, 'wounded': 0})
+            for code, label in WOUND_CHOICES)
+        for row in rows:
+            location = locations.get(row['wound_location'])
+            if location:
+                location['killed' if row['is_killed'] else 'wounded'] += row['n']
+        return [locations[code] for code, label in WOUND_CHOICES]
+    return _cached('wounds:%s' % name, [frame_scope('victims', frame)], compute)
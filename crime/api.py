@@ -0,0 +1,280 @@
+"""
+Read-only JSON API for incidents, victims and suspects.
+
+Rows are read with values() and serialized straight from the
+dictionaries, so no model instances are built. Clients choose columns
+with ?fields=, get related people or incidents either as ids
+(?fields=...,victims) or as nested records (?embed=victims), and page
+with the cursor in each response's "next". A page costs one query for
+the rows, plus one per related listing and one more per embed,
+however many rows it has.
+"""
+import datetime
+from myproject.crime.helpers import get_since_date, parse_date
+from myproject.crime.models import Incident, Suspect, Victim, INC_TYPE_CHOICES
+from myproject.crime.pagination import decode_cursor, make_cursor
+
+DEFAULT_LIMIT = 25
+MAX_LIMIT = 200
+
+# Public field name -> column. "url" is built from id and inc_slug.
+INCIDENT_FIELDS = (
+    ('id', 'id'),
+    ('url', 'inc_slug'),
+    ('headline', 'headline'),
+    ('date', 'inc_date'),
+    ('time', 'inc_time'),
+    ('type', 'inc_type'),
+    ('homicide', 'is_homicide'),
+    ('address', 'address'),
+    ('city', 'city'),
+    ('state', 'state'),
+    ('formatted_address', 'formatted_address'),
+    ('approximate_address', 'is_approximate_address'),
+    ('latitude', 'lat'),
+    ('longitude', 'lng'),
+    ('victim_count', 'victim_count'),
+    ('killed_count', 'killed_count'),
+    ('suspect_count', 'suspect_count'),
+    ('victims_unknown', 'is_victims_unknown'),
+    ('suspects_unknown', 'is_suspects_unknown'),
+    ('summary', 'summary'),
+)
+VICTIM_FIELDS = (
+    ('id', 'id'),
+    ('first_name', 'first_name'),
+    ('last_name', 'last_name'),
+    ('age', 'age'),
+    ('sex', 'sex'),
+    ('killed', 'is_killed'),
+    ('wound_location', 'wound_location'),
+    ('unidentified', 'is_unidentified'),
+    ('slug', 'vic_slug'),
+    ('about', 'about'),
+)
+SUSPECT_FIELDS = (
+    ('id', 'id'),
+    ('first_name', 'first_name'),
+    ('last_name', 'last_name'),
+    ('age', 'age'),
+    ('sex', 'sex'),
+    ('arrest_date', 'arrest_date'),
+    ('unidentified', 'is_unidentified'),
+    ('slug', 'suspect_slug'),
+    ('about', 'about'),
+)
+
+# Fields sent when ?fields= isn't given; everything but the long texts.
+DEFAULT_INCIDENT_FIELDS = tuple(name for name, column in INCIDENT_FIELDS if name != 'summary')
+DEFAULT_VICTIM_FIELDS = tuple(name for name, column in VICTIM_FIELDS if name != 'about')
+DEFAULT_SUSPECT_FIELDS = tuple(name for name, column in SUSPECT_FIELDS if name != 'about')
+
+
+class ApiError(ValueError):
+    """
+    A bad request parameter; the message is sent to the client.
+    """
+    pass
+
+
+class Resource(object):
+    """
+    How one model is exposed: its fields, the defaults and its
+    relations, as (name, through model, own column, other column,
+    other resource name).
+    """
+    def __init__(self, model, fields, defaults, relations):
+        self.model = model
+        self.fields = fields
+        self.columns = dict(fields)
+        self.defaults = defaults
+        self.relations = relations
+
+
+RESOURCES = {
+    'incidents': Resource(Incident, INCIDENT_FIELDS, DEFAULT_INCIDENT_FIELDS, (
+        ('victims', Incident.victims.through, 'incident_id', 'victim_id', 'victims'),
+        ('suspects', Incident.suspects.through, 'incident_id', 'suspect_id', 'suspects'),
+    )),
+    'victims': Resource(Victim, VICTIM_FIELDS, DEFAULT_VICTIM_FIELDS, (
+        ('incidents', Incident.victims.through, 'victim_id', 'incident_id', 'incidents'),
+    )),
+    'suspects': Resource(Suspect, SUSPECT_FIELDS, DEFAULT_SUSPECT_FIELDS, (
+        ('incidents', Incident.suspects.through, 'suspect_id', 'incident_id', 'incidents'),
+    )),
+}
+
+
+def _split(value):
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+def parse_fields(resource, value):
+    """
+    Returns the (fields, relations) named in a ?fields= value.
+    """
+    if not value:
+        return list(resource.defaults), []
+    relation_names = [relation[0] for relation in resource.relations]
+    fields, relations = [], []
+    for name in _split(value):
+        if name in resource.columns:
+            fields.append(name)
+        elif name in relation_names:
+            relations.append(name)
+        else:
+            raise ApiError("Unknown field %r; choose from %s." % (
+                name, ', '.join([field for field, column in resource.fields] + relation_names)))
+    return fields, relations
+
+
+def _bool(value, name):
+    if value in ('1', 'true', 'yes'):
+        return True
+    if value in ('0', 'false', 'no'):
+        return False
+    raise ApiError("%s must be true or false." % name)
+
+
+def _date(value, name):
+    try:
+        return parse_date(value)
+    except ValueError:
+        raise ApiError("%s must be a YYYY-MM-DD date." % name)
+
+
+def _limit(value):
+    try:
+        return max(1, min(int(value or DEFAULT_LIMIT), MAX_LIMIT))
+    except ValueError:
+        raise ApiError("limit must be a number.")
+
+
+def serialize(resource, fields, row):
+    """
+    Turns a values() row into a record with the public field names.
+    """
+    record = {}
+    for name in fields:
+        value = row[resource.columns[name]]
+        if name == 'url':
+            value = Incident(id=row['id'], inc_slug=value).get_absolute_url()
+        elif isinstance(value, datetime.time):
+            value = value.strftime('%H:%M')
+        elif isinstance(value, datetime.date):
+            value = value.isoformat()
+        record[name] = value
+    return record
+
+
+def _columns(resource, fields, *extra):
+    columns = set(resource.columns[name] for name in fields)
+    columns.update(extra)
+    return list(columns)
+
+
+def _attach_relations(resource, records, relations, embed):
+    """
+    Adds related ids, or embedded records, to each record:
+    one query per relation, and one more per embedded one.
+    """
+    ids = [record['_id'] for record in records]
+    for name, through, own, other, other_resource in resource.relations:
+        if name not in relations and name not in embed:
+            continue
+        links = {}
+        for own_id, other_id in through.objects.filter(**{own + '__in': ids}).values_list(own, other):
+            links.setdefault(own_id, []).append(other_id)
+        if name in embed:
+            related = RESOURCES[other_resource]
+            rows = related.model.objects.filter(id__in=set(sum(links.values(), []))).values(
+                *_columns(related, related.defaults, 'id'))
+            by_id = dict((row['id'], serialize(related, related.defaults, row)) for row in rows)
+            for record in records:
+                record[name] = [by_id[id] for id in sorted(links.get(record['_id'], [])) if id in by_id]
+        else:
+            for record in records:
+                record[name] = sorted(links.get(record['_id'], []))
+
+
+def _page(resource, rows, fields, relations, embed, limit, cursor_for):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = cursor_for(rows[-1])
+    records = []
+    for row in rows:
+        record = serialize(resource, fields, row)
+        record['_id'] = row['id']
+        records.append(record)
+    _attach_relations(resource, records, relations, embed)
+    for record in records:
+        del record['_id']
+    return {'data': records, 'next': next_cursor}
+
+
+def _common(resource, params):
+    fields, relations = parse_fields(resource, params.get('fields'))
+    embed = _split(params.get('embed'))
+    relation_names = [relation[0] for relation in resource.relations]
+    for name in embed:
+        if name not in relation_names:
+            raise ApiError("Can't embed %r; choose from %s." % (name, ', '.join(relation_names)))
+    return fields, relations, embed, _limit(params.get('limit'))
+
+
+def incidents(params):
+    """
+    Returns a page of incidents, newest first. Takes fields, embed,
+    limit, after (a cursor), time_frame, start, end, inc_type
+    (comma-separated codes) and is_homicide.
+    """
+    resource = RESOURCES['incidents']
+    fields, relations, embed, limit = _common(resource, params)
+
+    queryset = Incident.objects.in_time_frame(str(params.get('time_frame'))).between(
+        params.get('start') and _date(params['start'], 'start'),
+        params.get('end') and _date(params['end'], 'end'))
+    if params.get('inc_type'):
+        types = _split(params['inc_type'])
+        known = [code for code, label in INC_TYPE_CHOICES]
+        if [code for code in types if code not in known]:
+            raise ApiError("inc_type must be one or more of %s." % ', '.join(known))
+        queryset = queryset.filter(inc_type__in=types)
+    if params.get('is_homicide'):
+        queryset = queryset.filter(is_homicide=_bool(params['is_homicide'], 'is_homicide'))
+
+    queryset = queryset.latest_first()
+    if params.get('after'):
+        position = decode_cursor(params['after'])
+        if position is None:
+            raise ApiError("after must be a cursor from a previous response.")
+        queryset = queryset.seek(*position)
+    rows = list(queryset.values(*_columns(resource, fields, 'id', 'inc_date', 'inc_time'))[:limit + 1])
+    return _page(resource, rows, fields, relations, embed, limit,
+        lambda row: make_cursor(row['inc_date'], row['inc_time'], row['id']))
+
+
+def people(name, params):
+    """
+    Returns a page of victims or suspects (name), most recently
+    added first. Takes fields, embed, limit, after (a cursor),
+    time_frame, and for victims, killed.
+    """
+    resource = RESOURCES[name]
+    fields, relations, embed, limit = _common(resource, params)
+
+    queryset = resource.model.objects.all()
+    since_date = get_since_date(str(params.get('time_frame')))
+    if since_date:
+        queryset = queryset.filter(id__in=resource.model.objects.filter(
+            incident__inc_date__gte=since_date).values('id'))
+    if name == 'victims' and params.get('killed'):
+        queryset = queryset.filter(is_killed=_bool(params['killed'], 'killed'))
+    if params.get('after'):
+        try:
+            queryset = queryset.filter(id__lt=int(params['after']))
+        except ValueError:
+            raise ApiError("after must be a cursor from a previous response.")
+    rows = list(queryset.order_by('-id').values(*_columns(resource, fields, 'id'))[:limit + 1])
+    return _page(resource, rows, fields, relations, embed, limit, lambda row: str(row['id']))
@@ -0,0 +1,182 @@
+"""
+Static asset bundles for the crime pages.
+
+build() concatenates the files of each bundle in BUNDLES, minifies
+them, and writes them to static/bundles/ under names containing a hash
+of their contents, next to gzip (and, if the brotli module is
+installed, brotli) precompressed copies. Because a bundle's name
+changes whenever its contents do, the web server or CDN can cache
+bundles forever. manifest.json maps each bundle to its current file;
+the {% crimebundle %} tag reads it, and falls back to the separate
+source files when no bundles have been built (in development).
+
+JavaScript is minified with jsmin when it's installed and is otherwise
+only concatenated; the large libraries are already minified.
+"""
+import gzip
+import hashlib
+import os
+import posixpath
+import re
+import simplejson
+from cStringIO import StringIO
+from django.conf import settings
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from jsmin import jsmin
+except ImportError:
+    jsmin = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+BUNDLE_DIR = 'bundles'
+MANIFEST = 'manifest.json'
+
+# Bundle name -> kind -> files under static/, in load order. Pages
+# include "base" and then their own bundle. leaflet-src.js (the
+# unminified copy of leaflet.js) and crime_bak.css are left out.
+BUNDLES = getattr(settings, 'CRIME_ASSET_BUNDLES', {
+    'base': {
+        'css': ['bootstrap/css/bootstrap.min.css', 'crime.css'],
+        'js': ['bootstrap/js/bootstrap.min.js'],
+    },
+    'index': {
+        'js': ['js/curvycorners.js', 'js/jquery.flip.min.js', 'flip.js'],
+    },
+    'map': {
+        'css': ['js/leaflet/leaflet.css'],
+        'js': ['js/leaflet/leaflet.js', 'js/leaflet/leafclusterer.js',
+               'js/leaflet/leaflet-custom.js', 'js/crime_map.js'],
+    },
+})
+
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+_CSS_SPACE = re.compile(r'\s+')
+_CSS_PUNCTUATION = re.compile(r'\s*([{};,>])\s*')
+_CSS_COLON = re.compile(r':\s+')
+_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def minify_css(css):
+    """
+    Drops comments and unneeded whitespace. Conservative:
+    it doesn't rewrite values.
+    """
+    css = _CSS_COMMENT.sub('', css)
+    css = _CSS_SPACE.sub(' ', css)
+    css = _CSS_PUNCTUATION.sub(r'\1', css)
+    # Not the space before a colon: "a :hover" isn't "a:hover".
+    css = _CSS_COLON.sub(':', css)
+    return css.replace(';}', '}').strip()
+
+
+def rebase_css_urls(css, source, bundle_dir=BUNDLE_DIR):
+    """
+    Rewrites relative url()s in a stylesheet at `source` (a path under
+    static/) so they still resolve from the bundle directory.
+    """
+    source_dir = posixpath.dirname(source)
+
+    def rebase(match):
+        url = match.group(2)
+        if re.match(r'^(#|/|data:|[a-z]+://)', url):
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(source_dir, url))
+        return 'url(%s)' % posixpath.relpath(target, bundle_dir)
+    return _CSS_URL.sub(rebase, css)
+
+
+def bundle_content(kind, files, static_dir=STATIC_DIR):
+    parts = []
+    for name in files:
+        with open(os.path.join(static_dir, name), 'rb') as f:
+            content = f.read()
+        if kind == 'css':
+            parts.append(minify_css(rebase_css_urls(content, name)))
+        else:
+            parts.append(jsmin(content) if jsmin and not name.endswith('.min.js') else content)
+    separator = '\n' if kind == 'css' else ';\n'
+    return separator.join(parts) + '\n'
+
+
+def _write(path, data):
+    # Write next to the target and rename, so a half-written bundle is never served.
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.rename(temp, path)
+
+
+def _gzip(data):
+    output = StringIO()
+    with gzip.GzipFile(fileobj=output, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return output.getvalue()
+
+
+def build(bundles=None, static_dir=STATIC_DIR):
+    """
+    Builds every bundle and the manifest, removes bundles that neither
+    the new nor the previous manifest uses, and returns the manifest:
+    {"map.js": "bundles/map.<hash>.js", ...}.
+    """
+    bundles = bundles or BUNDLES
+    output_dir = os.path.join(static_dir, BUNDLE_DIR)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    previous = read_manifest(static_dir)
+
+    manifest = {}
+    for name, kinds in sorted(bundles.items()):
+        for kind, files in sorted(kinds.items()):
+            data = bundle_content(kind, files, static_dir)
+            filename = '%s.%s.%s' % (name, hashlib.md5(data).hexdigest()[:12], kind)
+            path = os.path.join(output_dir, filename)
+            if not os.path.exists(path):
+                _write(path, data)
+                _write(path + '.gz', _gzip(data))
+                if brotli:
+                    _write(path + '.br', brotli.compress(data))
+            manifest['%s.%s' % (name, kind)] = posixpath.join(BUNDLE_DIR, filename)
+    _write(os.path.join(output_dir, MANIFEST), simplejson.dumps(manifest, indent=2, sort_keys=True))
+
+    # Pages rendered before the deploy may still ask for the previous bundles.
+    keep = set(posixpath.basename(path) for path in manifest.values() + previous.values())
+    for filename in os.listdir(output_dir):
+        if filename != MANIFEST and filename.split('.gz')[0].split('.br')[0] not in keep:
+            os.remove(os.path.join(output_dir, filename))
+    _manifests.pop(static_dir, None)
+    return manifest
+
+
+_manifests = {}
+
+
+def read_manifest(static_dir=STATIC_DIR):
+    """
+    Returns the built manifest, or {} if there is none.
+    Reread only when the file changes.
+    """
+    path = os.path.join(static_dir, BUNDLE_DIR, MANIFEST)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+    cached = _manifests.get(static_dir)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            cached = _manifests[static_dir] = (mtime, simplejson.load(f))
+    return cached[1]
+
+
+def bundle_paths(name, kind, static_dir=STATIC_DIR):
+    """
+    Returns the static paths to include for a bundle: its built file,
+    or its source files if it hasn't been built.
+    """
+    built = read_manifest(static_dir).get('%s.%s' % (name, kind))
+    if built:
+        return [built]
+    return list(BUNDLES.get(name, {}).get(kind, []))
@@ -0,0 +1,269 @@
+"""
+Publishes the public crime pages as static files.
+
+bake() renders the main listing (every time frame and page), the map,
+the victim and suspect listings, and every incident page through the
+normal views, and writes them under an output directory. Listing pages
+are saved as <path>/index.html, or as <path>/index.<query>.html when
+they take parameters, e.g. victims/index.page=2&time_frame=week.html.
+The web server serves them with a rule like nginx's
+
+    try_files /baked$uri/index.$args.html /baked$uri/index.html @django;
+
+Each page depends on the cache scopes it shows (see caching.py), the
+same ones its cached view uses. The manifest in the output directory
+records the scope versions each file was rendered with. A later bake
+renders again only the files whose versions have moved. Saving an
+incident therefore redoes its own page, the pages that list it as
+nearby, and the listings of the time frames it falls in. Incident
+pages leave out the sidebar stats scope, which changes with every
+incident; "bake --all" refreshes them.
+
+Pages are rendered by a pool of worker processes, each with its own
+database connection. Every file, and the manifest, is written to a
+temporary name and renamed into place, so the server never sees half
+a file.
+"""
+import hashlib
+import math
+import multiprocessing
+import os
+import tempfile
+import urllib
+import simplejson
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from myproject.crime.caching import frame_scope, get_versions
+from myproject.crime.helpers import TIME_FRAMES, get_since_date
+from myproject.crime.models import Incident, Suspect, Victim
+from myproject.crime.views import INDEX_LISTINGS, INDEX_PAGE_SIZE, PEOPLE_PAGE_SIZE
+
+MANIFEST = '.bake-manifest.json'
+WORKERS = 4
+# Scope versions read from the cache per request.
+VERSION_BATCH = 1000
+
+
+class Page(object):
+    """
+    One baked file: the URL path and GET parameters it's rendered
+    from, and the scopes whose versions decide when it's stale.
+    """
+    def __init__(self, path, params, scopes, url=None):
+        self.path = path
+        self.params = params
+        self.scopes = scopes
+        self.url = url or path
+
+    @property
+    def filename(self):
+        name = 'index.html'
+        if self.params:
+            name = 'index.%s.html' % urllib.urlencode(sorted(self.params.items()))
+        return os.path.join(self.path.strip('/'), name)
+
+
+def _pages_for(count, page_size):
+    return max(int(math.ceil(count / float(page_size))), 1)
+
+
+def _people_count(model, time_frame):
+    people = model.objects.all()
+    if model is Victim:
+        people = people.filter(is_unidentified=False)
+    since_date = get_since_date(time_frame)
+    if since_date:
+        people = people.filter(incident__inc_date__gte=since_date)
+    else:
+        people = people.filter(incident__isnull=False)
+    return people.values('id').distinct().count()
+
+
+def _listing(path, scopes, page_count, time_frame):
+    """
+    The pages of one listing in one time frame. The "all" time frame
+    is also the default, parameterless page.
+    """
+    pages = []
+    for number in range(1, page_count + 1):
+        params = {'time_frame': time_frame}
+        if number > 1:
+            params['page'] = str(number)
+        pages.append(Page(path, params, scopes))
+        if time_frame == 'all':
+            params = dict(params)
+            del params['time_frame']
+            pages.append(Page(path, params, scopes))
+    return pages
+
+
+def site_pages():
+    """
+    Returns a Page for everything the site publishes.
+    """
+    index = reverse('myproject.crime.views.index')
+    map_path = reverse('myproject.crime.views.index', kwargs={'map': True})
+    victims = reverse('myproject.crime.views.victims_page')
+    suspects = reverse('myproject.crime.views.suspects_page')
+
+    pages = []
+    for time_frame in TIME_FRAMES:
+        stats = frame_scope('stats', time_frame)
+        listings = [frame_scope(listing, time_frame) for listing in INDEX_LISTINGS]
+        pages.extend(_listing(index, listings + [stats],
+            _pages_for(Incident.objects.in_time_frame(time_frame).count(), INDEX_PAGE_SIZE), time_frame))
+        pages.extend(_listing(map_path, listings + [stats], 1, time_frame))
+        pages.extend(_listing(victims, [frame_scope('victims', time_frame), stats],
+            _pages_for(_people_count(Victim, time_frame), PEOPLE_PAGE_SIZE), time_frame))
+        pages.extend(_listing(suspects, [frame_scope('suspects', time_frame), stats],
+            _pages_for(_people_count(Suspect, time_frame), PEOPLE_PAGE_SIZE), time_frame))
+
+    for id, inc_slug in Incident.objects.values_list('id', 'inc_slug').iterator():
+        # The file goes where the page's links point; see Incident.get_absolute_url().
+        incident = Incident(id=id, inc_slug=inc_slug)
+        pages.append(Page(incident.get_absolute_url(), {}, ['incident:%s' % id],
+            url=reverse('myproject.crime.views.incident_page', args=[id, inc_slug])))
+    return pages
+
+
+def write_atomically(path, content):
+    """
+    Writes a file through a temporary one in the same
+    directory, renamed over it when complete.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):  # Another worker made it first.
+                raise
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.bake-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(temp, 0o644)
+        os.rename(temp, path)
+    except Exception:
+        os.remove(temp)
+        raise
+
+
+_client = None
+
+
+def _start_worker():
+    # Forked workers must not share the parent's database connection.
+    global _client
+    connection.close()
+    _client = Client()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def render_page(job):
+    """
+    Renders one page and writes it under the output directory.
+    Returns (filename, status code, digest of the content). A page
+    that isn't a 200 has its old file removed, and one whose view
+    raised has a status of None and the error instead of a digest.
+    """
+    url, params, filename, output = job
+    global _client
+    if _client is None:
+        _client = Client()
+    try:
+        response = _client.get(url, params)
+    except Exception as e:  # The test client re-raises what the view raised.
+        _remove(os.path.join(output, filename))
+        return filename, None, '%s: %s' % (e.__class__.__name__, e)
+    if response.status_code != 200:
+        _remove(os.path.join(output, filename))
+        return filename, response.status_code, None
+    write_atomically(os.path.join(output, filename), response.content)
+    return filename, 200, hashlib.md5(response.content).hexdigest()
+
+
+def read_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST)) as f:
+            return simplejson.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+class BakeReport(object):
+    def __init__(self):
+        self.pages = 0
+        self.rendered = 0
+        self.removed = 0
+        self.errors = []
+
+    def __unicode__(self):
+        return u'%d pages: %d rendered, %d up to date, %d removed, %d errors' % (
+            self.pages, self.rendered, self.pages - self.rendered - len(self.errors),
+            self.removed, len(self.errors))
+
+
+def bake(output, workers=WORKERS, full=False, progress=None):
+    """
+    Brings the baked site in `output` up to date: renders the new
+    and stale pages (every page with full=True), removes pages that
+    no longer exist, and saves the manifest. Returns a BakeReport.
+    """
+    report = BakeReport()
+    manifest = read_manifest(output)
+    pages = site_pages()
+    report.pages = len(pages)
+
+    # Versions are read before rendering: a page edited while it's
+    # being rendered keeps its old versions and is done again next time.
+    scopes = sorted(set(scope for page in pages for scope in page.scopes))
+    versions = {}
+    for start in range(0, len(scopes), VERSION_BATCH):
+        batch = scopes[start:start + VERSION_BATCH]
+        versions.update(zip(batch, get_versions(batch)))
+    current, jobs = {}, []
+    for page in pages:
+        state = [[scope, versions[scope]] for scope in page.scopes]
+        current[page.filename] = state
+        entry = manifest.get(page.filename)
+        if full or not entry or entry['scopes'] != state or not os.path.exists(os.path.join(output, page.filename)):
+            jobs.append((page.url, page.params, page.filename, output))
+
+    if workers > 1 and len(jobs) > 1:
+        connection.close()
+        pool = multiprocessing.Pool(workers, _start_worker)
+        try:
+            results = list(pool.imap_unordered(render_page, jobs, chunksize=20))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [render_page(job) for job in jobs]
+
+    new_manifest = dict((filename, entry) for filename, entry in manifest.items() if filename in current)
+    for filename, status, digest in results:
+        if status == 200:
+            report.rendered += 1
+            new_manifest[filename] = {'scopes': current[filename], 'digest': digest}
+        else:
+            if status is None:
+                report.errors.append('%s failed: %s' % (filename, digest))
+            else:
+                report.errors.append('%s returned %d' % (filename, status))
+            new_manifest.pop(filename, None)
+        if progress and status == 200 and report.rendered % 500 == 0:
+            progress(report)
+
+    for filename in set(manifest) - set(current):
+        _remove(os.path.join(output, filename))
+        report.removed += 1
+    write_atomically(os.path.join(output, MANIFEST), simplejson.dumps(new_manifest, sort_keys=True))
+    return report
@@ -0,0 +1,234 @@
+"""
+Latency, query and memory benchmarks for the public crime views.
+
+Each view in VIEWS is requested through the test client `repeat`
+times. "cold" requests add a throwaway query parameter, so the page
+cache misses and the view does its full work. "warm" requests repeat
+the same URL, so they measure the cache path. Results are plain
+dictionaries that the benchmark_crime command writes as JSON; compare()
+checks a run against a stored baseline. nearby_queries() times the
+nearby-incident index against a brute-force scan of every incident.
+person_matching() times repeat-person matching on synthetic names.
+"""
+import datetime
+import math
+import operator
+import resource
+import time
+from django.core.management.color import no_style
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import Max
+from django.test.client import Client
+from myproject.crime import matching, nearby, synthetic
+from myproject.crime.helpers import person_match_key
+from myproject.crime.models import Incident, Suspect
+
+# (name, view, URL kwargs, GET parameters). URL kwargs of None
+# mean the view is for one incident: the latest is used.
+VIEWS = (
+    ('index', 'myproject.crime.views.index', {}, {}),
+    ('index_year', 'myproject.crime.views.index', {}, {'time_frame': 'year', 'page': '3'}),
+    ('map', 'myproject.crime.views.index', {'map': True}, {}),
+    ('map_incidents', 'myproject.crime.views.map_incidents', {}, {'bbox': '-75.60,39.70,-75.50,39.78', 'time_frame': 'year'}),
+    ('victims_page', 'myproject.crime.views.victims_page', {}, {}),
+    ('suspects_page', 'myproject.crime.views.suspects_page', {}, {}),
+    ('incident_page', 'myproject.crime.views.incident_page', None, {}),
+    ('search_page', 'myproject.crime.views.search_page', {}, {'query': 'market street'}),
+    ('analytics', 'myproject.crime.views.analytics_data', {}, {'period': 'month', 'time_frame': 'all'}),
+)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a list of numbers.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def _peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _url(view, kwargs):
+    if kwargs is None:
+        incident = Incident.objects.latest_first().only('id', 'inc_slug')[0]
+        kwargs = {'Incident_id': incident.id, 'Incident_inc_slug': incident.inc_slug}
+    return reverse(view, kwargs=kwargs)
+
+
+def measure(client, path, params, repeat, cold=True):
+    """
+    Requests a page `repeat` times and returns its latency
+    percentiles (ms), its most queries in one request, and the
+    process's peak memory, with how much this page raised it.
+    """
+    timings, queries = [], []
+    start_rss = _peak_rss_kb()
+    old_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        for i in range(repeat):
+            request_params = dict(params)
+            if cold:
+                request_params['_bench'] = '%s.%d' % (time.time(), i)
+            start_queries = len(connection.queries)
+            start = time.time()
+            response = client.get(path, request_params)
+            content = ''.join(response)  # Streamed responses are timed to the end.
+            timings.append((time.time() - start) * 1000.0)
+            queries.append(len(connection.queries) - start_queries)
+            if response.status_code != 200:
+                raise AssertionError('%s returned %d' % (path, response.status_code))
+    finally:
+        connection.use_debug_cursor = old_debug_cursor
+    return {
+        'p50_ms': round(percentile(timings, 0.50), 2),
+        'p90_ms': round(percentile(timings, 0.90), 2),
+        'p95_ms': round(percentile(timings, 0.95), 2),
+        'p99_ms': round(percentile(timings, 0.99), 2),
+        'max_ms': round(max(timings), 2),
+        'queries': max(queries),
+        'bytes': len(content),
+        'peak_rss_kb': _peak_rss_kb(),
+        'rss_growth_kb': _peak_rss_kb() - start_rss,
+    }
+
+
+def run(repeat=20, views=None, warm=True):
+    """
+    Benchmarks the views (all of VIEWS by default) against
+    whatever is in the database. Returns the results.
+    """
+    client = Client()
+    results = {}
+    for name, view, kwargs, params in VIEWS:
+        if views and name not in views:
+            continue
+        path = _url(view, kwargs)
+        results[name] = {'cold': measure(client, path, params, repeat, cold=True)}
+        if warm:
+            results[name]['warm'] = measure(client, path, params, repeat, cold=False)
+    return {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(),
+            'database': connection.vendor,
+            'incidents': Incident.objects.count(),
+            'repeat': repeat,
+        },
+        'views': results,
+    }
+
+
+def compare(results, baseline, threshold=0.2, metric='p95_ms'):
+    """
+    Returns a description of every view and mode that got more than
+    `threshold` (a fraction) slower on `metric` than in the baseline,
+    or runs more queries. An empty list means no regressions.
+    """
+    regressions = []
+    for name, modes in results['views'].items():
+        for mode, current in modes.items():
+            previous = baseline.get('views', {}).get(name, {}).get(mode)
+            if not previous:
+                continue
+            if current[metric] > previous[metric] * (1 + threshold):
+                regressions.append('%s (%s): %s %.1f -> %.1f' % (
+                    name, mode, metric, previous[metric], current[metric]))
+            if current['queries'] > previous['queries']:
+                regressions.append('%s (%s): queries %d -> %d' % (
+                    name, mode, previous['queries'], current['queries']))
+    return sorted(regressions)
+
+
+def _timed(query):
+    start = time.time()
+    rows = query()
+    return (time.time() - start) * 1000.0, [row['id'] for row in rows]
+
+
+def nearby_queries(samples=20, k=nearby.NEARBY_LIMIT, radius=nearby.NEARBY_RADIUS, days=nearby.NEARBY_DAYS):
+    """
+    Times k-nearest and radius queries around `samples` incidents,
+    through the index and by brute force, and checks that both
+    give the same answers. Returns latency percentiles (ms) for each.
+    """
+    incidents = list(Incident.objects.filter(lat__isnull=False).order_by('?').only(
+        'id', 'inc_date', 'lat', 'lng')[:samples])
+    timings = {}
+    window = datetime.timedelta(days=days)
+    for incident in incidents:
+        lat, lng, id = incident.lat, incident.lng, incident.id
+        start, end = incident.inc_date - window, incident.inc_date + window
+        for name, indexed, brute_force in (
+                ('nearest', lambda: nearby.nearest(lat, lng, k, start, end, id),
+                    lambda: nearby.brute_force(lat, lng, k=k, start=start, end=end, exclude=id)),
+                ('within', lambda: nearby.within(lat, lng, radius, start, end, id),
+                    lambda: nearby.brute_force(lat, lng, radius=radius, start=start, end=end, exclude=id))):
+            ms, ids = _timed(indexed)
+            brute_force_ms, brute_force_ids = _timed(brute_force)
+            if ids != brute_force_ids:
+                raise AssertionError('%s around incident %d: %r != %r' % (name, id, ids, brute_force_ids))
+            timings.setdefault(name, []).append(ms)
+            timings.setdefault(name + '_brute_force', []).append(brute_force_ms)
+    return dict((name, {
+        'p50_ms': round(percentile(values, 0.50), 2),
+        'p95_ms': round(percentile(values, 0.95), 2),
+    }) for name, values in timings.items())
+
+
+def person_matching(count=1000, duplicate_share=0.2, seed=0):
+    """
+    Adds `count` synthetic suspects, some of them repeats with typos
+    (see synthetic.generate_people()), and times propose_matches()
+    over the whole table. Returns its time, how many pairs it scored
+    against the number of all pairs, and the share of the known
+    repeats it found (recall) and of its matches that are real
+    repeats (precision). Repeats whose match key differs from the
+    original's can't be found within the blocks: "split" counts them,
+    and "blocked_recall" is the share found of the others.
+    """
+    people, duplicates = synthetic.generate_people(count, duplicate_share, seed)
+    first_id = (Suspect.objects.aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+    Suspect.objects.bulk_create([Suspect(id=first_id + index, suspect_slug='synthetic-%d' % index,
+        match_key=person_match_key(person['first_name'], person['last_name'], person['sex']), **person)
+        for index, person in enumerate(people)])
+    cursor = connection.cursor()
+    for sql in connection.ops.sequence_reset_sql(no_style(), [Suspect]):
+        cursor.execute(sql)
+
+    start = time.time()
+    matches = matching.propose_matches(Suspect)
+    ms = (time.time() - start) * 1000
+    comparisons = sum(len(list(matching.candidate_pairs(rows))) for rows in matching.blocks(Suspect))
+
+    # Which synthetic person each index is, and which merge group it fell in.
+    identity = dict((index, index) for index in range(count))
+    for original, repeat in sorted(duplicates, key=operator.itemgetter(1)):
+        identity[repeat] = identity[original]
+    group = {}
+    for keep, others in matching.group_matches(matches):
+        for id in [keep] + others:
+            group[id - first_id] = keep
+    found = len([1 for a, b in duplicates if a in group and group.get(a) == group.get(b)])
+    keys = [person_match_key(person['first_name'], person['last_name'], person['sex']) for person in people]
+    split = len([1 for a, b in duplicates if keys[a] != keys[b]])
+    correct = len([1 for match in matches
+        if identity.get(match.keep['id'] - first_id, -1) == identity.get(match.other['id'] - first_id, -2)])
+    total = Suspect.objects.count()
+    return {
+        'people': total,
+        'ms': round(ms, 1),
+        'comparisons': comparisons,
+        'all_pairs': total * (total - 1) // 2,
+        'matches': len(matches),
+        'recall': round(found / float(len(duplicates) or 1), 3),
+        'split': split,
+        'blocked_recall': round(found / float(len(duplicates) - split or 1), 3),
+        'precision': round(correct / float(len(matches) or 1), 3),
+    }
@@ -0,0 +1,115 @@
+"""
+Rendered-page caching for the public crime pages.
+
+Each page depends on a few named scopes, e.g. "incident:12",
+"incidents:week" or "stats:all". A scope's version is the time it
+last changed, kept in the cache. Page keys include the versions of
+their scopes, so an edit makes only the pages that show the edited
+data miss the cache; nothing is ever flushed. The versions also give
+every cached page an ETag, so browsers and proxies can revalidate
+with a 304. Last-Modified is sent too, but only a matching ETag gets a
+304: HTTP dates are whole seconds, and an edit in the same second as
+the cached response would be missed.
+"""
+import hashlib
+import math
+import time
+from functools import wraps
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.encoding import smart_str
+from django.utils.http import http_date
+from myproject.crime.helpers import TIME_FRAMES, get_since_date, time_frames_covering
+from myproject.crime.instrumentation import cache_event
+
+PAGE_TIMEOUT = 60 * 60 * 24
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def frame_scope(prefix, time_frame):
+    """
+    Returns the scope for a listing in a time frame. Relative time
+    frames start on a different day each day, so the start date is
+    part of the name.
+    """
+    if time_frame not in TIME_FRAMES:
+        time_frame = 'all'
+    return '%s:%s:%s' % (prefix, time_frame, get_since_date(time_frame) or '')
+
+
+def _version_key(scope):
+    return 'crime:version:%s' % scope
+
+
+def get_versions(scopes):
+    """
+    Returns the version of each scope. Scopes that have none yet
+    (or were evicted) start now, which only causes extra misses.
+    """
+    keys = dict((_version_key(scope), scope) for scope in scopes)
+    found = cache.get_many(keys.keys())
+    now = time.time()
+    missing = dict((key, now) for key in keys if key not in found)
+    if missing:
+        cache.set_many(missing, VERSION_TIMEOUT)
+        found.update(missing)
+    return [found[_version_key(scope)] for scope in scopes]
+
+
+def bump(*scopes):
+    """
+    Marks scopes as changed.
+    """
+    now = time.time()
+    cache.set_many(dict((_version_key(scope), now) for scope in scopes), VERSION_TIMEOUT)
+
+
+def bump_frames(prefix, dates):
+    """
+    Marks the listings that include any of the given dates as changed.
+    """
+    time_frames = set()
+    for date in dates:
+        if date is not None:
+            time_frames.update(time_frames_covering(date))
+    bump(*[frame_scope(prefix, time_frame) for time_frame in time_frames])
+
+
+def cache_page(name, scopes):
+    """
+    Caches a view's rendered output for anonymous GET requests.
+    `scopes` is called with the view's arguments and returns the
+    scopes the page shows. Logged-in users (editors checking their
+    work) always get a fresh page.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            user = getattr(request, 'user', None)
+            if request.method not in ('GET', 'HEAD') or (user and user.is_authenticated()):
+                return view(request, *args, **kwargs)
+
+            versions = get_versions(scopes(request, *args, **kwargs))
+            digest = hashlib.md5(smart_str('%s|%s' % (request.get_full_path(), versions))).hexdigest()
+            etag = '"%s"' % digest
+            last_modified = int(math.ceil(max(versions)))
+
+            if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+                return HttpResponseNotModified()
+
+            key = 'crime:page:%s:%s' % (name, digest)
+            cached = cache.get(key)
+            cache_event('page', cached is not None)
+            if cached is not None:
+                content, content_type = cached
+                response = HttpResponse(content, content_type=content_type)
+            else:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                cache.set(key, (response.content, response['Content-Type']), PAGE_TIMEOUT)
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,121 @@
+"""
+Server-side marker clustering for the map.
+
+The map asks for standard slippy-map tiles (z, x, y). Each tile is
+split into a CLUSTER_GRID x CLUSTER_GRID grid and the incidents in a
+grid cell are returned as one cluster with its centroid and counts by
+incident type and homicide. Tiles are cached until an incident inside
+them is saved or deleted, or until a bulk change drops them all.
+"""
+import math
+from django.core.cache import cache
+from django.db.models import Avg, Count
+from myproject.crime.caching import bump, get_versions
+from myproject.crime.helpers import TIME_FRAMES, get_since_date
+from myproject.crime.instrumentation import cache_event
+from myproject.crime.models import Incident
+
+MAX_ZOOM = 18
+CLUSTER_GRID = 8  # Cells per tile side; must be a power of two.
+TILE_TIMEOUT = 60 * 60 * 24
+
+
+def latlng_to_tile(lat, lng, zoom):
+    """
+    Returns the (x, y) of the tile containing a point at a zoom level.
+    """
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(math.radians(lat)) + 1 / math.cos(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(zoom, x, y):
+    """
+    Returns the (west, south, east, north) edges of a tile.
+    """
+    n = 2.0 ** zoom
+
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
+
+
+def _tile_key(time_frame, zoom, x, y, generation=None):
+    # The relative time frames move daily, so their keys carry the start date.
+    # The "tiles" scope version changes on bulk edits; see invalidate_all().
+    since_date = get_since_date(time_frame)
+    if generation is None:
+        generation = get_versions(['tiles'])[0]
+    return 'crime:tile:%s:%s:%s:%d:%d:%d' % (generation, time_frame, since_date or '', zoom, x, y)
+
+
+def build_tile(zoom, x, y, time_frame='all'):
+    """
+    Computes the clusters for one tile. Incidents are first grouped
+    by geohash in the database, so repeat addresses arrive as one row.
+    """
+    west, south, east, north = tile_bounds(zoom, x, y)
+    incidents = Incident.objects.in_time_frame(time_frame).filter(
+        lat__gte=south, lat__lt=north, lng__gte=west, lng__lt=east)
+    rows = incidents.values('geohash', 'inc_type', 'is_homicide').annotate(
+        n=Count('id'), lat=Avg('lat'), lng=Avg('lng')).order_by()
+
+    cell_zoom = zoom + int(math.log(CLUSTER_GRID, 2))
+    cells = {}
+    for row in rows:
+        cell = cells.setdefault(latlng_to_tile(row['lat'], row['lng'], cell_zoom), {
+            'lat': 0.0, 'lng': 0.0, 'count': 0, 'homicides': 0, 'types': {}})
+        cell['lat'] += row['lat'] * row['n']
+        cell['lng'] += row['lng'] * row['n']
+        cell['count'] += row['n']
+        if row['is_homicide']:
+            cell['homicides'] += row['n']
+        cell['types'][row['inc_type']] = cell['types'].get(row['inc_type'], 0) + row['n']
+
+    clusters = []
+    for cell in cells.values():
+        cell['lat'] = round(cell['lat'] / cell['count'], 5)
+        cell['lng'] = round(cell['lng'] / cell['count'], 5)
+        clusters.append(cell)
+    clusters.sort(key=lambda cell: -cell['count'])
+    return {'z': zoom, 'x': x, 'y': y, 'clusters': clusters}
+
+
+def get_tile(zoom, x, y, time_frame='all'):
+    """
+    Returns the clusters for a tile, from the cache when possible.
+    """
+    if time_frame not in TIME_FRAMES:
+        time_frame = 'all'
+    key = _tile_key(time_frame, zoom, x, y)
+    tile = cache.get(key)
+    cache_event('tile', tile is not None)
+    if tile is None:
+        tile = build_tile(zoom, x, y, time_frame)
+        cache.set(key, tile, TILE_TIMEOUT)
+    return tile
+
+
+def invalidate_point(lat, lng):
+    """
+    Drops every cached tile, at every zoom level and
+    time frame, that contains the given point.
+    """
+    if lat is None or lng is None:
+        return
+    generation = get_versions(['tiles'])[0]
+    keys = []
+    for zoom in range(MAX_ZOOM + 1):
+        x, y = latlng_to_tile(lat, lng, zoom)
+        keys.extend(_tile_key(time_frame, zoom, x, y, generation) for time_frame in TIME_FRAMES)
+    cache.delete_many(keys)
+
+
+def invalidate_all():
+    """
+    Drops every cached tile, for bulk changes
+    that touch too many points to list.
+    """
+    bump('tiles')
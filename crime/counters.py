@@ -0,0 +1,124 @@
+"""
+The people counters stored on each incident.
+
+victim_count, killed_count and suspect_count, and the two "not
+identified" flags, are derived from the incident's victims and
+suspects so listings and aggregates read plain columns. The signals
+in signals.py call refresh_counters() whenever links or people
+change. The verify_crime_counters command checks or repairs the
+whole table in one pass.
+
+The counts come from one GROUP BY per link table. Changed incidents
+are written with one UPDATE per distinct set of values, inside the
+caller's transaction, so the counters commit with the change that
+caused them.
+"""
+from django.db.models import Count
+from myproject.crime.models import Incident
+
+COUNTER_FIELDS = ('victim_count', 'killed_count', 'suspect_count', 'is_victims_unknown', 'is_suspects_unknown')
+
+# Incidents read, or written, per query; small enough
+# for SQLite's limit on query parameters.
+BATCH_SIZE = 500
+
+
+def _empty():
+    return {
+        'victim_count': 0,
+        'killed_count': 0,
+        'suspect_count': 0,
+        'is_victims_unknown': True,
+        'is_suspects_unknown': True,
+    }
+
+
+def compute_counters(incident_ids=None):
+    """
+    Returns {incident id: counters} for the given incidents (default:
+    every incident that has any victims or suspects). An incident is
+    "not identified" while none of its people are identified.
+    """
+    victims = Incident.victims.through.objects.all()
+    suspects = Incident.suspects.through.objects.all()
+    if incident_ids is not None:
+        victims = victims.filter(incident__in=incident_ids)
+        suspects = suspects.filter(incident__in=incident_ids)
+
+    counters = dict((id, _empty()) for id in incident_ids or [])
+    for row in victims.values('incident_id', 'victim__is_killed', 'victim__is_unidentified').annotate(
+            n=Count('id')).order_by():
+        incident = counters.setdefault(row['incident_id'], _empty())
+        incident['victim_count'] += row['n']
+        if row['victim__is_killed']:
+            incident['killed_count'] += row['n']
+        if not row['victim__is_unidentified']:
+            incident['is_victims_unknown'] = False
+    for row in suspects.values('incident_id', 'suspect__is_unidentified').annotate(
+            n=Count('id')).order_by():
+        incident = counters.setdefault(row['incident_id'], _empty())
+        incident['suspect_count'] += row['n']
+        if not row['suspect__is_unidentified']:
+            incident['is_suspects_unknown'] = False
+    return counters
+
+
+def _stale(stored_rows, counters):
+    """
+    Compares stored values() rows with the computed counters and
+    returns [(row, new counters)] for the ones that differ.
+    """
+    stale = []
+    for row in stored_rows:
+        new = counters.get(row['id']) or _empty()
+        if any(row[field] != new[field] for field in COUNTER_FIELDS):
+            stale.append((row, new))
+    return stale
+
+
+def _write(stale):
+    groups = {}
+    for row, new in stale:
+        groups.setdefault(tuple(new[field] for field in COUNTER_FIELDS), []).append(row['id'])
+    for values, ids in groups.items():
+        for start in range(0, len(ids), BATCH_SIZE):
+            Incident.objects.filter(id__in=ids[start:start + BATCH_SIZE]).update(
+                **dict(zip(COUNTER_FIELDS, values)))
+
+
+def refresh_counters(incident_ids):
+    """
+    Recomputes the counters of the given incidents and saves the
+    ones that changed. Returns [(old values() row, new counters)]
+    for those, so callers can update what depends on them.
+    """
+    incident_ids = list(set(incident_ids))
+    if not incident_ids:
+        return []
+    counters = compute_counters(incident_ids)
+    stored = Incident.objects.filter(id__in=incident_ids).values(
+        'id', 'inc_date', 'is_homicide', *COUNTER_FIELDS)
+    stale = _stale(stored, counters)
+    _write(stale)
+    return stale
+
+
+def verify_counters(repair=False):
+    """
+    Checks every incident's counters against its people and, with
+    repair, fixes the wrong ones. Returns [(old values() row, new
+    counters)] for every incident that was wrong.
+    """
+    counters = compute_counters()
+    stale = []
+    last_id = 0
+    while True:
+        rows = list(Incident.objects.filter(id__gt=last_id).order_by('id').values(
+            'id', 'inc_date', 'is_homicide', *COUNTER_FIELDS)[:BATCH_SIZE])
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        stale.extend(_stale(rows, counters))
+    if repair:
+        _write(stale)
+    return stale
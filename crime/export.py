@@ -0,0 +1,191 @@
+"""
+Streaming exports of incidents with their victims and suspects.
+
+Incidents are read in id order, CHUNK_SIZE at a time, with the people
+for each chunk prefetched, and every format is written as a generator
+of strings, so memory use doesn't grow with the archive. Choice fields
+are exported with their labels from models.py.
+"""
+import csv
+import zlib
+import simplejson
+from myproject.crime.models import Incident
+
+CHUNK_SIZE = 500
+FORMATS = ('csv', 'ndjson', 'geojson')
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'geojson': 'application/geo+json',
+}
+
+CSV_COLUMNS = (
+    'id', 'url', 'headline', 'date', 'time', 'type', 'homicide',
+    'address', 'city', 'state', 'formatted_address', 'approximate_address',
+    'latitude', 'longitude', 'victim_count', 'killed_count', 'suspect_count',
+    'victims_unknown', 'suspects_unknown', 'victims', 'suspects', 'summary',
+)
+
+
+def iter_incidents(queryset=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields incidents in id order with their victims and suspects
+    loaded, a chunk at a time.
+    """
+    if queryset is None:
+        queryset = Incident.objects.all()
+    queryset = queryset.order_by('id').prefetch_related('victims', 'suspects')
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+        for incident in chunk:
+            yield incident
+        last_id = chunk[-1].id
+
+
+def victim_record(victim):
+    return {
+        'id': victim.id,
+        'first_name': victim.first_name,
+        'last_name': victim.last_name,
+        'age': victim.age,
+        'sex': victim.get_sex_display(),
+        'killed': victim.is_killed,
+        'wound_location': victim.get_wound_location_display(),
+        'unidentified': victim.is_unidentified,
+    }
+
+
+def suspect_record(suspect):
+    return {
+        'id': suspect.id,
+        'first_name': suspect.first_name,
+        'last_name': suspect.last_name,
+        'age': suspect.age,
+        'sex': suspect.get_sex_display(),
+        'arrest_date': suspect.arrest_date and suspect.arrest_date.isoformat(),
+        'unidentified': suspect.is_unidentified,
+    }
+
+
+def incident_record(incident):
+    """
+    Returns an incident, with its people nested, as a dictionary
+    of JSON-ready values.
+    """
+    return {
+        'id': incident.id,
+        'url': incident.get_absolute_url(),
+        'headline': incident.headline,
+        'date': incident.inc_date.isoformat(),
+        'time': incident.inc_time and incident.inc_time.strftime('%H:%M'),
+        'type': incident.get_inc_type_display(),
+        'homicide': incident.is_homicide,
+        'address': incident.address,
+        'city': incident.city,
+        'state': incident.get_state_display(),
+        'formatted_address': incident.formatted_address,
+        'approximate_address': incident.is_approximate_address,
+        'latitude': incident.lat,
+        'longitude': incident.lng,
+        'victim_count': incident.victim_count,
+        'killed_count': incident.killed_count,
+        'suspect_count': incident.suspect_count,
+        'victims_unknown': incident.is_victims_unknown,
+        'suspects_unknown': incident.is_suspects_unknown,
+        'summary': incident.summary,
+        'victims': [victim_record(victim) for victim in incident.victims.all()],
+        'suspects': [suspect_record(suspect) for suspect in incident.suspects.all()],
+    }
+
+
+class _Line(object):
+    """
+    File-like object that hands back whatever csv.writer writes.
+    """
+    def write(self, value):
+        return value
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if value is None:
+        return ''
+    return value
+
+
+def _people(records):
+    return '; '.join(
+        ('%s, %s' % (record['last_name'], record['first_name'])).strip(', ')
+        for record in records)
+
+
+def write_csv(incidents):
+    """
+    One row per incident; victims and suspects are flattened
+    into "Last, First; Last, First" columns.
+    """
+    writer = csv.writer(_Line())
+    yield writer.writerow(CSV_COLUMNS)
+    for incident in incidents:
+        record = incident_record(incident)
+        record['victims'] = _people(record['victims'])
+        record['suspects'] = _people(record['suspects'])
+        yield writer.writerow([_encode(record[column]) for column in CSV_COLUMNS])
+
+
+def write_ndjson(incidents):
+    for incident in incidents:
+        yield simplejson.dumps(incident_record(incident)) + '\n'
+
+
+def write_geojson(incidents):
+    """
+    A FeatureCollection with one Point feature per incident;
+    incidents without coordinates get a null geometry.
+    """
+    yield '{"type": "FeatureCollection", "features": [\n'
+    separator = ''
+    for incident in incidents:
+        properties = incident_record(incident)
+        longitude, latitude = properties.pop('longitude'), properties.pop('latitude')
+        geometry = None
+        if latitude is not None:
+            geometry = {'type': 'Point', 'coordinates': [longitude, latitude]}
+        yield separator + simplejson.dumps({
+            'type': 'Feature',
+            'id': incident.id,
+            'geometry': geometry,
+            'properties': properties,
+        })
+        separator = ',\n'
+    yield '\n]}\n'
+
+
+WRITERS = {
+    'csv': write_csv,
+    'ndjson': write_ndjson,
+    'geojson': write_geojson,
+}
+
+
+def export(format, queryset=None, chunk_size=CHUNK_SIZE):
+    """
+    Returns a generator of the export of `queryset` in `format`.
+    """
+    return WRITERS[format](iter_incidents(queryset, chunk_size))
+
+
+def gzip_stream(chunks, level=6):
+    """
+    Gzips a stream of strings as it goes.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
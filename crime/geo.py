@@ -0,0 +1,115 @@
+"""
+Coordinate helpers: parsing, geohashes, distances and bounding boxes.
+"""
+import math
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9
+EARTH_RADIUS_METERS = 6371008.8
+METERS_PER_DEGREE = EARTH_RADIUS_METERS * math.pi / 180
+
+
+def parse_coordinates(latitude, longitude):
+    """
+    Turns the string Latitude/Longitude fields into floats.
+    Returns (None, None) when they're blank or out of range.
+    """
+    try:
+        lat, lng = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None, None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None, None
+    return lat, lng
+
+
+def geohash_encode(lat, lng, precision=GEOHASH_PRECISION):
+    """
+    Returns the geohash of a point. Nearby points share
+    a prefix, so a prefix names a grid cell.
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        value, bounds = (lng, lng_range) if even else (lat, lat_range)
+        mid = (bounds[0] + bounds[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            bounds[0] = mid
+        else:
+            bounds[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits, bit_count = 0, 0
+    return ''.join(chars)
+
+
+def geohash_cell_size(precision):
+    """
+    Returns the (height, width) in degrees of a geohash cell.
+    The bits alternate, longitude first.
+    """
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** (bits - bits // 2)
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Returns the great-circle distance between two points, in meters.
+    """
+    lat1, lng1, lat2, lng2 = [math.radians(value) for value in (lat1, lng1, lat2, lng2)]
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def cells_covering(lat, lng, radius):
+    """
+    Returns the geohash cells that together cover every point within
+    `radius` meters of a point: the point's cell and its neighbours,
+    at the finest precision whose cells are at least `radius` across.
+    """
+    height = radius / METERS_PER_DEGREE
+    width = height / max(math.cos(math.radians(lat)), 0.01)
+    precision = GEOHASH_PRECISION
+    while precision > 1:
+        cell_height, cell_width = geohash_cell_size(precision)
+        if cell_height >= height and cell_width >= width:
+            break
+        precision -= 1
+    cell_height, cell_width = geohash_cell_size(precision)
+    cells = set()
+    for lat_step in (-1, 0, 1):
+        for lng_step in (-1, 0, 1):
+            cell_lat = max(min(lat + lat_step * cell_height, 90.0), -90.0)
+            cell_lng = (lng + lng_step * cell_width + 180.0) % 360.0 - 180.0
+            cells.add(geohash_encode(cell_lat, cell_lng, precision))
+    return sorted(cells)
+
+
+def parse_bbox(value):
+    """
+    Parses a "west,south,east,north" string as sent by Leaflet's
+    map.getBounds().toBBoxString(). Returns None if it's malformed.
+    """
+    try:
+        west, south, east, north = [float(part) for part in value.split(',')]
+    except (AttributeError, ValueError):
+        return None
+    if south > north:
+        return None
+    return west, south, east, north
+
+
+def coordinate_columns(latitude, longitude):
+    """
+    Returns the numeric lat/lng and geohash values
+    for an incident's string coordinates.
+    """
+    lat, lng = parse_coordinates(latitude, longitude)
+    if lat is None:
+        return {'lat': None, 'lng': None, 'geohash': ''}
+    return {'lat': lat, 'lng': lng, 'geohash': geohash_encode(lat, lng)}
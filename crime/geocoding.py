@@ -0,0 +1,218 @@
+"""
+Batch geocoding for incident addresses.
+
+Incident.save() only ever reads GeocodeCache; unknown addresses are
+left there with a "Pending" status. geocode_pending() resolves them
+through the configured backend and fills in the incidents waiting on
+them, either from a queued job (see geocode_queued) or on a schedule
+with the geocode_pending command. The backend is set with
+CRIME_GEOCODER (a dotted path to a Geocoder subclass) so tests can
+use LocalGeocoder instead of Google.
+"""
+import datetime
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.utils.importlib import import_module
+from myproject.crime import heatmap, jobs, nearby
+from myproject.crime.caching import bump
+from myproject.crime.clustering import invalidate_point
+from myproject.crime.geo import coordinate_columns
+from myproject.crime.helpers import get_lat_lng, normalize_address
+from myproject.crime.models import GeocodeCache, Incident
+from myproject.crime.search import index_incident
+
+# Settings, with their defaults.
+GEOCODER = getattr(settings, 'CRIME_GEOCODER', 'myproject.crime.geocoding.GoogleGeocoder')
+GEOCODE_TTL = datetime.timedelta(days=getattr(settings, 'CRIME_GEOCODE_TTL_DAYS', 180))
+GEOCODE_NEGATIVE_TTL = datetime.timedelta(days=getattr(settings, 'CRIME_GEOCODE_NEGATIVE_TTL_DAYS', 7))
+GEOCODE_CACHE_SIZE = getattr(settings, 'CRIME_GEOCODE_CACHE_SIZE', 20000)
+GEOCODE_MAX_ATTEMPTS = getattr(settings, 'CRIME_GEOCODE_MAX_ATTEMPTS', 5)
+
+
+class GeocoderError(Exception):
+    """
+    A temporary failure; the address should be tried again later.
+    """
+    pass
+
+
+class Geocoder(object):
+    """
+    Backend interface. geocode() returns a (lat, lng, formatted_address)
+    tuple, returns None when the address can't be found, and raises
+    GeocoderError when the service couldn't be reached.
+    """
+    def geocode(self, location):
+        raise NotImplementedError
+
+
+class GoogleGeocoder(Geocoder):
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+
+    def geocode(self, location):
+        try:
+            return get_lat_lng(location, timeout=self.timeout)
+        except (IOError, ValueError, KeyError) as e:
+            raise GeocoderError(str(e))
+
+
+class LocalGeocoder(Geocoder):
+    """
+    Answers from a fixed table of normalized addresses. Used in tests
+    and for running imports without network access.
+    """
+    def __init__(self, results=None, default=None):
+        self.results = dict((normalize_address(location), result)
+            for location, result in (results or {}).items())
+        self.default = default
+        self.calls = []
+
+    def geocode(self, location):
+        self.calls.append(location)
+        return self.results.get(normalize_address(location), self.default)
+
+
+_geocoder = None
+
+
+def get_geocoder():
+    """
+    Returns an instance of the backend named by CRIME_GEOCODER.
+    """
+    global _geocoder
+    if _geocoder is None:
+        module, name = GEOCODER.rsplit('.', 1)
+        _geocoder = getattr(import_module(module), name)()
+    return _geocoder
+
+
+def set_geocoder(geocoder):
+    """
+    Replaces the backend, e.g. with a LocalGeocoder in tests.
+    """
+    global _geocoder
+    _geocoder = geocoder
+
+
+def geocode_many(locations, geocoder=None, workers=4):
+    """
+    Geocodes a list of locations concurrently. Returns a dictionary
+    of location -> result, where result is a tuple, None (not found)
+    or a GeocoderError instance.
+    """
+    geocoder = geocoder or get_geocoder()
+
+    def _geocode(location):
+        try:
+            return location, geocoder.geocode(location)
+        except GeocoderError as e:
+            return location, e
+
+    locations = list(locations)
+    if workers <= 1 or len(locations) <= 1:
+        return dict(map(_geocode, locations))
+    pool = ThreadPool(min(workers, len(locations)))
+    try:
+        return dict(pool.map(_geocode, locations))
+    finally:
+        pool.close()
+
+
+def store_result(entry, result):
+    """
+    Saves a geocoder result on a cache entry. Found and not-found
+    results get different lifetimes; errors leave it pending. An
+    entry that keeps failing is given up on as not found, unless it
+    has coordinates from before it expired: those are kept, and
+    retried after the not-found lifetime.
+    """
+    now = datetime.datetime.now()
+    entry.attempts += 1
+    if isinstance(result, GeocoderError):
+        if entry.attempts >= GEOCODE_MAX_ATTEMPTS:
+            if entry.latitude is not None and entry.longitude is not None:
+                entry.status = 'OK'
+                entry.attempts = 0
+            else:
+                entry.status = 'NF'
+            entry.expires = now + GEOCODE_NEGATIVE_TTL
+    elif result:
+        entry.status = 'OK'
+        entry.latitude, entry.longitude = float(result[0]), float(result[1])
+        entry.formatted_address = result[2][:255]
+        entry.attempts = 0
+        entry.expires = now + GEOCODE_TTL
+    else:
+        entry.status = 'NF'
+        entry.attempts = 0
+        entry.expires = now + GEOCODE_NEGATIVE_TTL
+    entry.save()
+
+
+def fill_incidents(entries):
+    """
+    Copies found coordinates onto incidents that were saved
+    without them. Uses update() so the save hooks don't run again.
+    """
+    found = dict((entry.address, entry) for entry in entries if entry.status == 'OK')
+    if not found:
+        return 0
+    filled = 0
+    waiting = Incident.objects.filter(latitude='', longitude='').values_list(
+        'id', 'address', 'city', 'state', 'inc_date')
+    for id, address, city, state, inc_date in waiting:
+        location = '+'.join(filter(None, (address, city, state)))
+        entry = found.get(normalize_address(location))
+        if entry:
+            latitude, longitude = str(entry.latitude), str(entry.longitude)
+            filled += Incident.objects.filter(pk=id).update(
+                latitude=latitude,
+                longitude=longitude,
+                formatted_address=entry.formatted_address,
+                **coordinate_columns(latitude, longitude))
+            invalidate_point(entry.latitude, entry.longitude)
+            index_incident(id)
+            bump('incident:%s' % id, *nearby.neighbour_scopes(entry.latitude, entry.longitude, inc_date, id))
+    if filled:
+        # These incidents may be older than what the cached grids include.
+        heatmap.invalidate_all()
+    return filled
+
+
+def geocode_pending(limit=100, geocoder=None, workers=4):
+    """
+    Resolves up to `limit` queued addresses and fills in the
+    incidents waiting on them. Returns the processed entries.
+    """
+    entries = list(GeocodeCache.objects.filter(status='PE').order_by('-last_used')[:limit])
+    results = geocode_many([entry.location for entry in entries], geocoder, workers)
+    for entry in entries:
+        store_result(entry, results[entry.location])
+    fill_incidents(entries)
+    return entries
+
+
+def geocode_queued(limit=100):
+    """
+    Job run after saves that left an address pending. Queues itself
+    again while a full batch came back, so a backlog drains in steps.
+    """
+    entries = geocode_pending(limit)
+    if len(entries) >= limit:
+        jobs.enqueue('myproject.crime.geocoding.geocode_queued', limit, key='geocode', delay=1)
+    return len(entries)
+
+
+def evict(max_size=None):
+    """
+    Drops expired negative results, then the least recently
+    used entries beyond the cache size limit.
+    """
+    now = datetime.datetime.now()
+    GeocodeCache.objects.filter(status='NF', expires__lt=now).delete()
+    max_size = max_size or GEOCODE_CACHE_SIZE
+    overflow = GeocodeCache.objects.count() - max_size
+    if overflow > 0:
+        stale = GeocodeCache.objects.exclude(status='PE').order_by('last_used').values_list('id', flat=True)[:overflow]
+        GeocodeCache.objects.filter(id__in=list(stale)).delete()
@@ -0,0 +1,229 @@
+"""
+Kernel density heatmaps of incidents for the map page.
+
+The map area (HEATMAP_BOUNDS) is divided into square cells a given
+number of meters wide. Incidents are counted per cell, and the counts
+are smoothed with a Gaussian kernel of the given bandwidth. The kernel
+is separable, so this takes two passes of 1-D convolution. The result
+is the density in incidents per square kilometer. All of this is
+NumPy array arithmetic; the only per-request cost in Python is one
+query for the coordinates.
+
+Grids are cached per filter, with the highest incident id they
+include and the ids they counted in the ID_MARGIN ids below it. A
+request whose grid is cached reads the incidents from that margin up,
+adds the smoothed counts of the ones not counted yet (the smoothing is
+linear), and stores the grid again. The margin catches incidents whose
+id was handed out before the grid was read but that were committed
+after it, by a longer transaction. Edits and deletes can move or
+remove points that are already counted, so they drop every grid
+(invalidate_all()).
+
+NumPy is optional: without it, available() is False and the
+heatmap endpoints answer 501.
+"""
+import hashlib
+import math
+from django.conf import settings
+from django.core.cache import cache
+from myproject.crime.caching import VERSION_TIMEOUT, bump, get_versions
+from myproject.crime.geo import METERS_PER_DEGREE
+from myproject.crime.helpers import get_since_date
+from myproject.crime.instrumentation import cache_event
+from myproject.crime.models import Incident
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# (west, south, east, north) of the area the heatmap covers.
+HEATMAP_BOUNDS = getattr(settings, 'CRIME_HEATMAP_BOUNDS', (-75.64, 39.68, -75.44, 39.80))
+CELL_SIZE = 100  # meters
+BANDWIDTH = 200  # meters
+MIN_CELL_SIZE, MAX_CELL_SIZE = 50, 1000
+# Grids are cached whole, so they must fit memcached's 1 MB items: at
+# 50 m cells the default area is about 370 KB of float32.
+MAX_GRID_BYTES = 900 * 1024
+MAX_BANDWIDTH = 5000
+# Cells per side of the tiles the grid is served in.
+TILE_CELLS = 64
+# The kernel is cut off this many bandwidths from its center.
+KERNEL_EXTENT = 3
+# Ids below a cached grid's highest one that are read again.
+ID_MARGIN = 500
+
+
+def available():
+    return numpy is not None
+
+
+class Grid(object):
+    """
+    The geometry of a heatmap grid: rows run north to south and
+    columns west to east, in cells `cell_size` meters wide.
+    """
+    def __init__(self, cell_size=CELL_SIZE, bounds=HEATMAP_BOUNDS):
+        self.cell_size = cell_size
+        self.bounds = bounds
+        west, south, east, north = bounds
+        # Meters per degree of longitude at the middle of the area.
+        self.lng_scale = METERS_PER_DEGREE * math.cos(math.radians((south + north) / 2))
+        self.rows = int(math.ceil((north - south) * METERS_PER_DEGREE / cell_size))
+        self.cols = int(math.ceil((east - west) * self.lng_scale / cell_size))
+
+    def cell_indexes(self, lats, lngs):
+        """
+        Returns the flat cell index of each point, dropping
+        points outside the grid.
+        """
+        west, south, east, north = self.bounds
+        rows = numpy.floor((north - lats) * METERS_PER_DEGREE / self.cell_size).astype(numpy.int64)
+        cols = numpy.floor((lngs - west) * self.lng_scale / self.cell_size).astype(numpy.int64)
+        inside = (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+        return rows[inside] * self.cols + cols[inside]
+
+    @property
+    def nbytes(self):
+        # Size of the cached float32 density array.
+        return self.rows * self.cols * 4
+
+    def tile_counts(self):
+        return (int(math.ceil(self.rows / float(TILE_CELLS))),
+                int(math.ceil(self.cols / float(TILE_CELLS))))
+
+    def tile_bounds(self, row, col):
+        """
+        Returns the (west, south, east, north) of a tile's cells.
+        """
+        west, south, east, north = self.bounds
+        first_row, first_col = row * TILE_CELLS, col * TILE_CELLS
+        last_row = min(first_row + TILE_CELLS, self.rows)
+        last_col = min(first_col + TILE_CELLS, self.cols)
+        meters = float(self.cell_size)
+        return (west + first_col * meters / self.lng_scale, north - last_row * meters / METERS_PER_DEGREE,
+                west + last_col * meters / self.lng_scale, north - first_row * meters / METERS_PER_DEGREE)
+
+
+def _kernel(cell_size, bandwidth):
+    sigma = float(bandwidth) / cell_size
+    radius = int(math.ceil(KERNEL_EXTENT * sigma))
+    offsets = numpy.arange(-radius, radius + 1, dtype=numpy.float64)
+    kernel = numpy.exp(-0.5 * (offsets / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def _convolve(counts, kernel):
+    """
+    Smooths a 2-D array with a 1-D kernel along both axes,
+    one shifted slice per kernel weight.
+    """
+    radius = len(kernel) // 2
+    for axis in (0, 1):
+        padding = [(0, 0), (0, 0)]
+        padding[axis] = (radius, radius)
+        padded = numpy.pad(counts, padding, mode='constant')
+        smoothed = numpy.zeros_like(counts)
+        size = counts.shape[axis]
+        for offset, weight in enumerate(kernel):
+            if axis == 0:
+                smoothed += weight * padded[offset:offset + size, :]
+            else:
+                smoothed += weight * padded[:, offset:offset + size]
+        counts = smoothed
+    return counts
+
+
+def density(grid, lats, lngs, bandwidth=BANDWIDTH):
+    """
+    Returns the density grid, in incidents per square kilometer,
+    of the given points.
+    """
+    counts = numpy.bincount(grid.cell_indexes(lats, lngs), minlength=grid.rows * grid.cols)
+    counts = counts.astype(numpy.float64).reshape(grid.rows, grid.cols)
+    cell_km2 = (grid.cell_size / 1000.0) ** 2
+    return _convolve(counts, _kernel(grid.cell_size, bandwidth)) / cell_km2
+
+
+class Filters(object):
+    """
+    Which incidents a heatmap counts. inc_types is a list of
+    incident type codes, is_homicide True, False or None.
+    """
+    def __init__(self, time_frame='all', start=None, end=None, inc_types=None, is_homicide=None,
+            cell_size=CELL_SIZE, bandwidth=BANDWIDTH):
+        self.time_frame = time_frame
+        self.start = start
+        self.end = end
+        self.inc_types = sorted(inc_types or [])
+        self.is_homicide = is_homicide
+        self.cell_size = cell_size
+        self.bandwidth = bandwidth
+
+    def key(self):
+        # Relative time frames move daily, so the key has their start date.
+        return hashlib.md5(repr((self.time_frame, get_since_date(self.time_frame), self.start, self.end,
+            self.inc_types, self.is_homicide, self.cell_size, self.bandwidth, HEATMAP_BOUNDS))).hexdigest()
+
+    def incidents(self):
+        incidents = Incident.objects.in_time_frame(self.time_frame).between(self.start, self.end).filter(
+            lat__isnull=False, lng__isnull=False)
+        if self.inc_types:
+            incidents = incidents.filter(inc_type__in=self.inc_types)
+        if self.is_homicide is not None:
+            incidents = incidents.filter(is_homicide=self.is_homicide)
+        return incidents
+
+
+def _points(rows):
+    lats = numpy.array([lat for id, lat, lng in rows], dtype=numpy.float64)
+    lngs = numpy.array([lng for id, lat, lng in rows], dtype=numpy.float64)
+    return lats, lngs
+
+
+def _recent(ids, max_id):
+    return sorted(id for id in ids if id > max_id - ID_MARGIN)
+
+
+def get_density(filters):
+    """
+    Returns (Grid, density array, incidents counted) for the filters,
+    from the cache when possible, adding incidents created since the
+    cached grid was computed.
+    """
+    grid = Grid(filters.cell_size)
+    key = 'crime:heatmap:%s:%s' % (get_versions(['heatmap'])[0], filters.key())
+    cached = cache.get(key)
+    cache_event('heatmap', cached is not None)
+    if cached is None:
+        rows = list(filters.incidents().values_list('id', 'lat', 'lng'))
+        max_id = max([id for id, lat, lng in rows] or [0])
+        values = density(grid, *_points(rows), bandwidth=filters.bandwidth).astype(numpy.float32)
+        cached = {'max_id': max_id, 'recent': _recent([row[0] for row in rows], max_id),
+            'count': len(rows), 'density': values}
+        cache.set(key, cached, VERSION_TIMEOUT)
+    else:
+        counted = set(cached['recent'])
+        rows = [row for row in filters.incidents().filter(id__gt=cached['max_id'] - ID_MARGIN).values_list(
+            'id', 'lat', 'lng') if row[0] not in counted]
+        if rows:
+            values = density(grid, *_points(rows), bandwidth=filters.bandwidth).astype(numpy.float32)
+            cached['density'] = cached['density'] + values
+            cached['max_id'] = max([cached['max_id']] + [id for id, lat, lng in rows])
+            cached['recent'] = _recent(list(counted) + [row[0] for row in rows], cached['max_id'])
+            cached['count'] += len(rows)
+            cache.set(key, cached, VERSION_TIMEOUT)
+    return grid, cached['density'], cached['count']
+
+
+def tile(grid, values, row, col):
+    """
+    Returns one tile's cells of a density array.
+    """
+    return values[row * TILE_CELLS:(row + 1) * TILE_CELLS, col * TILE_CELLS:(col + 1) * TILE_CELLS]
+
+
+def invalidate_all():
+    """
+    Drops every cached grid, after edits or deletes.
+    """
+    bump('heatmap')
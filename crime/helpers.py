@@ -1,13 +1,21 @@
+import datetime
+import re
 import urllib
 import urllib2
+import unicodedata
 import simplejson
-from django.utils.encoding import smart_str
+from django.utils.encoding import force_unicode, smart_str
 
 
-def get_lat_lng(location):
+def get_lat_lng(location, timeout=10):
+    """
+    Asks the Google geocoder for a location. Returns a
+    (lat, lng, formatted_address) tuple, or None if nothing was found.
+    Network failures raise IOError.
+    """
     location = urllib.quote_plus(smart_str(location))
     url = 'http://maps.googleapis.com/maps/api/geocode/json?address=%s&sensor=false' % location
-    response = urllib2.urlopen(url).read()
+    response = urllib2.urlopen(url, timeout=timeout).read()
     result = simplejson.loads(response)
     if result['status'] == 'OK':
         lat = str(result['results'][0]['geometry']['location']['lat'])
@@ -15,4 +23,132 @@ def get_lat_lng(location):
         formatted_address = str(result['results'][0]['formatted_address'])
         return lat, lng, formatted_address[:-5]
     else:
+        return None
+
+
+STREET_ABBREVIATIONS = {
+    'avenue': 'ave',
+    'boulevard': 'blvd',
+    'court': 'ct',
+    'drive': 'dr',
+    'east': 'e',
+    'lane': 'ln',
+    'north': 'n',
+    'place': 'pl',
+    'road': 'rd',
+    'south': 's',
+    'street': 'st',
+    'west': 'w',
+}
+
+
+def normalize_address(location):
+    """
+    Reduces an address to a canonical form, so that
+    "100 block of N. Market Street+Wilmington+DE" and
+    "100 Block N Market St, Wilmington, DE" share a cache entry.
+    """
+    location = smart_str(location).lower().replace('+', ' ')
+    words = re.sub(r'[^a-z0-9# ]', ' ', location).split()
+    words = [STREET_ABBREVIATIONS.get(word, word) for word in words if word not in ('of', 'the')]
+    return ' '.join(words)
+
+
+SOUNDEX_CODES = dict((letter, str(code)) for code, letters in enumerate(
+    ('AEIOUYHW', 'BFPV', 'CGJKQSXZ', 'DT', 'L', 'MN', 'R')) for letter in letters)
+
+
+def normalize_name(name):
+    """
+    Reduces a name to its uppercase ASCII letters,
+    so "O'Neal" and "Oneal" compare equal.
+    """
+    name = unicodedata.normalize('NFKD', force_unicode(name or '')).encode('ascii', 'ignore')
+    return re.sub(r'[^A-Z]', '', name.upper())
+
+
+def soundex(name):
+    """
+    American Soundex: the first letter and three digits for the
+    consonant sounds that follow, so "Robert" and "Rupert" are
+    both R163. Returns '' for a name without letters.
+    """
+    name = normalize_name(name)
+    if not name:
         return ''
+    digits, last = [], SOUNDEX_CODES[name[0]]
+    for letter in name[1:]:
+        code = SOUNDEX_CODES[letter]
+        if code != '0' and code != last:
+            digits.append(code)
+        # H and W don't separate two letters with the same code; vowels do.
+        if letter not in 'HW':
+            last = code
+    return (name[0] + ''.join(digits) + '000')[:4]
+
+
+def person_match_key(first_name, last_name, sex):
+    """
+    The blocking key person matching compares people within: the
+    Soundex of the last name, the first initial and the sex, e.g.
+    "W425JM" for a man named John Wilson or Willson.
+    """
+    code = soundex(last_name)
+    if not code:
+        return ''
+    return '%s%s%s' % (code, normalize_name(first_name)[:1], sex or '')
+
+
+# Values accepted by the "time_frame" GET variable on the listing pages.
+TIME_FRAMES = ('all', 'week', 'one_month', 'six_months', 'year')
+
+
+def monthdelta(date, delta):
+    m, y = (date.month + delta) % 12, date.year + ((date.month) + delta - 1) // 12
+    if not m:
+        m = 12
+    d = min(date.day, [31, 29 if y % 4 == 0 and not y % 400 == 0 else 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31][m - 1])
+    return date.replace(day=d, month=m, year=y)
+
+
+def parse_date(value):
+    """
+    Parses a YYYY-MM-DD date. Returns None for an empty
+    value and raises ValueError for anything else.
+    """
+    if value in (None, ''):
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except TypeError:
+        raise ValueError("%r is not a YYYY-MM-DD date" % (value,))
+
+
+def get_since_date(time_frame, today=None):
+    """
+    Returns the first date covered by a time frame,
+    or None if the time frame covers the whole archive.
+    """
+    if today is None:
+        today = datetime.date.today()
+    if time_frame == 'week':
+        return today - datetime.timedelta(weeks=1)
+    elif time_frame == 'one_month':
+        return monthdelta(today, -1)
+    elif time_frame == 'six_months':
+        return monthdelta(today, -6)
+    elif time_frame == 'year':
+        return today.replace(year=today.year - 1)
+    return None
+
+
+def time_frames_covering(date, today=None):
+    """
+    Returns the time frames whose listings include the given date.
+    """
+    covering = []
+    for time_frame in TIME_FRAMES:
+        since_date = get_since_date(time_frame, today)
+        if since_date is None or since_date <= date:
+            covering.append(time_frame)
+    return covering
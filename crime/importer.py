@@ -0,0 +1,405 @@
+"""
+Bulk import of historical incidents from CSV or NDJSON.
+
+Reads the same layout export.py writes: choice fields may be given as
+codes ("SH") or labels ("Shooting"), and people either nested (NDJSON)
+or as "Last, First; Last, First" (CSV). Records are handled in chunks:
+each chunk's unknown addresses are geocoded once, concurrently, then
+its incidents, people and links are written with bulk_create in one
+transaction, along with their counters and search terms. Progress is
+saved to a checkpoint file after every chunk, so an interrupted import
+picks up where it stopped; the stats and caches are brought up to date
+once at the end.
+
+Like loaddata, the importer assigns primary keys itself and resets the
+database sequences at the end, so it must not run alongside admin edits.
+"""
+import csv
+import datetime
+import os
+import time
+import simplejson
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.template.defaultfilters import slugify
+from myproject.crime import analytics, caching, clustering, counters, nearby, search, stats
+from myproject.crime.geo import coordinate_columns
+from myproject.crime.geocoding import geocode_many, get_geocoder, store_result
+from myproject.crime.helpers import TIME_FRAMES, normalize_address, parse_date, person_match_key
+from myproject.crime.models import (Incident, Suspect, Victim, GeocodeCache,
+    INC_TYPE_CHOICES, SEX_CHOICES, STATE_CHOICES, WOUND_CHOICES)
+from myproject.crime.pagination import count_scope
+
+CHUNK_SIZE = 500
+TRUE_VALUES = ('1', 'true', 't', 'yes', 'y')
+
+
+class RecordError(ValueError):
+    """
+    A record that can't be imported; the message says why.
+    """
+    pass
+
+
+def read_csv(path):
+    """
+    Yields (line number, record) pairs from a CSV file with a header row.
+    """
+    with open(path, 'rb') as f:
+        for line, row in enumerate(csv.DictReader(f), 2):
+            yield line, dict((key, value.decode('utf-8')) for key, value in row.items() if key)
+
+
+def read_ndjson(path):
+    with open(path, 'rb') as f:
+        for line, text in enumerate(f, 1):
+            if text.strip():
+                yield line, simplejson.loads(text)
+
+
+def read_records(path):
+    if path.endswith('.csv'):
+        return read_csv(path)
+    return read_ndjson(path)
+
+
+def _choice(value, choices, field, default=None):
+    """
+    Accepts either the code or the label of a choice.
+    """
+    if value in (None, ''):
+        if default is not None:
+            return default
+        raise RecordError("%s is required" % field)
+    value = unicode(value).strip().lower()
+    for code, label in choices:
+        if value in (code.lower(), label.lower()):
+            return code
+    raise RecordError("%s %r is not one of %s" % (field, value, ', '.join(code for code, label in choices)))
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    return unicode(value or '').strip().lower() in TRUE_VALUES
+
+
+def _int(value, field):
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RecordError("%s %r is not a number" % (field, value))
+
+
+def _date(value, field, required=False):
+    if value in (None, ''):
+        if required:
+            raise RecordError("%s is required" % field)
+        return None
+    try:
+        return parse_date(value[:10])
+    except (TypeError, ValueError):
+        raise RecordError("%s %r is not a YYYY-MM-DD date" % (field, value))
+
+
+def _time(value):
+    if value in (None, ''):
+        return None
+    for format in ('%H:%M:%S', '%H:%M'):
+        try:
+            return datetime.datetime.strptime(value, format).time()
+        except ValueError:
+            pass
+    raise RecordError("time %r is not HH:MM" % value)
+
+
+def _people(value):
+    """
+    Turns a CSV "Last, First; Last, First" column into records.
+    """
+    if isinstance(value, list):
+        return value
+    people = []
+    for name in (value or '').split(';'):
+        if name.strip():
+            last_name, _, first_name = name.partition(',')
+            people.append({'last_name': last_name.strip(), 'first_name': first_name.strip()})
+    return people
+
+
+def person_key(first_name, last_name):
+    """
+    The slug people are de-duplicated by, also used as vic_slug/suspect_slug.
+    """
+    return slugify(u'%s %s' % (last_name, first_name))[:50]
+
+
+def parse_record(record):
+    """
+    Validates a record and returns (incident, victims, suspects),
+    where incident is a dictionary of Incident field values.
+    """
+    headline = (record.get('headline') or '').strip()
+    if not headline:
+        raise RecordError("headline is required")
+    incident = {
+        'headline': headline[:255],
+        'inc_slug': (record.get('slug') or slugify(headline))[:50],
+        'inc_date': _date(record.get('date'), 'date', required=True),
+        'inc_time': _time(record.get('time')),
+        'inc_type': _choice(record.get('type'), INC_TYPE_CHOICES, 'type'),
+        'is_homicide': _bool(record.get('homicide')),
+        'address': (record.get('address') or '')[:255],
+        'city': (record.get('city') or 'Wilmington')[:255],
+        'state': _choice(record.get('state'), STATE_CHOICES, 'state', default='DE'),
+        'formatted_address': (record.get('formatted_address') or '')[:255],
+        'is_approximate_address': _bool(record.get('approximate_address')),
+        'latitude': unicode(record.get('latitude') or ''),
+        'longitude': unicode(record.get('longitude') or ''),
+        'victim_count': _int(record.get('victim_count'), 'victim_count'),
+        'killed_count': _int(record.get('killed_count'), 'killed_count') or 0,
+        'suspect_count': _int(record.get('suspect_count'), 'suspect_count') or 0,
+        'is_victims_unknown': _bool(record.get('victims_unknown')),
+        'is_suspects_unknown': _bool(record.get('suspects_unknown')),
+        'summary': record.get('summary') or '',
+    }
+    victims = []
+    for person in _people(record.get('victims')):
+        victims.append({
+            'first_name': (person.get('first_name') or '')[:100],
+            'last_name': (person.get('last_name') or '')[:100],
+            'age': _int(person.get('age'), 'victim age'),
+            'sex': _choice(person.get('sex'), SEX_CHOICES, 'victim sex', default='U'),
+            'is_killed': _bool(person.get('killed')),
+            'wound_location': _choice(person.get('wound_location'), WOUND_CHOICES, 'wound_location', default='NS'),
+            'is_unidentified': _bool(person.get('unidentified')),
+        })
+    suspects = []
+    for person in _people(record.get('suspects')):
+        suspects.append({
+            'first_name': (person.get('first_name') or '')[:100],
+            'last_name': (person.get('last_name') or '')[:100],
+            'age': _int(person.get('age'), 'suspect age'),
+            'sex': _choice(person.get('sex'), SEX_CHOICES, 'suspect sex', default='U'),
+            'arrest_date': _date(person.get('arrest_date'), 'arrest_date'),
+            'is_unidentified': _bool(person.get('unidentified')),
+        })
+    return incident, victims, suspects
+
+
+class ImportReport(object):
+    def __init__(self):
+        self.started = time.time()
+        self.read = 0
+        self.imported = 0
+        self.skipped = 0
+        self.geocoded = 0
+        self.errors = []
+        self.incident_ids = []
+
+    def rate(self):
+        elapsed = time.time() - self.started
+        return self.read / elapsed if elapsed else 0.0
+
+    def __unicode__(self):
+        return u'%d read, %d imported, %d already present, %d errors, %d addresses geocoded (%.0f records/s)' % (
+            self.read, self.imported, self.skipped, len(self.errors), self.geocoded, self.rate())
+
+
+class IncidentImporter(object):
+    """
+    Imports records in chunks. `progress` is called with the
+    ImportReport after every chunk.
+    """
+    def __init__(self, geocoder=None, chunk_size=CHUNK_SIZE, workers=8,
+            checkpoint=None, progress=None):
+        self.geocoder = geocoder or get_geocoder()
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.report = ImportReport()
+        self.resumed = False
+        self._people = {Victim: {}, Suspect: {}}
+
+    def _resume_from(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                return int(f.read().strip() or 0)
+        return 0
+
+    def _save_checkpoint(self, line):
+        if self.checkpoint:
+            temp = self.checkpoint + '.tmp'
+            with open(temp, 'w') as f:
+                f.write(str(line))
+            os.rename(temp, self.checkpoint)
+
+    def run(self, records):
+        resume_from = self._resume_from()
+        self.resumed = resume_from > 0
+        chunk = []
+        for line, record in records:
+            if line <= resume_from:
+                continue
+            self.report.read += 1
+            try:
+                chunk.append((line,) + parse_record(record))
+            except RecordError as e:
+                self.report.errors.append((line, unicode(e)))
+            if len(chunk) >= self.chunk_size:
+                self._import_chunk(chunk, line)
+                chunk = []
+        if chunk:
+            self._import_chunk(chunk, chunk[-1][0])
+        self._finish()
+        return self.report
+
+    def _geocode(self, incidents):
+        """
+        Fills in coordinates for incidents without them: from the
+        cache where possible, the rest with one concurrent batch.
+        """
+        waiting = {}
+        for incident in incidents:
+            if not incident['latitude'] and not incident['longitude']:
+                location = '+'.join(filter(None, (incident['address'], incident['city'], incident['state'])))
+                waiting.setdefault(normalize_address(location), (location, []))[1].append(incident)
+        if not waiting:
+            return
+        entries = dict((entry.address, entry) for entry in
+            GeocodeCache.objects.filter(address__in=waiting.keys()))
+        now = datetime.datetime.now()
+        misses = [address for address in waiting if address not in entries or
+            entries[address].status == 'PE' or (entries[address].expires and entries[address].expires < now)]
+        results = geocode_many([waiting[address][0] for address in misses], self.geocoder, self.workers)
+        for address in misses:
+            location = waiting[address][0]
+            entry = entries.get(address) or GeocodeCache(
+                address=address, location=location[:255], status='PE', last_used=now)
+            store_result(entry, results[location])
+            entries[address] = entry
+            self.report.geocoded += 1
+        for address, (location, incidents) in waiting.items():
+            entry = entries[address]
+            if entry.status == 'OK':
+                for incident in incidents:
+                    incident['latitude'], incident['longitude'] = str(entry.latitude), str(entry.longitude)
+                    incident['formatted_address'] = incident['formatted_address'] or entry.formatted_address
+
+    def _person(self, model, fields, new_people):
+        """
+        Returns the id of an existing person with the same name
+        and slug, or of a new one added to new_people.
+        """
+        slug_field = 'vic_slug' if model is Victim else 'suspect_slug'
+        key = person_key(fields['first_name'], fields['last_name'])
+        known = self._people[model]
+        if key not in known:
+            existing = model.objects.filter(**{slug_field: key}).values_list('id', flat=True)[:1]
+            if existing:
+                known[key] = existing[0]
+            else:
+                fields[slug_field] = key
+                # bulk_create skips save(), which sets the key otherwise.
+                fields['match_key'] = person_match_key(fields['first_name'], fields['last_name'], fields.get('sex'))
+                person = model(**fields)
+                new_people.append(person)
+                known[key] = person
+        return known[key]
+
+    def _import_chunk(self, chunk, last_line):
+        self._geocode([incident for line, incident, victims, suspects in chunk])
+
+        # Skip incidents imported before (same date and slug).
+        keys = set(Incident.objects.filter(
+            inc_date__in=set(incident['inc_date'] for line, incident, v, s in chunk),
+            inc_slug__in=set(incident['inc_slug'] for line, incident, v, s in chunk)
+        ).values_list('inc_date', 'inc_slug'))
+
+        with transaction.commit_on_success():
+            next_ids = {}
+            for model in (Incident, Victim, Suspect):
+                next_ids[model] = (model.objects.aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+
+            incidents, links, new_people = [], {Victim: [], Suspect: []}, {Victim: [], Suspect: []}
+            for line, fields, victims, suspects in chunk:
+                key = (fields['inc_date'], fields['inc_slug'])
+                if key in keys:
+                    self.report.skipped += 1
+                    continue
+                keys.add(key)
+                fields.update(coordinate_columns(fields['latitude'], fields['longitude']))
+                incident = Incident(id=next_ids[Incident], **fields)
+                next_ids[Incident] += 1
+                incidents.append(incident)
+                for model, people in ((Victim, victims), (Suspect, suspects)):
+                    for person_fields in people:
+                        person = self._person(model, person_fields, new_people[model])
+                        if isinstance(person, (int, long)):
+                            person_id = person
+                        else:
+                            if person.id is None:
+                                person.id = next_ids[model]
+                                next_ids[model] += 1
+                            person_id = person.id
+                        links[model].append((incident.id, person_id))
+
+            Incident.objects.bulk_create(incidents)
+            for model in (Victim, Suspect):
+                model.objects.bulk_create(new_people[model])
+            Incident.victims.through.objects.bulk_create([
+                Incident.victims.through(incident_id=incident_id, victim_id=victim_id)
+                for incident_id, victim_id in set(links[Victim])])
+            Incident.suspects.through.objects.bulk_create([
+                Incident.suspects.through(incident_id=incident_id, suspect_id=suspect_id)
+                for incident_id, suspect_id in set(links[Suspect])])
+
+            # bulk_create skips the model signals. Counters come from
+            # the linked people, not the source file.
+            ids = [incident.id for incident in incidents]
+            for start in range(0, len(ids), counters.BATCH_SIZE):
+                counters.refresh_counters(ids[start:start + counters.BATCH_SIZE])
+            search.index_incidents(ids)
+
+        neighbours = []
+        for incident in incidents:
+            neighbours.extend(nearby.neighbour_scopes(incident.lat, incident.lng, incident.inc_date, incident.id))
+        if neighbours:
+            caching.bump(*neighbours)
+
+        # People created in this chunk are plain ids from here on.
+        for model in (Victim, Suspect):
+            for key, person in self._people[model].items():
+                if not isinstance(person, (int, long)):
+                    self._people[model][key] = person.id
+
+        self.report.imported += len(incidents)
+        self.report.incident_ids.extend(incident.id for incident in incidents)
+        self._save_checkpoint(last_line)
+        if self.progress:
+            self.progress(self.report)
+
+    def _finish(self):
+        """
+        Brings the sequences and the tables and caches derived from
+        every incident up to date. A resumed import does this too,
+        for the chunks committed before it was interrupted.
+        """
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Incident, Victim, Suspect]):
+            cursor.execute(sql)
+        transaction.commit_unless_managed()
+        if not self.report.incident_ids and not self.resumed:
+            return
+        # After the chunks' counters: the stats count the "not identified" flags.
+        stats.rebuild_stats()
+        clustering.invalidate_all()
+        analytics.invalidate_all()
+        caching.bump('search', *[count_scope(model) for model in (Incident, Victim, Suspect)] +
+            [caching.frame_scope(listing, time_frame)
+                for listing in ('stats', 'incidents', 'victims', 'suspects')
+                for time_frame in TIME_FRAMES])
@@ -0,0 +1,258 @@
+"""
+Per-request timing and query instrumentation.
+
+InstrumentationMiddleware records, for each view, wall time, number of
+queries, time spent in the database and in template rendering, and
+the crime caches' hits and misses (see cache_event()). Everything is
+kept in memory per process: fixed-bucket histograms and a bounded
+window of recent durations per view, so memory doesn't grow with
+traffic. Requests slower than CRIME_SLOW_REQUEST_MS are logged with
+their queries grouped by fingerprint. /crime/metrics serves the
+numbers as JSON or Prometheus text to staff or holders of
+CRIME_METRICS_TOKEN.
+
+Query capture turns on Django's debug cursor for the length of the
+request only; the query list is emptied at the start of every request.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from django.db import connection
+from django.template.base import Template
+
+logger = logging.getLogger('myproject.crime.instrumentation')
+
+# Settings, with their defaults.
+SLOW_REQUEST_MS = getattr(settings, 'CRIME_SLOW_REQUEST_MS', 1000)
+METRICS_TOKEN = getattr(settings, 'CRIME_METRICS_TOKEN', None)
+RECENT_WINDOW = getattr(settings, 'CRIME_METRICS_WINDOW', 500)
+CAPTURE_QUERIES = getattr(settings, 'CRIME_METRICS_CAPTURE_QUERIES', True)
+
+# Upper bounds, in milliseconds, of the histogram buckets.
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram(object):
+    """
+    Fixed buckets for Prometheus, plus the most recent values
+    for percentiles.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RECENT_WINDOW)
+
+    def add(self, value):
+        index = 0
+        while index < len(BUCKETS) and value > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, fraction):
+        values = sorted(self.recent)
+        if not values:
+            return None
+        return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class ViewStats(object):
+    def __init__(self):
+        self.duration = Histogram()
+        self.queries = 0
+        self.db_ms = 0.0
+        self.template_ms = 0.0
+        self.errors = 0
+        self.slow = 0
+
+    def as_dict(self):
+        duration = self.duration
+        return {
+            'requests': duration.count,
+            'errors': self.errors,
+            'slow': self.slow,
+            'mean_ms': duration.count and round(duration.sum / duration.count, 2),
+            'p50_ms': duration.percentile(0.5),
+            'p95_ms': duration.percentile(0.95),
+            'p99_ms': duration.percentile(0.99),
+            'queries_per_request': duration.count and round(float(self.queries) / duration.count, 2),
+            'db_ms_per_request': duration.count and round(self.db_ms / duration.count, 2),
+            'template_ms_per_request': duration.count and round(self.template_ms / duration.count, 2),
+        }
+
+
+_lock = threading.Lock()
+_views = {}
+_cache_events = {}
+_started = time.time()
+_local = threading.local()
+
+
+def cache_event(name, hit):
+    """
+    Counts a hit or miss of one of the crime caches ("page", "tile",
+    ...), globally and for the current request.
+    """
+    key = (name, 'hit' if hit else 'miss')
+    with _lock:
+        _cache_events[key] = _cache_events.get(key, 0) + 1
+    events = getattr(_local, 'cache_events', None)
+    if events is not None:
+        events[key] = events.get(key, 0) + 1
+
+
+_NUMBER = re.compile(r'\b\d+(\.\d+)?\b')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_IN_LIST = re.compile(r'\bIN \((?:\?, )*\?\)', re.IGNORECASE)
+
+
+def fingerprint(sql):
+    """
+    Returns a query with its literals replaced, so repeats of the
+    same query with different values group together.
+    """
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    return _IN_LIST.sub('IN (...)', sql)
+
+
+def _summarize_queries(queries):
+    groups = {}
+    for query in queries:
+        group = groups.setdefault(fingerprint(query['sql']), [0, 0.0])
+        group[0] += 1
+        group[1] += float(query['time']) * 1000
+    return sorted(groups.items(), key=lambda item: -item[1][1])
+
+
+def _timed(render):
+    """
+    Wraps Template._render to add up rendering time per request.
+    Nested renders ({% extends %}, {% include %}) count only once.
+    """
+    def timed_render(self, context):
+        if getattr(_local, 'template_ms', None) is None or _local.render_depth:
+            return render(self, context)
+        _local.render_depth += 1
+        start = time.time()
+        try:
+            return render(self, context)
+        finally:
+            _local.render_depth -= 1
+            _local.template_ms += (time.time() - start) * 1000
+    timed_render.crime_timed = True
+    return timed_render
+
+
+class InstrumentationMiddleware(object):
+    def __init__(self):
+        if not getattr(Template._render, 'crime_timed', False):
+            Template._render = _timed(Template._render)
+
+    def process_request(self, request):
+        _local.start = time.time()
+        _local.view = None
+        _local.template_ms = 0.0
+        _local.render_depth = 0
+        _local.cache_events = {}
+        _local.old_debug_cursor = connection.use_debug_cursor
+        _local.first_query = len(connection.queries)
+        if CAPTURE_QUERIES:
+            connection.use_debug_cursor = True
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _local.view = '%s.%s' % (view_func.__module__.rsplit('.', 1)[-1], view_func.__name__)
+
+    def process_response(self, request, response):
+        start = getattr(_local, 'start', None)
+        if start is None:
+            return response
+        duration = (time.time() - start) * 1000
+        queries = connection.queries[_local.first_query:]
+        connection.use_debug_cursor = _local.old_debug_cursor
+        view = _local.view or 'unresolved'
+        db_ms = sum(float(query['time']) for query in queries) * 1000
+        slow = duration >= SLOW_REQUEST_MS
+
+        with _lock:
+            stats = _views.get(view)
+            if stats is None:
+                stats = _views[view] = ViewStats()
+            stats.duration.add(duration)
+            stats.queries += len(queries)
+            stats.db_ms += db_ms
+            stats.template_ms += _local.template_ms
+            if response.status_code >= 500:
+                stats.errors += 1
+            if slow:
+                stats.slow += 1
+
+        if slow:
+            logger.warning('Slow request: %s %s took %.0f ms (%d queries, %.0f ms in the database, '
+                '%.0f ms in templates, caches %s)\n%s', view, request.get_full_path(), duration,
+                len(queries), db_ms, _local.template_ms, _local.cache_events,
+                '\n'.join('  %4d x %8.1f ms  %s' % (count, ms, sql)
+                    for sql, (count, ms) in _summarize_queries(queries)[:10]))
+        _local.start = _local.template_ms = _local.cache_events = None
+        return response
+
+
+def snapshot():
+    """
+    Returns this process's numbers as a dictionary.
+    """
+    with _lock:
+        views = dict((view, stats.as_dict()) for view, stats in _views.items())
+        caches = {}
+        for (name, result), count in _cache_events.items():
+            caches.setdefault(name, {'hit': 0, 'miss': 0})[result] = count
+    return {
+        'pid': os.getpid(),
+        'uptime_seconds': int(time.time() - _started),
+        'views': views,
+        'caches': caches,
+    }
+
+
+def prometheus():
+    """
+    Returns this process's numbers in the Prometheus text format.
+    """
+    lines = [
+        '# TYPE crime_request_duration_ms histogram',
+    ]
+    with _lock:
+        views = sorted(_views.items())
+        for view, stats in views:
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), stats.duration.counts):
+                cumulative += count
+                lines.append('crime_request_duration_ms_bucket{view="%s",le="%s"} %d' % (view, bound, cumulative))
+            lines.append('crime_request_duration_ms_sum{view="%s"} %.3f' % (view, stats.duration.sum))
+            lines.append('crime_request_duration_ms_count{view="%s"} %d' % (view, stats.duration.count))
+        for name, kind, attribute in (
+                ('crime_db_queries_total', 'counter', 'queries'),
+                ('crime_db_time_ms_total', 'counter', 'db_ms'),
+                ('crime_template_time_ms_total', 'counter', 'template_ms'),
+                ('crime_request_errors_total', 'counter', 'errors'),
+                ('crime_slow_requests_total', 'counter', 'slow')):
+            lines.append('# TYPE %s %s' % (name, kind))
+            for view, stats in views:
+                lines.append('%s{view="%s"} %s' % (name, view, getattr(stats, attribute)))
+        lines.append('# TYPE crime_cache_requests_total counter')
+        for (name, result), count in sorted(_cache_events.items()):
+            lines.append('crime_cache_requests_total{cache="%s",result="%s"} %d' % (name, result, count))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    with _lock:
+        _views.clear()
+        _cache_events.clear()
@@ -0,0 +1,181 @@
+"""
+A small database-backed job queue for slow side effects of admin
+saves (network geocoding, thumbnail rendering), so editors don't wait
+on them.
+
+enqueue() writes a Job row in the caller's transaction, so a worker
+only sees the job once the save that queued it has committed. Jobs
+are run by `manage.py run_jobs`, which needs nothing but the database.
+Failed jobs are retried with exponential backoff up to max_attempts.
+Each job has a key: queuing a key that's already waiting does nothing,
+and queuing one that's running makes it run once more afterwards.
+
+With CRIME_JOBS_EAGER set, jobs run inline as they are queued (for tests).
+"""
+import datetime
+import hashlib
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+import simplejson
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F
+from django.utils.importlib import import_module
+from myproject.crime.models import JOB_STATUS_CHOICES, Job
+
+# Settings, with their defaults.
+JOBS_EAGER = getattr(settings, 'CRIME_JOBS_EAGER', False)
+JOB_MAX_ATTEMPTS = getattr(settings, 'CRIME_JOB_MAX_ATTEMPTS', 5)
+JOB_BACKOFF = getattr(settings, 'CRIME_JOB_BACKOFF_SECONDS', 30)
+JOB_MAX_BACKOFF = getattr(settings, 'CRIME_JOB_MAX_BACKOFF_SECONDS', 60 * 60)
+JOB_TIMEOUT = getattr(settings, 'CRIME_JOB_TIMEOUT_SECONDS', 60 * 15)
+
+
+def _load(task):
+    module, name = task.rsplit('.', 1)
+    return getattr(import_module(module), name)
+
+
+def enqueue(task, *args, **kwargs):
+    """
+    Queues a call of `task` (a dotted path to a function) with
+    JSON-serializable args. Takes an optional `key`, which defaults
+    to the task and its arguments, and `delay` in seconds.
+    """
+    payload = simplejson.dumps(args)
+    key = kwargs.pop('key', None) or '%s:%s' % (task, hashlib.md5(payload).hexdigest())
+    delay = kwargs.pop('delay', 0)
+    if JOBS_EAGER:
+        return _load(task)(*simplejson.loads(payload))
+
+    run_after = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+    # Reuse the row if the key has been seen before.
+    # update() skips auto_now, so "updated" is set by hand throughout.
+    now = datetime.datetime.now()
+    if Job.objects.filter(key=key, status='QU').update(task=task, args=payload, updated=now):
+        return
+    if Job.objects.filter(key=key, status='RU').update(rerun=True, updated=now):
+        return
+    if Job.objects.filter(key=key).update(task=task, args=payload, status='QU', attempts=0,
+            run_after=run_after, rerun=False, last_error='', updated=now):
+        return
+    savepoint = transaction.savepoint()
+    try:
+        Job.objects.create(key=key, task=task, args=payload, run_after=run_after,
+            max_attempts=JOB_MAX_ATTEMPTS)
+        transaction.savepoint_commit(savepoint)
+    except IntegrityError:
+        # Someone else queued the same key in the meantime.
+        transaction.savepoint_rollback(savepoint)
+
+
+def backoff(attempts):
+    """
+    Seconds to wait before retrying a job that has failed `attempts`
+    times: doubling each time, capped, with some jitter.
+    """
+    delay = min(JOB_BACKOFF * 2 ** (attempts - 1), JOB_MAX_BACKOFF)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def requeue_stale():
+    """
+    Puts back jobs whose worker died while running them.
+    """
+    now = datetime.datetime.now()
+    cutoff = now - datetime.timedelta(seconds=JOB_TIMEOUT)
+    return Job.objects.filter(status='RU', locked_at__lt=cutoff).update(status='QU', locked_by='', updated=now)
+
+
+def claim(worker):
+    """
+    Marks the next due job as running for `worker` and returns it,
+    or None. The conditional update means two workers can't claim
+    the same job, without needing row locks.
+    """
+    now = datetime.datetime.now()
+    candidates = Job.objects.filter(status='QU', run_after__lte=now).order_by(
+        'run_after', 'id').values_list('id', flat=True)[:10]
+    for id in candidates:
+        if Job.objects.filter(pk=id, status='QU').update(
+                status='RU', locked_by=worker, locked_at=now, attempts=F('attempts') + 1, updated=now):
+            return Job.objects.get(pk=id)
+    return None
+
+
+def run(job):
+    """
+    Runs a claimed job and records the outcome.
+    """
+    try:
+        with transaction.commit_on_success():
+            _load(job.task)(*simplejson.loads(job.args))
+    except Exception:
+        error = traceback.format_exc()
+        now = datetime.datetime.now()
+        if job.attempts < job.max_attempts:
+            Job.objects.filter(pk=job.pk).update(status='QU', last_error=error, locked_by='', updated=now,
+                run_after=now + datetime.timedelta(seconds=backoff(job.attempts)))
+        else:
+            Job.objects.filter(pk=job.pk).update(status='FA', last_error=error, locked_by='', updated=now)
+        return False
+    # A rerun requested while this ran starts straight away.
+    now = datetime.datetime.now()
+    if not Job.objects.filter(pk=job.pk, rerun=True).update(
+            status='QU', rerun=False, attempts=0, locked_by='', run_after=now, updated=now):
+        Job.objects.filter(pk=job.pk).update(status='DO', last_error='', locked_by='', updated=now)
+    return True
+
+
+def work(worker=None, once=False, poll=1.0, stop=None):
+    """
+    Runs jobs until `stop` (a threading.Event) is set, or, with
+    once=True, until none are due. Returns the number run.
+    """
+    worker = worker or '%s:%d:%s' % (socket.gethostname(), os.getpid(), threading.current_thread().name)
+    count = 0
+    try:
+        while not (stop and stop.is_set()):
+            job = claim(worker)
+            transaction.commit_unless_managed()
+            if job is None:
+                if once:
+                    break
+                time.sleep(poll)
+                continue
+            run(job)
+            transaction.commit_unless_managed()
+            count += 1
+    finally:
+        connection.close()
+    return count
+
+
+def status(recent=20):
+    """
+    Returns queue counts by status, the age of the oldest due job
+    and the most recent failures.
+    """
+    now = datetime.datetime.now()
+    counts = dict((code, 0) for code, label in JOB_STATUS_CHOICES)
+    for row in Job.objects.values('status').annotate(n=Count('id')).order_by():
+        counts[row['status']] = row['n']
+    oldest = Job.objects.filter(status='QU', run_after__lte=now).order_by('run_after').values_list(
+        'run_after', flat=True)[:1]
+    failures = Job.objects.filter(status='FA').order_by('-updated')[:recent]
+    return {
+        'counts': dict((label.lower(), counts[code]) for code, label in JOB_STATUS_CHOICES),
+        'oldest_due_seconds': oldest and int((now - oldest[0]).total_seconds()) or 0,
+        'retrying': Job.objects.filter(status='QU', attempts__gt=0).count(),
+        'failures': [{
+            'key': job.key,
+            'task': job.task,
+            'attempts': job.attempts,
+            'updated': job.updated.isoformat(),
+            'error': (job.last_error.strip().splitlines() or [''])[-1],
+        } for job in failures],
+    }
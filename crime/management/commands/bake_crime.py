@@ -0,0 +1,26 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from myproject.crime.bake import WORKERS, bake
+
+
+class Command(BaseCommand):
+    args = '<output directory>'
+    help = "Renders the public crime pages into a directory of static files, redoing only the stale ones."
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=WORKERS,
+            help='Number of processes rendering pages.'),
+        make_option('--all', action='store_true', dest='full', default=False,
+            help='Render every page, stale or not.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the directory to write the pages to.")
+
+        def progress(report):
+            self.stdout.write("%d pages rendered...\n" % report.rendered)
+
+        report = bake(args[0], workers=options['workers'], full=options['full'], progress=progress)
+        for error in report.errors[:20]:
+            self.stdout.write("%s\n" % error)
+        self.stdout.write("%s\n" % unicode(report))
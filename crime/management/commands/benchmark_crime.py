@@ -0,0 +1,75 @@
+import simplejson
+from optparse import make_option
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
+from myproject.crime import benchmark
+from myproject.crime.synthetic import SCALES, build_archive
+
+
+class Command(NoArgsCommand):
+    help = ("Benchmarks the crime views against a synthetic archive in a throwaway test "
+        "database. Use settings with a private cache, since pages are cached as usual.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--scale', default='1k',
+            help='Incidents to generate: %s, or a number.' % ', '.join(sorted(SCALES))),
+        make_option('--seed', type='int', default=0,
+            help='Seed for the synthetic archive.'),
+        make_option('--repeat', type='int', default=20,
+            help='Requests per view and mode.'),
+        make_option('--views',
+            help='Comma-separated view names; all by default.'),
+        make_option('--no-warm', action='store_false', dest='warm', default=True,
+            help='Skip the cached ("warm") requests.'),
+        make_option('--output', default='benchmark.json',
+            help='File the results are written to.'),
+        make_option('--baseline',
+            help='Results file to compare with; exits with an error on regressions.'),
+        make_option('--threshold', type='float', default=0.2,
+            help='Allowed slowdown against the baseline, as a fraction.'),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            count = SCALES.get(options['scale']) or int(options['scale'])
+        except ValueError:
+            raise CommandError("--scale must be one of %s or a number." % ', '.join(sorted(SCALES)))
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = simplejson.load(f)
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            def progress(report):
+                self.stdout.write("Generating: %s\n" % unicode(report))
+            build_archive(count, seed=options['seed'], progress=progress)
+            views = options['views'] and options['views'].split(',')
+            results = benchmark.run(options['repeat'], views, options['warm'])
+            results['nearby'] = benchmark.nearby_queries(options['repeat'])
+            results['matching'] = benchmark.person_matching(count, seed=options['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        results['meta'].update({'scale': count, 'seed': options['seed']})
+
+        with open(options['output'], 'w') as f:
+            simplejson.dump(results, f, indent=2, sort_keys=True)
+        for name, modes in sorted(results['views'].items()):
+            for mode, result in sorted(modes.items()):
+                self.stdout.write("%-15s %-4s p50 %8.1f ms  p95 %8.1f ms  %3d queries\n" % (
+                    name, mode, result['p50_ms'], result['p95_ms'], result['queries']))
+        for name, result in sorted(results['nearby'].items()):
+            self.stdout.write("nearby %-24s p50 %8.1f ms  p95 %8.1f ms\n" % (
+                name, result['p50_ms'], result['p95_ms']))
+        matching = results['matching']
+        self.stdout.write("matching %d people: %.1f ms, %d of %d pairs scored, recall %.3f "
+            "(%.3f within blocks, %d repeats split), precision %.3f\n" % (
+            matching['people'], matching['ms'], matching['comparisons'], matching['all_pairs'],
+            matching['recall'], matching['blocked_recall'], matching['split'], matching['precision']))
+
+        if baseline:
+            regressions = benchmark.compare(results, baseline, options['threshold'])
+            if regressions:
+                raise CommandError("Regressions against %s:\n  %s" % (
+                    options['baseline'], '\n  '.join(regressions)))
+            self.stdout.write("No regressions against %s.\n" % options['baseline'])
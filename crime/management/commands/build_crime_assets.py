@@ -0,0 +1,15 @@
+from django.core.management.base import NoArgsCommand
+from myproject.crime.assets import brotli, build, jsmin
+
+
+class Command(NoArgsCommand):
+    help = "Builds the fingerprinted, minified and precompressed crime asset bundles."
+
+    def handle_noargs(self, **options):
+        manifest = build()
+        for name, path in sorted(manifest.items()):
+            self.stdout.write("%s -> %s\n" % (name, path))
+        if not brotli:
+            self.stdout.write("The brotli module isn't installed; only gzip copies were written.\n")
+        if not jsmin:
+            self.stdout.write("The jsmin module isn't installed; JavaScript was concatenated but not minified.\n")
@@ -0,0 +1,48 @@
+import sys
+from optparse import make_option
+from django.core.management.base import CommandError, NoArgsCommand
+from myproject.crime.export import FORMATS, export, gzip_stream
+from myproject.crime.helpers import TIME_FRAMES, parse_date
+from myproject.crime.models import Incident
+
+
+def _date(value):
+    try:
+        return parse_date(value)
+    except ValueError:
+        raise CommandError("Dates must be YYYY-MM-DD, not %r." % value)
+
+
+class Command(NoArgsCommand):
+    help = "Exports incidents with their victims and suspects as CSV, NDJSON or GeoJSON."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--format', choices=FORMATS, default='csv',
+            help='One of: %s.' % ', '.join(FORMATS)),
+        make_option('--output', default='-',
+            help='File to write to; "-" for standard output.'),
+        make_option('--time-frame', choices=TIME_FRAMES, default='all',
+            help='Limit to one of the time frames used by the pages.'),
+        make_option('--start', help='First incident date, YYYY-MM-DD.'),
+        make_option('--end', help='Last incident date, YYYY-MM-DD.'),
+        make_option('--gzip', action='store_true', default=False,
+            help='Gzip the output.'),
+    )
+
+    def handle_noargs(self, **options):
+        incidents = Incident.objects.in_time_frame(options['time_frame']).between(
+            options['start'] and _date(options['start']),
+            options['end'] and _date(options['end']))
+        content = export(options['format'], incidents)
+        if options['gzip']:
+            content = gzip_stream(content)
+
+        if options['output'] == '-':
+            output = sys.stdout
+        else:
+            output = open(options['output'], 'wb')
+        try:
+            for chunk in content:
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
@@ -0,0 +1,31 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from myproject.crime.models import Suspect, Thumbnail, Victim
+from myproject.crime.thumbnails import delete_variants, photo_field, photo_state, render_variants
+
+
+class Command(NoArgsCommand):
+    help = "Renders missing victim and suspect photo thumbnails and deletes ones no longer used."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all', action='store_true', default=False,
+            help='Render every photo again, not just the ones without thumbnails.'),
+    )
+
+    def handle_noargs(self, **options):
+        current = set()
+        for model in (Victim, Suspect):
+            for person in model.objects.exclude(**{photo_field(model): ''}).exclude(**{photo_field(model) + '__isnull': True}):
+                current.add(photo_state(person))
+        rendered = set(Thumbnail.objects.values_list('source', 'cropping').distinct())
+
+        count = 0
+        for state in sorted(current):
+            if options['all'] or state not in rendered:
+                try:
+                    render_variants(*state)
+                    count += 1
+                except IOError as e:
+                    self.stderr.write("Couldn't render %s: %s\n" % (state[0], e))
+        for state in rendered - current:
+            delete_variants(*state)
+        self.stdout.write("Rendered %d photos, removed %d stale ones.\n" % (count, len(rendered - current)))
@@ -0,0 +1,19 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from myproject.crime.geocoding import evict, geocode_pending
+
+
+class Command(NoArgsCommand):
+    help = "Geocodes queued incident addresses and fills in the incidents waiting on them."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', type='int', default=100,
+            help='Maximum number of addresses to geocode.'),
+        make_option('--workers', type='int', default=4,
+            help='Number of concurrent geocoder requests.'),
+    )
+
+    def handle_noargs(self, **options):
+        entries = geocode_pending(limit=options['limit'], workers=options['workers'])
+        found = len([entry for entry in entries if entry.status == 'OK'])
+        self.stdout.write("Geocoded %d addresses, %d found.\n" % (len(entries), found))
+        evict()
@@ -0,0 +1,35 @@
+import os
+from optparse import make_option
+from django.core.management.base import CommandError, LabelCommand
+from myproject.crime.importer import CHUNK_SIZE, IncidentImporter, read_records
+
+
+class Command(LabelCommand):
+    help = "Imports historical incidents from CSV or NDJSON files in the export layout."
+    args = '<file file ...>'
+    label = 'file'
+    option_list = LabelCommand.option_list + (
+        make_option('--chunk-size', type='int', default=CHUNK_SIZE,
+            help='Records written per transaction.'),
+        make_option('--workers', type='int', default=8,
+            help='Number of concurrent geocoder requests.'),
+        make_option('--checkpoint',
+            help='Progress file; defaults to <file>.checkpoint. Rerun to resume.'),
+    )
+
+    def handle_label(self, path, **options):
+        if not os.path.exists(path):
+            raise CommandError("%s does not exist." % path)
+
+        def progress(report):
+            self.stdout.write("%s\n" % unicode(report))
+
+        importer = IncidentImporter(
+            chunk_size=options['chunk_size'],
+            workers=options['workers'],
+            checkpoint=options['checkpoint'] or path + '.checkpoint',
+            progress=progress)
+        report = importer.run(read_records(path))
+        for line, error in report.errors:
+            self.stderr.write("%s:%d: %s\n" % (path, line, error))
+        self.stdout.write("Finished %s: %s\n" % (path, unicode(report)))
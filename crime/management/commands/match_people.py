@@ -0,0 +1,38 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from myproject.crime import matching
+from myproject.crime.models import Suspect, Victim
+
+
+class Command(NoArgsCommand):
+    help = "Lists victims and suspects that look entered more than once, and optionally merges them."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--only', type='choice', choices=['victims', 'suspects'],
+            help='Match only victims or only suspects.'),
+        make_option('--threshold', type='float', default=matching.THRESHOLD,
+            help='Lowest score, from 0 to 1, proposed as the same person.'),
+        make_option('--limit', type='int', default=50,
+            help='Number of proposed matches listed per model.'),
+        make_option('--merge', action='store_true', default=False,
+            help='Merge every proposed match into the person entered first.'),
+        make_option('--rebuild-keys', action='store_true', dest='rebuild_keys', default=False,
+            help='Recompute the match keys first, for people saved before they existed.'),
+    )
+
+    def handle_noargs(self, **options):
+        for listing, model in (('victims', Victim), ('suspects', Suspect)):
+            if options['only'] and options['only'] != listing:
+                continue
+            if options['rebuild_keys']:
+                self.stdout.write("Updated the match keys of %d %s.\n" % (matching.rebuild_keys(model), listing))
+            matches = matching.propose_matches(model, options['threshold'])
+            self.stdout.write("%d possible repeats among %s:\n" % (len(matches), listing))
+            for match in matches[:options['limit']]:
+                self.stdout.write("  %s\n" % unicode(match))
+            if len(matches) > options['limit']:
+                self.stdout.write("  ... and %d more.\n" % (len(matches) - options['limit']))
+            if options['merge'] and matches:
+                groups = matching.group_matches(matches, options['threshold'])
+                incident_ids = matching.merge_people(model, groups)
+                self.stdout.write("Merged %d %s into %d, across %d incidents.\n" % (
+                    sum(len(others) for keep, others in groups), listing, len(groups), len(incident_ids)))
@@ -0,0 +1,10 @@
+from django.core.management.base import NoArgsCommand
+from myproject.crime.stats import rebuild_stats
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the aggregate stats snapshot for every time frame."
+
+    def handle_noargs(self, **options):
+        for stats in rebuild_stats():
+            self.stdout.write("%s: %d incidents\n" % (stats.time_frame, stats.total_count))
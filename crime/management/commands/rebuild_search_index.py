@@ -0,0 +1,9 @@
+from django.core.management.base import NoArgsCommand
+from myproject.crime.search import rebuild_index
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the search index for every incident."
+
+    def handle_noargs(self, **options):
+        self.stdout.write("Indexed %d incidents.\n" % rebuild_index())
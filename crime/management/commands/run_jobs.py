@@ -0,0 +1,42 @@
+import threading
+import time
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from myproject.crime.jobs import requeue_stale, work
+
+
+class Command(NoArgsCommand):
+    help = "Runs queued background jobs (geocoding, thumbnails) until interrupted."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', default=2,
+            help='Number of worker threads.'),
+        make_option('--once', action='store_true', default=False,
+            help='Exit when no jobs are due, e.g. from cron.'),
+        make_option('--poll', type='float', default=1.0,
+            help='Seconds to wait between checks of an empty queue.'),
+    )
+
+    def handle_noargs(self, **options):
+        requeue_stale()
+        transaction.commit_unless_managed()
+        if options['once']:
+            count = work(once=True)
+            self.stdout.write("Ran %d jobs.\n" % count)
+            return
+
+        stop = threading.Event()
+        threads = [threading.Thread(target=work, name='worker-%d' % i,
+            kwargs={'poll': options['poll'], 'stop': stop}) for i in range(options['workers'])]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(60)
+                requeue_stale()
+                transaction.commit_unless_managed()
+        except KeyboardInterrupt:
+            stop.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,32 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from myproject.crime.geo import coordinate_columns
+from myproject.crime.models import Incident
+
+
+class Command(NoArgsCommand):
+    help = "Fills the numeric lat/lng and geohash columns from the string Latitude/Longitude fields."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all', action='store_true', default=False,
+            help='Recompute every incident, not just the ones missing numeric coordinates.'),
+        make_option('--batch-size', type='int', default=500,
+            help='Incidents updated per transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        incidents = Incident.objects.exclude(latitude='').order_by('id')
+        if not options['all']:
+            incidents = incidents.filter(lat__isnull=True)
+        last_id, updated = 0, 0
+        while True:
+            rows = list(incidents.filter(id__gt=last_id).values_list(
+                'id', 'latitude', 'longitude')[:options['batch_size']])
+            if not rows:
+                break
+            with transaction.commit_on_success():
+                for id, latitude, longitude in rows:
+                    updated += Incident.objects.filter(pk=id).update(
+                        **coordinate_columns(latitude, longitude))
+            last_id = rows[-1][0]
+        self.stdout.write("Updated %d incidents.\n" % updated)
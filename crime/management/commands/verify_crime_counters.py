@@ -0,0 +1,36 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from myproject.crime import analytics, caching
+from myproject.crime.counters import COUNTER_FIELDS, verify_counters
+from myproject.crime.helpers import TIME_FRAMES
+from myproject.crime.stats import rebuild_stats
+
+
+class Command(NoArgsCommand):
+    help = "Checks every incident's victim, killed and suspect counters against its people."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--repair', action='store_true', default=False,
+            help='Fix the wrong counters, and the stats and caches built on them.'),
+    )
+
+    def handle_noargs(self, **options):
+        with transaction.commit_on_success():
+            stale = verify_counters(repair=options['repair'])
+        for old, new in stale[:20]:
+            self.stdout.write("Incident %d: %s\n" % (old['id'], ', '.join(
+                '%s %s -> %s' % (field, old[field], new[field])
+                for field in COUNTER_FIELDS if old[field] != new[field])))
+        if len(stale) > 20:
+            self.stdout.write("... and %d more.\n" % (len(stale) - 20))
+        if not stale:
+            self.stdout.write("All counters are correct.\n")
+        elif options['repair']:
+            rebuild_stats()
+            analytics.invalidate_all()
+            caching.bump('search', *['incident:%s' % old['id'] for old, new in stale] +
+                [caching.frame_scope(listing, time_frame)
+                    for listing in ('stats', 'incidents') for time_frame in TIME_FRAMES])
+            self.stdout.write("Repaired %d incidents.\n" % len(stale))
+        else:
+            self.stdout.write("%d incidents have wrong counters; rerun with --repair to fix them.\n" % len(stale))
@@ -0,0 +1,312 @@
+"""
+Finds victims and suspects entered more than once, and merges them.
+
+People are added per incident in the admin, so someone arrested twice
+often ends up as two Suspect rows. Each person's match_key (see
+helpers.person_match_key()) holds the blocking key. It is the Soundex
+code of the last name, the first initial and the sex, and is indexed.
+Only people with the same key are compared. Within a key they are
+sorted by age, and only people whose ages are at most AGE_BAND years
+apart are compared; people of unknown age are compared with everyone
+in the key. Pairs are scored on Jaro-Winkler similarity of both names
+and on how close the ages are. Those scoring at least THRESHOLD are
+proposed, unless one is a victim killed before the other's latest
+incident (see possible()).
+
+Keys are read in one pass over the match_key index, so the work grows
+with the size of the blocks, not with the square of the table.
+
+merge_people() moves the merged people's incident links to the person
+kept, with a few bulk queries per batch. A victim kept is marked killed,
+with the fatal wound, if any victim merged into it was. It then deletes
+the merged people and updates the counters, stats, search index and
+caches of the incidents involved.
+"""
+import itertools
+import operator
+from django.db import connection, transaction
+from django.db.models import Max
+from myproject.crime import caching, signals, thumbnails
+from myproject.crime.helpers import normalize_name, person_match_key
+from myproject.crime.models import Incident, Victim
+from myproject.crime.pagination import count_scope
+
+THRESHOLD = 0.9
+AGE_BAND = 3
+# Weights of the last name, first name and age in a score.
+LAST_NAME_WEIGHT, FIRST_NAME_WEIGHT, AGE_WEIGHT = 0.55, 0.35, 0.10
+
+# Blank fields of the person kept are filled from the merged ones.
+FILL_FIELDS = ('age', 'about')
+# Taken together from a merged victim who was killed.
+DEATH_FIELDS = ('is_killed', 'wound_location')
+
+# People read, or written, per query.
+BATCH_SIZE = 500
+
+
+def jaro_winkler(a, b, prefix_scale=0.1):
+    """
+    Jaro-Winkler similarity of two strings, from 0 (nothing
+    in common) to 1 (equal), favoring a shared prefix.
+    """
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    window = max(max(len(a), len(b)) // 2 - 1, 0)
+    a_matched, b_matched = [False] * len(a), [False] * len(b)
+    matches = 0
+    for i, letter in enumerate(a):
+        for j in range(max(0, i - window), min(len(b), i + window + 1)):
+            if not b_matched[j] and b[j] == letter:
+                a_matched[i] = b_matched[j] = True
+                matches += 1
+                break
+    if not matches:
+        return 0.0
+    a_letters = [letter for letter, matched in zip(a, a_matched) if matched]
+    b_letters = [letter for letter, matched in zip(b, b_matched) if matched]
+    transpositions = len([1 for x, y in zip(a_letters, b_letters) if x != y]) // 2
+    jaro = (matches / float(len(a)) + matches / float(len(b)) +
+        (matches - transpositions) / float(matches)) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * prefix_scale * (1 - jaro)
+
+
+def score(a, b):
+    """
+    Scores two rows from blocks() as the same person, from 0 to 1.
+    """
+    if a['age'] is None or b['age'] is None:
+        age = 0.5
+    else:
+        age = max(0.0, 1 - abs(a['age'] - b['age']) / float(AGE_BAND + 1))
+    return round(LAST_NAME_WEIGHT * jaro_winkler(a['last'], b['last']) +
+        FIRST_NAME_WEIGHT * jaro_winkler(a['first'], b['first']) + AGE_WEIGHT * age, 4)
+
+
+def blocks(model):
+    """
+    Yields the identified people of a model as lists of values()
+    rows that share a match key, for keys shared by two or more.
+    """
+    people = model.objects.filter(is_unidentified=False).exclude(match_key='').order_by('match_key')
+    fields = ('id', 'first_name', 'last_name', 'age', 'match_key')
+    if model is Victim:
+        people = people.values(*(fields + ('is_killed',))).annotate(last_date=Max('incident__inc_date'))
+    else:
+        people = people.values(*fields)
+    for key, rows in itertools.groupby(people.iterator(), operator.itemgetter('match_key')):
+        rows = list(rows)
+        if len(rows) > 1:
+            for row in rows:
+                row['first'], row['last'] = normalize_name(row['first_name']), normalize_name(row['last_name'])
+            yield rows
+
+
+def candidate_pairs(rows):
+    """
+    Yields the pairs in a block worth scoring: ages no more than
+    AGE_BAND apart, or either one unknown.
+    """
+    known = sorted([row for row in rows if row['age'] is not None], key=operator.itemgetter('age'))
+    unknown = [row for row in rows if row['age'] is None]
+    for i, a in enumerate(known):
+        for b in known[i + 1:]:
+            if b['age'] - a['age'] > AGE_BAND:
+                break
+            yield a, b
+    for i, a in enumerate(unknown):
+        for b in unknown[i + 1:] + known:
+            yield a, b
+
+
+def possible(a, b):
+    """
+    Whether two rows from blocks() can be the same person: a victim
+    who was killed can't turn up in a later incident.
+    """
+    for dead, other in ((a, b), (b, a)):
+        if (dead.get('is_killed') and dead['last_date'] and other['last_date'] and
+                other['last_date'] > dead['last_date']):
+            return False
+    return True
+
+
+class Match(object):
+    """
+    A proposed merge of two people, given as values() rows. `keep`
+    is the one entered first.
+    """
+    def __init__(self, score, a, b):
+        self.score = score
+        self.keep, self.other = sorted((a, b), key=operator.itemgetter('id'))
+
+    def __unicode__(self):
+        return u'%.3f  %s, %s (%s) #%d <- %s, %s (%s) #%d' % (self.score,
+            self.keep['last_name'], self.keep['first_name'], self.keep['age'], self.keep['id'],
+            self.other['last_name'], self.other['first_name'], self.other['age'], self.other['id'])
+
+
+def propose_matches(model, threshold=THRESHOLD):
+    """
+    Returns the Matches scoring at least `threshold`
+    among a model's people, best first.
+    """
+    matches = []
+    for rows in blocks(model):
+        for a, b in candidate_pairs(rows):
+            if not possible(a, b):
+                continue
+            value = score(a, b)
+            if value >= threshold:
+                matches.append(Match(value, a, b))
+    matches.sort(key=lambda match: (-match.score, match.keep['id'], match.other['id']))
+    return matches
+
+
+def group_matches(matches, threshold=THRESHOLD):
+    """
+    Joins matches that share people into merge groups. Returns
+    [(id kept, [ids merged into it])], keeping the lowest id. A group
+    joins people who were never compared, so each one merged must
+    also be possible() and score at least `threshold` against the
+    person kept; the others are left out.
+    """
+    rows = {}
+    for match in matches:
+        rows[match.keep['id']], rows[match.other['id']] = match.keep, match.other
+    parent = {}
+
+    def root(id):
+        while parent.get(id, id) != id:
+            parent[id] = parent.get(parent[id], parent[id])
+            id = parent[id]
+        return id
+
+    for match in matches:
+        a, b = root(match.keep['id']), root(match.other['id'])
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    groups = {}
+    for id in parent:
+        groups.setdefault(root(id), []).append(id)
+    checked = []
+    for keep, ids in groups.items():
+        ids = sorted(id for id in ids if id != keep and possible(rows[keep], rows[id]) and
+            score(rows[keep], rows[id]) >= threshold)
+        if ids:
+            checked.append((keep, ids))
+    return sorted(checked)
+
+
+def _batches(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), BATCH_SIZE):
+        yield ids[start:start + BATCH_SIZE]
+
+
+def _fill(model, merged):
+    """
+    Fills the blank fields of the people kept from the people merged
+    into them, lowest id first. A photo moves over too if the person
+    kept has none, and so does a victim's death. Returns the ids of
+    the merged people whose photo moved.
+    """
+    photo = thumbnails.photo_field(model)
+    fields = FILL_FIELDS + (DEATH_FIELDS if model is Victim else ())
+    rows = {}
+    for batch in _batches(set(merged) | set(merged.values())):
+        for row in model.objects.filter(id__in=batch).values('id', photo, 'cropping', *fields):
+            rows[row['id']] = row
+    moved = []
+    for other in sorted(merged):
+        keep = rows[merged[other]]
+        changes = dict((field, rows[other][field]) for field in FILL_FIELDS
+            if keep[field] in (None, '') and rows[other][field] not in (None, ''))
+        if not keep[photo] and rows[other][photo]:
+            changes.update({photo: rows[other][photo], 'cropping': rows[other]['cropping']})
+            moved.append(other)
+        if model is Victim and rows[other]['is_killed'] and not keep['is_killed']:
+            changes.update((field, rows[other][field]) for field in DEATH_FIELDS)
+        if changes:
+            keep.update(changes)
+            model.objects.filter(id=keep['id']).update(**changes)
+    # Thumbnails follow the photos: made for the people that got one,
+    # dropped with the people deleted.
+    owner = model._meta.module_name
+    for other in moved:
+        row = rows[merged[other]]
+        thumbnails.schedule((row[photo], row['cropping'] or ''), None, (owner, row['id']))
+    for other in merged:
+        if other not in moved and rows[other][photo]:
+            thumbnails.schedule(('', ''), (rows[other][photo], rows[other]['cropping'] or ''), (owner, other))
+    return moved
+
+
+def merge_people(model, groups):
+    """
+    Merges people of one model: groups is [(id kept, [ids merged])],
+    as from group_matches(). The incidents of the merged people are
+    linked to the person kept instead, and the merged people are
+    deleted. Returns the ids of the incidents whose people changed.
+    """
+    merged = dict((other, keep) for keep, others in groups for other in others if other != keep)
+    if set(merged) & set(merged.values()):
+        raise ValueError("A person can't be both kept and merged.")
+    if not merged:
+        return []
+
+    field = 'victim' if model is Victim else 'suspect'
+    listing = field + 's'
+    through = getattr(Incident, listing).through
+    with transaction.commit_on_success():
+        links = set()
+        for batch in _batches(set(merged) | set(merged.values())):
+            links.update(through.objects.filter(**{field + '__in': batch}).values_list('incident', field))
+        wanted = set((incident_id, merged.get(person_id, person_id)) for incident_id, person_id in links)
+        for batch in _batches(merged):
+            through.objects.filter(**{field + '__in': batch}).delete()
+        through.objects.bulk_create([through(**{'incident_id': incident_id, field + '_id': person_id})
+            for incident_id, person_id in sorted(wanted - links)])
+
+        _fill(model, merged)
+        # A queryset delete would send the delete signals person by
+        # person; what they update is done once for all below.
+        cursor = connection.cursor()
+        table = connection.ops.quote_name(model._meta.db_table)
+        for batch in _batches(merged):
+            cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (table, ', '.join(['%s'] * len(batch))), batch)
+
+        incident_ids = sorted(set(incident_id for incident_id, person_id in wanted))
+        signals.people_changed(listing, incident_ids)
+    caching.bump(count_scope(model))
+    return incident_ids
+
+
+def rebuild_keys(model):
+    """
+    Recomputes every person's match key, for rows saved before the
+    keys existed. Returns how many changed.
+    """
+    changed = {}
+    last_id = 0
+    while True:
+        rows = list(model.objects.filter(id__gt=last_id).order_by('id').values(
+            'id', 'first_name', 'last_name', 'sex', 'match_key')[:BATCH_SIZE])
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        for row in rows:
+            key = person_match_key(row['first_name'], row['last_name'], row['sex'])
+            if key != row['match_key']:
+                changed.setdefault(key, []).append(row['id'])
+    for key, ids in changed.items():
+        for batch in _batches(ids):
+            model.objects.filter(id__in=batch).update(match_key=key)
+    return sum(len(ids) for ids in changed.values())
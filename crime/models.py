@@ -1,5 +1,8 @@
-from django.db import models
-from helpers import get_lat_lng
+import datetime
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Q
+from geo import coordinate_columns
+from helpers import get_since_date, normalize_address, person_match_key
 from image_cropping.fields import ImageRatioField, ImageCropField
 
 # CHOICE FIELDS
@@ -42,11 +45,72 @@ WOUND_CHOICES = (
 )
 
 
+class IncidentQuerySet(models.query.QuerySet):
+    def in_time_frame(self, time_frame, today=None):
+        """
+        Limits to one of the "time_frame" windows used by the pages.
+        """
+        return self.between(get_since_date(time_frame, today))
+
+    def between(self, start=None, end=None):
+        """
+        Limits to incidents on or after start and on or before end.
+        Either may be None to leave that side open.
+        """
+        queryset = self
+        if start:
+            queryset = queryset.filter(inc_date__gte=start)
+        if end:
+            queryset = queryset.filter(inc_date__lte=end)
+        return queryset
+
+    def latest_first(self):
+        """
+        Newest first by date and time, then by id.
+        """
+        return self.order_by('-inc_date', '-inc_time', '-id')
+
+    def seek(self, inc_date, inc_time, id):
+        """
+        Keyset pagination for latest_first(): returns the incidents that
+        come after the given one. With the (inc_date, inc_time, id) index
+        this costs the same on the last page as on the first.
+        """
+        # PostgreSQL and Oracle sort NULL times first when descending,
+        # SQLite and MySQL sort them last.
+        nulls_first = connections[self.db].vendor in ('postgresql', 'oracle')
+        if inc_time is None:
+            after = Q(inc_date__lt=inc_date) | Q(inc_date=inc_date, inc_time__isnull=True, id__lt=id)
+            if nulls_first:
+                after |= Q(inc_date=inc_date, inc_time__isnull=False)
+        else:
+            after = (Q(inc_date__lt=inc_date) |
+                Q(inc_date=inc_date, inc_time__lt=inc_time) |
+                Q(inc_date=inc_date, inc_time=inc_time, id__lt=id))
+            if not nulls_first:
+                after |= Q(inc_date=inc_date, inc_time__isnull=True)
+        return self.filter(after)
+
+
+class IncidentManager(models.Manager):
+    def get_query_set(self):
+        return IncidentQuerySet(self.model, using=self._db)
+
+    def in_time_frame(self, time_frame, today=None):
+        return self.get_query_set().in_time_frame(time_frame, today)
+
+    def between(self, start=None, end=None):
+        return self.get_query_set().between(start, end)
+
+    def latest_first(self):
+        return self.get_query_set().latest_first()
+
+
 class Incident(models.Model):
     """
     Incident model.
     """
-    headline = models.CharField('Headline', max_length=255)
+    headline = models.CharField('Headline', max_length=255, db_index=True)
     is_approximate_address = models.BooleanField('Approximate address')
     address = models.CharField(max_length=255, blank=True, help_text="Enter either the Latitude and Longitude <em>OR</em> Address and the following two fields.")
     city = models.CharField(max_length=255, blank=True, default="Wilmington")
@@ -54,20 +118,25 @@ class Incident(models.Model):
     latitude = models.CharField('Latitude', blank=True, max_length=100)
     longitude = models.CharField('Longitude', blank=True, max_length=100)
     formatted_address = models.CharField('Formatted Address', blank=True, max_length=255)
-    inc_date = models.DateField('Incident Date')
-    inc_time = models.TimeField('Incident Time', null=True, blank=True)
+    lat = models.FloatField('Numeric Latitude', null=True, blank=True, db_index=True, editable=False)
+    lng = models.FloatField('Numeric Longitude', null=True, blank=True, db_index=True, editable=False)
+    geohash = models.CharField('Geohash', max_length=12, blank=True, db_index=True, editable=False)
+    inc_date = models.DateField('Incident Date', db_index=True)
+    inc_time = models.TimeField('Incident Time', null=True, blank=True, db_index=True)
     inc_type = models.CharField('Incident Type', max_length=2, choices=INC_TYPE_CHOICES)
     is_homicide = models.BooleanField('Homicide')
-    victim_count = models.IntegerField('No. of Victims', max_length=12, blank=True, null=True)
+    victim_count = models.IntegerField('No. of Victims', max_length=12, blank=True, null=True, default=0)
     killed_count = models.IntegerField('No. of Killed', max_length=12, blank=True, null=True, default="0")
-    is_victims_unknown = models.BooleanField('Victims not identified')
+    is_victims_unknown = models.BooleanField('Victims not identified', default=True)
     summary = models.TextField('Incident Summary', blank=True, help_text="Give just the details. Try to keep it under 5 grafs.")
     suspect_count = models.IntegerField('No. of Arrests', max_length=12, blank=True, null=True, default=0)
-    is_suspects_unknown = models.BooleanField('Suspects not identified')
+    is_suspects_unknown = models.BooleanField('Suspects not identified', default=True)
     suspects = models.ManyToManyField('Suspect', null=True, blank=True)
     victims = models.ManyToManyField('Victim', blank=True, null=True)
     inc_slug = models.SlugField('Slug')
 
+    objects = IncidentManager()
+
     def __unicode__(self):
         return self.headline
 
@@ -75,10 +144,20 @@ class Incident(models.Model):
         return u'%s %s %s' % (self.address, self.city, self.state)
     full_address = property(_get_full_address)
 
+    def _get_location(self):
+        return '+'.join(filter(None, (self.address, self.city, self.state)))
+    location = property(_get_location)
+
     def save(self, *args, **kwargs):
+        # Never geocode over the network here. Cache misses are queued
+        # and filled in later by the geocode_pending command.
+        self._geocode_pending = False
         if not self.latitude and not self.longitude:
-            location = '+'.join(filter(None, (self.address, self.city, self.state)))
-            self.latitude, self.longitude, self.formatted_address = get_lat_lng(location)
+            result, self._geocode_pending = GeocodeCache.objects.lookup(self.location)
+            if result:
+                self.latitude, self.longitude, self.formatted_address = result
+        for name, value in coordinate_columns(self.latitude, self.longitude).items():
+            setattr(self, name, value)
         super(Incident, self).save(*args, **kwargs)
 
     def get_absolute_url(self):
@@ -97,8 +176,8 @@ class Victim(models.Model):
     """
     Victim Model
     """
-    first_name = models.CharField('First Name', max_length=100)
-    last_name = models.CharField('Last Name', max_length=100)
+    first_name = models.CharField('First Name', max_length=100, db_index=True)
+    last_name = models.CharField('Last Name', max_length=100, db_index=True)
     age = models.IntegerField('Age', max_length=3, blank=True, null=True)
     sex = models.CharField('Sex', max_length=1, choices=SEX_CHOICES)
     is_killed = models.BooleanField('This person was killed')
@@ -108,10 +187,16 @@ class Victim(models.Model):
     cropping = ImageRatioField('victim_photo', '300x400')
     about = models.TextField('Victim Info.', null=True, blank=True)
     vic_slug = models.SlugField()
+    match_key = models.CharField('Match key', max_length=8, blank=True, db_index=True, editable=False)
 
     def __unicode__(self):
         return "%s, %s" % (self.last_name, self.first_name)
 
+    def save(self, *args, **kwargs):
+        # The blocking key matching.py looks for repeat people by.
+        self.match_key = person_match_key(self.first_name, self.last_name, self.sex)
+        super(Victim, self).save(*args, **kwargs)
+
     def get_full_name(self):
         """
             Returns the first_name plus the last_name, with a space in between.
@@ -132,8 +217,8 @@ class Suspect(models.Model):
     """
     Suspect Model
     """
-    first_name = models.CharField('First Name', max_length=100)
-    last_name = models.CharField('Last Name', max_length=100)
+    first_name = models.CharField('First Name', max_length=100, db_index=True)
+    last_name = models.CharField('Last Name', max_length=100, db_index=True)
     age = models.IntegerField('Age', max_length=3, blank=True, null=True)
     sex = models.CharField('Sex', max_length=1, choices=SEX_CHOICES)
     arrest_date = models.DateField('Arrest Date', null=True, blank=True)
@@ -142,13 +227,206 @@ class Suspect(models.Model):
     cropping = ImageRatioField('suspect_photo', '300x400')
     about = models.TextField('Suspect Info.', null=True, blank=True)
     suspect_slug = models.SlugField()
+    match_key = models.CharField('Match key', max_length=8, blank=True, db_index=True, editable=False)
 
     def __unicode__(self):
         return "%s, %s" % (self.last_name, self.first_name)
 
+    def save(self, *args, **kwargs):
+        # The blocking key matching.py looks for repeat people by.
+        self.match_key = person_match_key(self.first_name, self.last_name, self.sex)
+        super(Suspect, self).save(*args, **kwargs)
+
     def get_full_name(self):
         """
             Returns the first_name plus the last_name, with a space in between.
         """
         full_name = '%s %s' % (self.first_name, self.last_name)
         return full_name.strip()
+
+
+GEOCODE_STATUS_CHOICES = (
+    ('OK', 'Found'),
+    ('NF', 'Not found'),
+    ('PE', 'Pending'),
+)
+
+
+class GeocodeCacheManager(models.Manager):
+    def lookup(self, location):
+        """
+        Returns (result, pending) for a location: the cached
+        (lat, lng, formatted_address) tuple or None, and whether the
+        entry waits for the batch geocoder. Misses and expired entries
+        are queued for it; an expired result is still returned until
+        the batch replaces it.
+        """
+        address = normalize_address(location)
+        if not address:
+            return None, False
+        now = datetime.datetime.now()
+        try:
+            entry = self.get(address=address)
+        except self.model.DoesNotExist:
+            # Another save may queue the same address first.
+            sid = transaction.savepoint(using=self.db)
+            try:
+                self.create(address=address, location=location[:255], status='PE', last_used=now)
+                transaction.savepoint_commit(sid, using=self.db)
+                return None, True
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=self.db)
+                entry = self.get(address=address)
+        pending = entry.status == 'PE'
+        if entry.expires and entry.expires < now and not pending:
+            self.filter(pk=entry.pk).update(status='PE', last_used=now)
+            pending = True
+        else:
+            self.filter(pk=entry.pk).update(last_used=now)
+        if entry.status != 'NF' and entry.latitude is not None and entry.longitude is not None:
+            return (str(entry.latitude), str(entry.longitude), entry.formatted_address), pending
+        return None, pending
+
+
+class GeocodeCache(models.Model):
+    """
+    Geocoder results keyed by normalized address.
+    Rows with a "Pending" status are the queue for the batch geocoder.
+    """
+    address = models.CharField('Normalized Address', max_length=255, unique=True)
+    location = models.CharField('Location', max_length=255)
+    status = models.CharField(max_length=2, choices=GEOCODE_STATUS_CHOICES, db_index=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    formatted_address = models.CharField('Formatted Address', blank=True, max_length=255)
+    attempts = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    last_used = models.DateTimeField(db_index=True)
+    expires = models.DateTimeField(null=True, blank=True)
+
+    objects = GeocodeCacheManager()
+
+    def __unicode__(self):
+        return self.address
+
+
+class AggregateStats(models.Model):
+    """
+    Snapshot of the sidebar stats for one time frame.
+    Kept up to date by the receivers in signals.py and
+    rebuilt from scratch by the rebuild_crime_stats command.
+    """
+    time_frame = models.CharField('Time Frame', max_length=20, unique=True)
+    as_of = models.DateField('As of')
+    since_date = models.DateField('Since', null=True, blank=True)
+    homicide_count = models.IntegerField(default=0)
+    homicide_arrest_count = models.IntegerField(default=0)
+    shooting_count = models.IntegerField(default=0)
+    shooting_arrest_count = models.IntegerField(default=0)
+    total_count = models.IntegerField(default=0)
+    tot_arrest_count = models.IntegerField(default=0)
+    sus_avg_age = models.FloatField(null=True, blank=True)
+    vic_avg_age = models.FloatField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'aggregate stats'
+
+    def __unicode__(self):
+        return u'%s (as of %s)' % (self.time_frame, self.as_of)
+
+    def as_dict(self):
+        """
+        Returns the stats in the form the templates expect,
+        including success rates.
+        """
+        def rate(part, whole):
+            if not whole:
+                return None
+            return part * 100.00 / whole
+
+        return {
+            'sus_avg_age': self.sus_avg_age,
+            'vic_avg_age': self.vic_avg_age,
+            'homicide_count': self.homicide_count,
+            'homicide_arrest_count': self.homicide_arrest_count,
+            'homicide_success_rate': rate(self.homicide_arrest_count, self.homicide_count),
+            'shooting_count': self.shooting_count,
+            'shooting_arrest_count': self.shooting_arrest_count,
+            'shooting_success_rate': rate(self.shooting_arrest_count, self.shooting_count),
+            'total_count': self.total_count,
+            'tot_arrest_count': self.tot_arrest_count,
+            'tot_success_rate': rate(self.tot_arrest_count, self.total_count),
+        }
+
+
+class SearchTerm(models.Model):
+    """
+    Inverted index for the search page: one row per term per
+    incident, weighted by where in the incident the term appears.
+    Maintained by search.index_incident().
+    """
+    term = models.CharField(max_length=50, db_index=True)
+    incident = models.ForeignKey(Incident)
+    weight = models.IntegerField(default=1)
+
+    class Meta:
+        unique_together = ('term', 'incident')
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.term, self.incident_id)
+
+
+class Thumbnail(models.Model):
+    """
+    A stored thumbnail of a victim or suspect photo at one size,
+    for one cropping. Maintained by thumbnails.update_photo().
+    """
+    source = models.CharField(max_length=255, db_index=True)
+    cropping = models.CharField(max_length=50, blank=True)
+    width = models.IntegerField()
+    height = models.IntegerField()
+    image = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('source', 'cropping', 'width')
+
+    def __unicode__(self):
+        return u'%s (%dx%d)' % (self.source, self.width, self.height)
+
+
+JOB_STATUS_CHOICES = (
+    ('QU', 'Queued'),
+    ('RU', 'Running'),
+    ('DO', 'Done'),
+    ('FA', 'Failed'),
+)
+
+
+class Job(models.Model):
+    """
+    A unit of background work, run by the run_jobs command.
+    `key` makes enqueueing idempotent: queuing the same key again
+    while it's waiting does nothing. See jobs.py.
+    """
+    key = models.CharField(max_length=255, unique=True)
+    task = models.CharField(max_length=255)
+    args = models.TextField(default='[]')
+    status = models.CharField(max_length=2, choices=JOB_STATUS_CHOICES, default='QU', db_index=True)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=5)
+    run_after = models.DateTimeField(db_index=True)
+    rerun = models.BooleanField(default=False)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.key, self.get_status_display())
+
+
+# Connect the receivers that keep the derived tables in sync.
+import signals
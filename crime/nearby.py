@@ -0,0 +1,118 @@
+"""
+Nearby incidents: radius and k-nearest queries over the geohash
+column.
+
+A query reads only the incidents in the 3x3 block of geohash cells
+around the point (see geo.cells_covering()), through the indexed
+geohash prefix and the (lat, lng) index, and measures exact distances
+for those. k-nearest starts with a small radius and widens it until
+it holds k incidents. Every incident within a radius is then among
+the candidates, so the k closest are exact.
+"""
+import datetime
+import operator
+from django.conf import settings
+from django.db.models import Q
+from myproject.crime.geo import cells_covering, haversine, METERS_PER_DEGREE
+from myproject.crime.models import Incident
+
+# What the incident page shows: incidents within a few blocks and
+# a few months either side of it.
+NEARBY_RADIUS = getattr(settings, 'CRIME_NEARBY_RADIUS_METERS', 400)
+NEARBY_DAYS = getattr(settings, 'CRIME_NEARBY_DAYS', 90)
+NEARBY_LIMIT = getattr(settings, 'CRIME_NEARBY_LIMIT', 5)
+
+# k-nearest searches start at this radius and stop widening at MAX_RADIUS.
+FIRST_RADIUS = 250
+MAX_RADIUS = 10000
+
+FIELDS = ('id', 'inc_slug', 'headline', 'inc_date', 'inc_type', 'is_homicide', 'lat', 'lng')
+
+
+def _candidates(lat, lng, radius, start, end, exclude):
+    """
+    Returns values() rows of the incidents within `radius` meters,
+    with their "distance", closest first.
+    """
+    cells = reduce(operator.or_, [Q(geohash__startswith=cell) for cell in cells_covering(lat, lng, radius)])
+    incidents = Incident.objects.between(start, end).filter(cells)
+    degrees = radius / METERS_PER_DEGREE
+    incidents = incidents.filter(lat__range=(lat - degrees, lat + degrees))
+    if exclude is not None:
+        incidents = incidents.exclude(id=exclude)
+
+    rows = []
+    for row in incidents.values(*FIELDS):
+        row['distance'] = haversine(lat, lng, row['lat'], row['lng'])
+        if row['distance'] <= radius:
+            rows.append(row)
+    rows.sort(key=lambda row: (row['distance'], row['id']))
+    return rows
+
+
+def within(lat, lng, radius, start=None, end=None, exclude=None, limit=None):
+    """
+    Returns the incidents within `radius` meters of a point and
+    between two dates, closest first, as values() rows with a
+    "distance" in meters. `exclude` is an incident id to leave out.
+    """
+    rows = _candidates(lat, lng, radius, start, end, exclude)
+    return rows[:limit] if limit else rows
+
+
+def nearest(lat, lng, k, start=None, end=None, exclude=None, max_radius=MAX_RADIUS):
+    """
+    Returns the k incidents closest to a point, between two dates,
+    like within(). Incidents more than max_radius meters away aren't
+    considered, so fewer than k may come back.
+    """
+    radius = min(FIRST_RADIUS, max_radius)
+    while True:
+        rows = _candidates(lat, lng, radius, start, end, exclude)
+        if len(rows) >= k or radius >= max_radius:
+            return rows[:k]
+        radius = min(radius * 4, max_radius)
+
+
+def near_incident(incident, radius=NEARBY_RADIUS, days=NEARBY_DAYS, limit=NEARBY_LIMIT):
+    """
+    Returns the other incidents within `radius` meters of an incident
+    and `days` days either side of it, closest first.
+    """
+    if incident.lat is None or incident.lng is None:
+        return []
+    window = datetime.timedelta(days=days)
+    return within(incident.lat, incident.lng, radius, incident.inc_date - window,
+        incident.inc_date + window, exclude=incident.id, limit=limit)
+
+
+def neighbour_scopes(lat, lng, inc_date, exclude=None):
+    """
+    Returns the cache scopes of the incident pages that show an
+    incident at this place and date among their nearby incidents.
+    Bumped when the incident is saved or deleted.
+    """
+    if lat is None or lng is None or inc_date is None:
+        return []
+    window = datetime.timedelta(days=NEARBY_DAYS)
+    rows = within(lat, lng, NEARBY_RADIUS, inc_date - window, inc_date + window, exclude)
+    return ['incident:%s' % row['id'] for row in rows]
+
+
+def brute_force(lat, lng, k=None, radius=None, start=None, end=None, exclude=None):
+    """
+    The same answers as nearest() (k) or within() (radius), from
+    every incident with coordinates. The baseline for benchmarks.
+    """
+    incidents = Incident.objects.between(start, end).filter(lat__isnull=False, lng__isnull=False)
+    if exclude is not None:
+        incidents = incidents.exclude(id=exclude)
+    rows = []
+    for row in incidents.values(*FIELDS):
+        row['distance'] = haversine(lat, lng, row['lat'], row['lng'])
+        if radius is None or row['distance'] <= radius:
+            rows.append(row)
+    rows.sort(key=lambda row: (row['distance'], row['id']))
+    if k is not None:
+        rows = [row for row in rows if row['distance'] <= MAX_RADIUS][:k]
+    return rows
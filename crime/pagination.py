@@ -0,0 +1,156 @@
+"""
+Keyset ("seek") pagination for incident listings.
+
+Instead of a page number, the next page is named by a cursor: the
+date, time and id of the last incident shown. The database finds the
+next page through the (inc_date, inc_time, id) index, so deep pages
+cost the same as the first one. Used with IncidentQuerySet.latest_first().
+
+The admin changelists keep numbered pages but take their counts from
+cached_count(): each distinct query is counted once per change to its
+table, and an unfiltered table too big to count cheaply is estimated
+from the database's statistics.
+"""
+import datetime
+import hashlib
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from myproject.crime.caching import VERSION_TIMEOUT, get_versions
+
+# Below this many rows, an exact COUNT(*) is cheap enough.
+ESTIMATE_THRESHOLD = 10000
+
+
+def make_cursor(inc_date, inc_time, id):
+    """
+    Returns the cursor for the page after the incident with the
+    given date, time and id, e.g. "2012-10-01.143000.1234" or
+    "2012-10-01..1234".
+    """
+    return '%s.%s.%d' % (inc_date.isoformat(), inc_time.strftime('%H%M%S') if inc_time else '', id)
+
+
+def encode_cursor(incident):
+    return make_cursor(incident.inc_date, incident.inc_time, incident.id)
+
+
+def decode_cursor(value):
+    """
+    Returns the (inc_date, inc_time, id) in a cursor,
+    or None if it's malformed.
+    """
+    try:
+        inc_date, inc_time, id = value.split('.')
+        inc_date = datetime.datetime.strptime(inc_date, '%Y-%m-%d').date()
+        inc_time = datetime.datetime.strptime(inc_time, '%H%M%S').time() if inc_time else None
+        return inc_date, inc_time, int(id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class SeekPage(object):
+    """
+    A page of results, with the parts of the Paginator Page API
+    that make sense without counting the whole listing.
+    """
+    def __init__(self, object_list, cursor, next_cursor):
+        self.object_list = object_list
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+
+    def __repr__(self):
+        return '<Page after %s>' % (self.cursor or 'start')
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def seek_page(queryset, cursor, per_page):
+    """
+    Returns the SeekPage of `queryset` (which must be ordered with
+    latest_first()) that follows `cursor`, or the first page.
+    """
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        queryset = queryset.seek(*position)
+    else:
+        cursor = None
+    object_list = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(object_list) > per_page:
+        object_list = object_list[:per_page]
+        next_cursor = encode_cursor(object_list[-1])
+    return SeekPage(object_list, cursor, next_cursor)
+
+
+def count_scope(model):
+    """
+    Returns the scope bumped whenever rows of `model`
+    are added, removed or changed.
+    """
+    return 'count:%s' % model._meta.db_table
+
+
+def estimated_count(model, using='default'):
+    """
+    Returns the planner's estimate of the number of rows in a
+    model's table, or None where the backend has none.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = "SELECT reltuples FROM pg_class WHERE relname = %s"
+    elif connection.vendor == 'mysql':
+        sql = ("SELECT table_rows FROM information_schema.tables "
+               "WHERE table_schema = DATABASE() AND table_name = %s")
+    else:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(sql, [table])
+    row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+def cached_count(queryset):
+    """
+    Counts a queryset, reusing the count until its table changes.
+    Unfiltered counts of big tables are estimates.
+    """
+    query = queryset.query
+    sql, params = query.get_compiler(queryset.db).as_sql()
+    key = 'crime:count:%s:%s' % (get_versions([count_scope(queryset.model)])[0],
+        hashlib.md5(repr((sql, params))).hexdigest())
+    count = cache.get(key)
+    if count is None:
+        if not query.where and not query.having:
+            count = estimated_count(queryset.model, queryset.db)
+            if count is not None and count < ESTIMATE_THRESHOLD:
+                count = None
+        if count is None:
+            count = query.get_count(using=queryset.db)
+        cache.set(key, count, VERSION_TIMEOUT)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    """
+    A Paginator that counts with cached_count().
+    """
+    def _get_count(self):
+        if self._count is None:
+            self._count = cached_count(self.object_list)
+        return self._count
+    count = property(_get_count)
@@ -0,0 +1,133 @@
+"""
+Full-text search over incidents and the people in them.
+
+Every incident is broken into terms from its headline, summary and
+address and from the names and notes of its victims and suspects.
+The terms go into the SearchTerm table with a weight per field, and
+a query is answered by intersecting the incidents listed under each
+of its terms, ranked by total weight.
+"""
+import re
+import unicodedata
+from django.db.models import Sum
+from django.utils.encoding import force_unicode
+from myproject.crime.models import Incident, SearchTerm, Suspect, Victim
+
+TERM_RE = re.compile(r'[a-z0-9]+')
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 50
+# Candidate sets up to this size are narrowed in SQL, larger ones in Python.
+MAX_IN_CLAUSE = 500
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has',
+    'he', 'in', 'is', 'it', 'its', 'of', 'on', 'or', 'she', 'that', 'the',
+    'to', 'was', 'were', 'will', 'with',
+))
+
+INCIDENT_WEIGHTS = (
+    ('headline', 5),
+    ('formatted_address', 2),
+    ('summary', 1),
+)
+PERSON_WEIGHTS = (
+    ('first_name', 4),
+    ('last_name', 4),
+    ('about', 1),
+)
+
+
+def tokenize(text):
+    """
+    Splits text into lowercase, accent-free search terms.
+    """
+    text = unicodedata.normalize('NFKD', force_unicode(text or '')).encode('ascii', 'ignore').lower()
+    return [term[:MAX_TERM_LENGTH] for term in TERM_RE.findall(text)
+        if len(term) >= MIN_TERM_LENGTH and term not in STOP_WORDS]
+
+
+def incident_terms(incident_id):
+    """
+    Returns a dictionary of term -> weight for an incident.
+    """
+    weights = {}
+
+    def add(text, weight):
+        for term in tokenize(text):
+            weights[term] = weights.get(term, 0) + weight
+
+    fields = [field for field, weight in INCIDENT_WEIGHTS]
+    for row in Incident.objects.filter(pk=incident_id).values(*fields):
+        for field, weight in INCIDENT_WEIGHTS:
+            add(row[field], weight)
+    fields = [field for field, weight in PERSON_WEIGHTS]
+    for model in (Victim, Suspect):
+        for row in model.objects.filter(incident=incident_id).values(*fields):
+            for field, weight in PERSON_WEIGHTS:
+                add(row[field], weight)
+    return weights
+
+
+def index_incident(incident_id):
+    """
+    Replaces the index entries for one incident, in the
+    caller's transaction: it runs inside the model signals.
+    """
+    SearchTerm.objects.filter(incident=incident_id).delete()
+    SearchTerm.objects.bulk_create([
+        SearchTerm(term=term, incident_id=incident_id, weight=weight)
+        for term, weight in incident_terms(incident_id).items()])
+
+
+def index_incidents(incident_ids):
+    for incident_id in incident_ids:
+        index_incident(incident_id)
+
+
+def index_person(person):
+    """
+    Reindexes the incidents a victim or suspect is linked to.
+    """
+    index_incidents(person.incident_set.values_list('id', flat=True))
+
+
+def rebuild_index():
+    """
+    Reindexes every incident. Returns how many were indexed.
+    """
+    SearchTerm.objects.all().delete()
+    incident_ids = list(Incident.objects.values_list('id', flat=True))
+    index_incidents(incident_ids)
+    return len(incident_ids)
+
+
+def search(query, prefix=False, limit=None):
+    """
+    Returns the ids of the incidents matching every term in the query,
+    best match first. With prefix=True the last term also matches
+    longer words ("mar" finds "market"), for type-ahead.
+    """
+    terms = tokenize(query)
+    if not terms:
+        return []
+    scores = None
+    for i, term in enumerate(terms):
+        postings = SearchTerm.objects.all()
+        if prefix and i == len(terms) - 1:
+            postings = postings.filter(term__startswith=term)
+        else:
+            postings = postings.filter(term=term)
+        if scores is not None and len(scores) <= MAX_IN_CLAUSE:
+            postings = postings.filter(incident__in=scores.keys())
+        term_scores = dict(postings.values_list('incident').annotate(score=Sum('weight')).order_by())
+        if scores is None:
+            scores = term_scores
+        else:
+            scores = dict((incident_id, scores[incident_id] + score)
+                for incident_id, score in term_scores.items() if incident_id in scores)
+        if not scores:
+            return []
+    # Newer incidents have higher ids, so ties go to the most recent.
+    ranked = sorted(scores.keys(), key=lambda incident_id: (-scores[incident_id], -incident_id))
+    if limit:
+        ranked = ranked[:limit]
+    return ranked
@@ -0,0 +1,194 @@
+"""
+Receivers that keep the crime app's derived data in sync
+with edits made to incidents, victims and suspects.
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from myproject.crime.models import Incident, Suspect, Victim
+from myproject.crime.pagination import count_scope
+from myproject.crime import analytics, caching, clustering, counters, heatmap, jobs, nearby, search, stats, thumbnails
+
+
+# Stored fields that derived data depends on.
+TRACKED_FIELDS = ('inc_date', 'inc_type', 'is_homicide', 'is_suspects_unknown', 'lat', 'lng')
+STATS_FIELDS = ('inc_date', 'is_homicide', 'is_suspects_unknown')
+ANALYTICS_FIELDS = ('inc_date', 'inc_type', 'is_homicide', 'is_suspects_unknown')
+HEATMAP_FIELDS = ('inc_date', 'inc_type', 'is_homicide', 'lat', 'lng')
+
+
+def _refresh_average_ages():
+    changed = stats.refresh_average_ages()
+    if changed:
+        caching.bump(*[caching.frame_scope('stats', time_frame) for time_frame in changed])
+
+
+def _refresh_counters(incident_ids):
+    """
+    Brings the incidents' people counters up to date, and with them
+    the stats and analytics that count arrests.
+    """
+    stale = counters.refresh_counters(incident_ids)
+    arrests_changed = [(old, new) for old, new in stale
+        if old['is_suspects_unknown'] != new['is_suspects_unknown']]
+    for old, new in arrests_changed:
+        stats.apply_incident_delta(old['inc_date'], old['is_homicide'], old['is_suspects_unknown'], sign=-1)
+        stats.apply_incident_delta(old['inc_date'], old['is_homicide'], new['is_suspects_unknown'], sign=1)
+    if arrests_changed:
+        dates = [old['inc_date'] for old, new in arrests_changed]
+        analytics.invalidate_dates(dates)
+        caching.bump_frames('stats', dates)
+    if stale:
+        # The admin filters on the "not identified" flags.
+        caching.bump(count_scope(Incident))
+    caching.bump_frames('incidents', [old['inc_date'] for old, new in stale])
+
+
+def people_changed(listing, incident_ids):
+    """
+    Updates what depends on the victims or suspects
+    ("listing") of the given incidents. Bulk changes that skip
+    the signals, like matching.merge_people(), call it directly.
+    """
+    incident_ids = list(incident_ids)
+    _refresh_counters(incident_ids)
+    _refresh_average_ages()
+    search.index_incidents(incident_ids)
+    dates = Incident.objects.filter(id__in=incident_ids).values_list('inc_date', flat=True)
+    caching.bump('search', *['incident:%s' % id for id in incident_ids])
+    caching.bump_frames(listing, dates)
+
+
+@receiver(pre_save, sender=Incident)
+def remember_incident_state(sender, instance, **kwargs):
+    """
+    Keeps the stored values of the tracked fields, so post_save
+    can tell where the incident used to be counted.
+    """
+    instance._old_state = None
+    if instance.pk:
+        rows = Incident.objects.filter(pk=instance.pk).values(*TRACKED_FIELDS)
+        if rows:
+            instance._old_state = rows[0]
+
+
+@receiver(post_save, sender=Incident)
+def incident_saved(sender, instance, created, **kwargs):
+    old = getattr(instance, '_old_state', None)
+    new = dict((field, getattr(instance, field)) for field in TRACKED_FIELDS)
+    dates = [new['inc_date']]
+    if old:
+        dates.append(old['inc_date'])
+
+    old_key = old and tuple(old[field] for field in STATS_FIELDS)
+    new_key = tuple(new[field] for field in STATS_FIELDS)
+    if old_key != new_key:
+        if old_key:
+            stats.apply_incident_delta(*old_key, sign=-1)
+        stats.apply_incident_delta(*new_key, sign=1)
+        caching.bump_frames('stats', dates)
+    if not old or any(old[field] != new[field] for field in ANALYTICS_FIELDS):
+        analytics.invalidate_dates(dates)
+    if old and old['inc_date'] != new['inc_date']:
+        _refresh_average_ages()
+        caching.bump_frames('victims', dates)
+        caching.bump_frames('suspects', dates)
+
+    if getattr(instance, '_geocode_pending', False):
+        # The address is pending in GeocodeCache; resolve it off the request.
+        jobs.enqueue('myproject.crime.geocoding.geocode_queued', key='geocode')
+    if old and any(old[field] != new[field] for field in HEATMAP_FIELDS):
+        # New incidents are added to the cached grids as they're read.
+        heatmap.invalidate_all()
+    if old:
+        clustering.invalidate_point(old['lat'], old['lng'])
+    clustering.invalidate_point(new['lat'], new['lng'])
+    search.index_incident(instance.pk)
+    neighbours = nearby.neighbour_scopes(new['lat'], new['lng'], new['inc_date'], instance.pk)
+    if old and any(old[field] != new[field] for field in ('inc_date', 'lat', 'lng')):
+        neighbours += nearby.neighbour_scopes(old['lat'], old['lng'], old['inc_date'], instance.pk)
+    caching.bump('search', 'incident:%s' % instance.pk, count_scope(Incident), *neighbours)
+    caching.bump_frames('incidents', dates)
+
+
+@receiver(post_delete, sender=Incident)
+def incident_deleted(sender, instance, **kwargs):
+    stats.apply_incident_delta(instance.inc_date, instance.is_homicide,
+        instance.is_suspects_unknown, sign=-1)
+    analytics.invalidate_dates([instance.inc_date])
+    _refresh_average_ages()
+    clustering.invalidate_point(instance.lat, instance.lng)
+    heatmap.invalidate_all()
+    caching.bump('search', 'incident:%s' % instance.pk, count_scope(Incident),
+        *nearby.neighbour_scopes(instance.lat, instance.lng, instance.inc_date, instance.pk))
+    for listing in ('stats', 'incidents', 'victims', 'suspects'):
+        caching.bump_frames(listing, [instance.inc_date])
+
+
+@receiver(pre_delete, sender=Victim)
+@receiver(pre_delete, sender=Suspect)
+def remember_person_incidents(sender, instance, **kwargs):
+    """
+    The M2M rows are gone by post_delete, so note
+    which incidents the person belonged to.
+    """
+    instance._incident_ids = list(instance.incident_set.values_list('id', flat=True))
+
+
+@receiver(pre_save, sender=Victim)
+@receiver(pre_save, sender=Suspect)
+def remember_photo_state(sender, instance, **kwargs):
+    instance._old_photo_state = None
+    if instance.pk:
+        rows = sender.objects.filter(pk=instance.pk).values_list(thumbnails.photo_field(sender), 'cropping')
+        if rows:
+            instance._old_photo_state = (rows[0][0] or '', rows[0][1] or '')
+
+
+@receiver(post_save, sender=Victim)
+@receiver(post_save, sender=Suspect)
+def person_photo_saved(sender, instance, **kwargs):
+    old = getattr(instance, '_old_photo_state', None) or ('', '')
+    new = thumbnails.photo_state(instance)
+    if new != old:
+        thumbnails.schedule(new, old, (sender._meta.module_name, instance.pk))
+
+
+@receiver(post_delete, sender=Victim)
+@receiver(post_delete, sender=Suspect)
+def person_photo_deleted(sender, instance, **kwargs):
+    old = thumbnails.photo_state(instance)
+    if old[0]:
+        thumbnails.schedule(('', ''), old, (sender._meta.module_name, instance.pk))
+
+
+@receiver(post_save, sender=Victim)
+@receiver(post_save, sender=Suspect)
+def person_saved(sender, instance, **kwargs):
+    listing = 'victims' if sender is Victim else 'suspects'
+    caching.bump(count_scope(sender))
+    people_changed(listing, instance.incident_set.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Victim)
+@receiver(post_delete, sender=Suspect)
+def person_deleted(sender, instance, **kwargs):
+    listing = 'victims' if sender is Victim else 'suspects'
+    caching.bump(count_scope(sender))
+    people_changed(listing, getattr(instance, '_incident_ids', []))
+
+
+@receiver(m2m_changed, sender=Incident.victims.through)
+@receiver(m2m_changed, sender=Incident.suspects.through)
+def incident_people_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        instance._incident_ids = list(instance.incident_set.values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        incident_ids = [instance.pk]
+    elif action == 'post_clear':
+        incident_ids = getattr(instance, '_incident_ids', [])
+    else:
+        incident_ids = pk_set or []
+    listing = 'victims' if sender is Incident.victims.through else 'suspects'
+    people_changed(listing, incident_ids)
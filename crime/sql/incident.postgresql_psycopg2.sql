@@ -0,0 +1,3 @@
+-- PostgreSQL only. The admin's "^headline" search is a case-insensitive
+-- prefix match, UPPER(headline) LIKE 'X%', which the plain index can't serve.
+CREATE INDEX crime_incident_headline_upper ON crime_incident (UPPER(headline) text_pattern_ops);
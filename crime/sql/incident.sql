@@ -0,0 +1,4 @@
+-- Run by syncdb after the crime_incident table is created.
+-- Existing databases can apply it with "manage.py sqlcustom crime".
+CREATE INDEX crime_incident_lat_lng ON crime_incident (lat, lng);
+CREATE INDEX crime_incident_date_time_id ON crime_incident (inc_date, inc_time, id);
@@ -0,0 +1,4 @@
+-- PostgreSQL only. Admin searches and the incident form's autocomplete
+-- match name prefixes case-insensitively: UPPER(last_name) LIKE 'X%'.
+CREATE INDEX crime_suspect_last_name_upper ON crime_suspect (UPPER(last_name) text_pattern_ops);
+CREATE INDEX crime_suspect_first_name_upper ON crime_suspect (UPPER(first_name) text_pattern_ops);
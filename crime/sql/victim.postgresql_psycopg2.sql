@@ -0,0 +1,4 @@
+-- PostgreSQL only. Admin searches and the incident form's autocomplete
+-- match name prefixes case-insensitively: UPPER(last_name) LIKE 'X%'.
+CREATE INDEX crime_victim_last_name_upper ON crime_victim (UPPER(last_name) text_pattern_ops);
+CREATE INDEX crime_victim_first_name_upper ON crime_victim (UPPER(first_name) text_pattern_ops);
@@ -0,0 +1,65 @@
+/*
+ * Adds a type-ahead to the incident form's victim and suspect id
+ * fields. Typing a name (or "Last, First", or an id) lists matches
+ * from the admin's autocomplete endpoint a page at a time; picking
+ * one appends its id to the field.
+ */
+(function ($) {
+	function attach(input) {
+		var url = input.attr('data-autocomplete'),
+			search = $('<input type="text" class="vTextField" placeholder="Find by name"/>'),
+			list = $('<ul class="crime-autocomplete"/>').css({listStyle: 'none', margin: 0, padding: 0}),
+			timer = null,
+			request = null;
+		input.parent().append($('<div/>').append(search, list));
+
+		function add(id) {
+			var ids = $.grep(input.val().split(','), function (value) { return $.trim(value) !== ''; });
+			if ($.inArray(String(id), ids) === -1) {
+				ids.push(id);
+			}
+			input.val(ids.join(','));
+		}
+
+		function load(page) {
+			if (request) {
+				request.abort();
+			}
+			request = $.getJSON(url, {q: search.val(), page: page}, function (data) {
+				if (page === 1) {
+					list.empty();
+				}
+				list.find('.more').remove();
+				$.each(data.results, function (i, person) {
+					$('<li/>').append($('<a href="#"/>').text(person.text).click(function () {
+						add(person.id);
+						return false;
+					})).appendTo(list);
+				});
+				if (data.more) {
+					$('<li class="more"/>').append($('<a href="#">More&hellip;</a>').click(function () {
+						load(page + 1);
+						return false;
+					})).appendTo(list);
+				}
+			});
+		}
+
+		search.keyup(function () {
+			clearTimeout(timer);
+			timer = setTimeout(function () {
+				if ($.trim(search.val())) {
+					load(1);
+				} else {
+					list.empty();
+				}
+			}, 250);
+		});
+	}
+
+	$(function () {
+		$('input[data-autocomplete]').each(function () {
+			attach($(this));
+		});
+	});
+})(django.jQuery);
@@ -0,0 +1,171 @@
+/*
+ * Loads the incidents inside the visible map area whenever the
+ * map is panned or zoomed, either as individual markers from
+ * /crime/map/incidents.json or as server-side clusters from
+ * /crime/map/tiles/<z>/<x>/<y>.json. The heatmap overlay is drawn
+ * from the byte tiles of /crime/map/heatmap/<row>/<col>.bin.
+ *
+ *   CrimeMap.loadViewport(map, '/webapps/crime/map/incidents.json', 'week');
+ *   CrimeMap.loadClusters(map, '/webapps/crime/map/tiles/', 'week');
+ *   CrimeMap.loadHeatmap(map, '/webapps/crime/map/heatmap.json', {time_frame: 'week'});
+ */
+var CrimeMap = (function ($) {
+	function popup(incident) {
+		return '<a href="' + incident.url + '">' + $('<div/>').text(incident.headline).html() + '</a>' +
+			'<br/>' + incident.date;
+	}
+
+	function loadViewport(map, url, timeFrame) {
+		var layer = new L.LayerGroup(),
+			request = null;
+		map.addLayer(layer);
+
+		function refresh() {
+			if (request) {
+				request.abort();
+			}
+			request = $.getJSON(url, {
+				bbox: map.getBounds().toBBoxString(),
+				time_frame: timeFrame || 'all'
+			}, function (data) {
+				layer.clearLayers();
+				$.each(data.incidents, function (i, incident) {
+					var marker = new L.Marker(new L.LatLng(incident.lat, incident.lng));
+					marker.bindPopup(popup(incident));
+					layer.addLayer(marker);
+				});
+			});
+		}
+
+		map.on('moveend', refresh);
+		refresh();
+		return layer;
+	}
+
+	function clusterPopup(cluster) {
+		var lines = [cluster.count + (cluster.count === 1 ? ' incident' : ' incidents')];
+		if (cluster.homicides) {
+			lines.push(cluster.homicides + (cluster.homicides === 1 ? ' homicide' : ' homicides'));
+		}
+		$.each(cluster.types, function (type, count) {
+			lines.push(TYPE_LABELS[type] + ': ' + count);
+		});
+		return lines.join('<br/>');
+	}
+
+	var TYPE_LABELS = {SH: 'Shooting', ST: 'Stabbing', VH: 'Vehicular', OT: 'Other'};
+
+	function loadClusters(map, baseUrl, timeFrame) {
+		var layer = new L.LayerGroup(),
+			tiles = {},
+			generation = 0;
+		map.addLayer(layer);
+
+		function draw(tile) {
+			$.each(tile.clusters, function (i, cluster) {
+				var marker = new L.CircleMarker(new L.LatLng(cluster.lat, cluster.lng), {
+					radius: 6 + Math.min(Math.sqrt(cluster.count) * 2, 24),
+					color: cluster.homicides ? '#900' : '#333'
+				});
+				marker.bindPopup(clusterPopup(cluster));
+				layer.addLayer(marker);
+			});
+		}
+
+		function refresh() {
+			var zoom = map.getZoom(),
+				bounds = map.getPixelBounds(),
+				limit = Math.pow(2, zoom) - 1,
+				minX = Math.max(Math.floor(bounds.min.x / 256), 0),
+				minY = Math.max(Math.floor(bounds.min.y / 256), 0),
+				maxX = Math.min(Math.floor(bounds.max.x / 256), limit),
+				maxY = Math.min(Math.floor(bounds.max.y / 256), limit),
+				current = ++generation,
+				x, y;
+			layer.clearLayers();
+			for (x = minX; x <= maxX; x++) {
+				for (y = minY; y <= maxY; y++) {
+					(function (key) {
+						if (tiles[key]) {
+							draw(tiles[key]);
+							return;
+						}
+						$.getJSON(baseUrl + key + '.json', {time_frame: timeFrame || 'all'}, function (tile) {
+							tiles[key] = tile;
+							// Tiles that arrive after the map moved on are kept, not drawn.
+							if (current === generation) {
+								draw(tile);
+							}
+						});
+					}(zoom + '/' + x + '/' + y));
+				}
+			}
+		}
+
+		map.on('moveend', refresh);
+		refresh();
+		return layer;
+	}
+
+	// Transparent where there's nothing, through yellow to opaque red.
+	function heatColor(value) {
+		return [255, Math.round(255 - value * 0.8), 0, Math.min(value * 2, 200)];
+	}
+
+	function heatImage(values, rows, cols) {
+		var canvas = document.createElement('canvas'),
+			context, image, i, color;
+		canvas.width = cols;
+		canvas.height = rows;
+		context = canvas.getContext('2d');
+		image = context.createImageData(cols, rows);
+		for (i = 0; i < values.length; i++) {
+			if (values[i]) {
+				color = heatColor(values[i]);
+				image.data[i * 4] = color[0];
+				image.data[i * 4 + 1] = color[1];
+				image.data[i * 4 + 2] = color[2];
+				image.data[i * 4 + 3] = color[3];
+			}
+		}
+		context.putImageData(image, 0, 0);
+		return canvas.toDataURL();
+	}
+
+	function loadHeatmap(map, url, params) {
+		var layer = new L.LayerGroup(),
+			baseUrl = url.replace(/\.json$/, '/'),
+			query = $.param(params || {});
+		map.addLayer(layer);
+
+		function loadTile(key) {
+			var request = new XMLHttpRequest();
+			request.open('GET', baseUrl + key + '.bin' + (query ? '?' + query : ''));
+			request.responseType = 'arraybuffer';
+			request.onload = function () {
+				if (request.status !== 200) {
+					return;
+				}
+				var shape = request.getResponseHeader('X-Heatmap-Shape').split(','),
+					bounds = request.getResponseHeader('X-Heatmap-Bounds').split(',');
+				layer.addLayer(new L.ImageOverlay(
+					heatImage(new Uint8Array(request.response), +shape[0], +shape[1]),
+					new L.LatLngBounds(new L.LatLng(+bounds[1], +bounds[0]), new L.LatLng(+bounds[3], +bounds[2]))
+				));
+			};
+			request.send();
+		}
+
+		$.getJSON(url, params || {}, function (grid) {
+			var row, col;
+			for (row = 0; row < grid.tile_rows; row++) {
+				for (col = 0; col < grid.tile_cols; col++) {
+					loadTile(row + '/' + col);
+				}
+			}
+		});
+		return layer;
+	}
+
+	return {loadViewport: loadViewport, loadClusters: loadClusters, loadHeatmap: loadHeatmap};
+}(jQuery));
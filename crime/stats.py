@@ -0,0 +1,158 @@
+"""
+Materialized sidebar stats.
+
+The counts in AggregateStats are adjusted in place as incidents are
+saved and deleted, so the views only ever read one row. Average ages
+depend on the victim/suspect links and are recomputed when those change.
+Each row remembers the day it was computed for; the relative time frames
+("week", "year", ...) move every day, so a stale row is rebuilt on first
+read.
+"""
+import datetime
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Count, F, Q
+from myproject.crime.helpers import TIME_FRAMES, get_since_date
+from myproject.crime.models import AggregateStats, Incident, Suspect, Victim
+
+COUNT_FIELDS = (
+    'homicide_count',
+    'homicide_arrest_count',
+    'shooting_count',
+    'shooting_arrest_count',
+    'total_count',
+    'tot_arrest_count',
+)
+
+
+def _normalize_time_frame(time_frame):
+    if time_frame in TIME_FRAMES:
+        return time_frame
+    return 'all'
+
+
+def _count_fields(is_homicide, is_suspects_unknown):
+    """
+    Returns the count fields a single incident contributes to.
+    """
+    fields = ['total_count']
+    if is_homicide:
+        fields.append('homicide_count')
+    else:
+        fields.append('shooting_count')
+    if not is_suspects_unknown:
+        fields.append('tot_arrest_count')
+        if is_homicide:
+            fields.append('homicide_arrest_count')
+        else:
+            fields.append('shooting_arrest_count')
+    return fields
+
+
+def _average_ages(since_date):
+    if since_date is None:
+        victims = Victim.objects.all()
+        suspects = Suspect.objects.all()
+    else:
+        victims = Victim.objects.filter(id__in=Victim.objects.filter(
+            incident__inc_date__gte=since_date).values('id'))
+        suspects = Suspect.objects.filter(id__in=Suspect.objects.filter(
+            incident__inc_date__gte=since_date).values('id'))
+    return (victims.aggregate(avg=Avg('age'))['avg'],
+            suspects.aggregate(avg=Avg('age'))['avg'])
+
+
+def compute_stats(time_frame, today=None):
+    """
+    Recomputes and saves the snapshot for one time frame.
+    The six incident counts come from a single GROUP BY query.
+    """
+    if today is None:
+        today = datetime.date.today()
+    time_frame = _normalize_time_frame(time_frame)
+    since_date = get_since_date(time_frame, today)
+
+    counts = dict((field, 0) for field in COUNT_FIELDS)
+    rows = Incident.objects.between(since_date).values(
+        'is_homicide', 'is_suspects_unknown').annotate(n=Count('id')).order_by()
+    for row in rows:
+        for field in _count_fields(row['is_homicide'], row['is_suspects_unknown']):
+            counts[field] += row['n']
+
+    vic_avg_age, sus_avg_age = _average_ages(since_date)
+
+    try:
+        stats = AggregateStats.objects.get(time_frame=time_frame)
+    except AggregateStats.DoesNotExist:
+        stats = AggregateStats(time_frame=time_frame)
+    stats.as_of = today
+    stats.since_date = since_date
+    stats.vic_avg_age = vic_avg_age
+    stats.sus_avg_age = sus_avg_age
+    for field, value in counts.items():
+        setattr(stats, field, value)
+    if stats.pk:
+        stats.save()
+        return stats
+    # Two first reads of a time frame may both create its row.
+    sid = transaction.savepoint()
+    try:
+        stats.save()
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        stats.pk = AggregateStats.objects.get(time_frame=time_frame).pk
+        stats.save(force_update=True)
+    return stats
+
+
+def rebuild_stats(today=None):
+    """
+    Rebuilds the snapshot for every time frame.
+    """
+    return [compute_stats(time_frame, today) for time_frame in TIME_FRAMES]
+
+
+def get_aggregate_info(time_frame='all'):
+    """
+    Returns a dictionary of stats from the data,
+    including success rates and average ages.
+    """
+    today = datetime.date.today()
+    time_frame = _normalize_time_frame(time_frame)
+    try:
+        stats = AggregateStats.objects.get(time_frame=time_frame)
+    except AggregateStats.DoesNotExist:
+        stats = None
+    if stats is None or stats.as_of != today:
+        stats = compute_stats(time_frame, today)
+    return stats.as_dict()
+
+
+def _snapshots_covering(inc_date):
+    return AggregateStats.objects.filter(
+        Q(since_date__isnull=True) | Q(since_date__lte=inc_date))
+
+
+def apply_incident_delta(inc_date, is_homicide, is_suspects_unknown, sign, count=1):
+    """
+    Adds (sign=1) or removes (sign=-1) one incident, or `count` alike
+    ones, from every snapshot whose time frame covers their date.
+    """
+    updates = dict((field, F(field) + sign * count)
+        for field in _count_fields(is_homicide, is_suspects_unknown))
+    _snapshots_covering(inc_date).update(**updates)
+
+
+def refresh_average_ages():
+    """
+    Recomputes the average victim and suspect ages for every
+    stored snapshot. Returns the time frames that changed.
+    """
+    changed = []
+    for stats in AggregateStats.objects.all():
+        vic_avg_age, sus_avg_age = _average_ages(stats.since_date)
+        if (vic_avg_age, sus_avg_age) != (stats.vic_avg_age, stats.sus_avg_age):
+            AggregateStats.objects.filter(pk=stats.pk).update(
+                vic_avg_age=vic_avg_age, sus_avg_age=sus_avg_age)
+            changed.append(stats.time_frame)
+    return changed
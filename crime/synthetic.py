@@ -0,0 +1,168 @@
+"""
+Seeded synthetic incident archives for benchmarks and load tests.
+
+generate_records() yields records in the importer's layout, so
+build_archive() goes through the same bulk path as real historical
+data (see importer.py). Coordinates cluster around a few Wilmington
+neighborhoods; names are built from syllables, so people repeat about
+as often as they do in the real archive. The same seed always gives
+the same archive. generate_people() makes person records with known
+repeats, misspelled or not, for the person-matching benchmark.
+"""
+import datetime
+import random
+from myproject.crime.geocoding import LocalGeocoder
+from myproject.crime.importer import IncidentImporter
+from myproject.crime.models import WOUND_CHOICES
+
+SCALES = {'1k': 1000, '10k': 10000, '100k': 100000}
+
+# (lat, lng, spread in degrees, share of incidents)
+HOTSPOTS = (
+    (39.7447, -75.5484, 0.008, 0.35),  # Downtown
+    (39.7363, -75.5621, 0.010, 0.25),  # Hilltop
+    (39.7520, -75.5380, 0.010, 0.20),  # East Side
+    (39.7259, -75.5477, 0.012, 0.10),  # Southbridge
+    (39.7600, -75.5600, 0.030, 0.10),  # Elsewhere in the city
+)
+STREETS = (
+    'Market Street', 'King Street', 'French Street', 'Walnut Street', 'Lancaster Avenue',
+    'Maryland Avenue', 'Fourth Street', 'Sixth Street', 'Tenth Street', 'Vandever Avenue',
+    'Bowers Street', 'Jefferson Street', 'Washington Street', 'Union Street', 'Claymont Street',
+)
+FIRST_NAMES = (
+    'James', 'John', 'Robert', 'Michael', 'William', 'David', 'Richard', 'Joseph', 'Thomas',
+    'Charles', 'Anthony', 'Marcus', 'Andre', 'Tyrone', 'Jamal', 'Darnell', 'Kevin', 'Brian',
+    'Mary', 'Patricia', 'Jennifer', 'Linda', 'Keisha', 'Tanya', 'Maria', 'Angela', 'Lisa',
+)
+SYLLABLES = ('wil', 'son', 'mar', 'ton', 'ley', 'har', 'ris', 'john', 'jack', 'ber', 'ford',
+    'well', 'kins', 'ham', 'by', 'ridge', 'lan', 'dell', 'stone', 'mor')
+
+# Incident types weighted roughly as in the real archive.
+INC_TYPES = ('SH',) * 14 + ('ST',) * 3 + ('VH',) + ('OT',) * 2
+HEADLINES = {
+    'SH': ('%s shot on %s', '%s wounded in %s shooting', 'Shooting on %s leaves %s hurt'),
+    'ST': ('%s stabbed on %s', '%s wounded in %s stabbing', 'Stabbing on %s leaves %s hurt'),
+    'VH': ('%s struck by car on %s', '%s hurt in %s hit-and-run', 'Hit-and-run on %s leaves %s hurt'),
+    'OT': ('%s found dead on %s', '%s hurt in %s assault', 'Assault on %s leaves %s hurt'),
+}
+HOMICIDE_SHARE = 0.15
+ARREST_SHARE = 0.4
+
+
+def _last_name(rng):
+    return ''.join(rng.choice(SYLLABLES) for i in range(rng.choice((2, 2, 3)))).capitalize()
+
+
+def _point(rng):
+    pick, total = rng.random(), 0.0
+    for lat, lng, spread, share in HOTSPOTS:
+        total += share
+        if pick <= total:
+            break
+    return round(rng.gauss(lat, spread), 6), round(rng.gauss(lng, spread * 1.3), 6)
+
+
+def _person(rng, victim):
+    person = {
+        'first_name': rng.choice(FIRST_NAMES),
+        'last_name': _last_name(rng),
+        'age': max(12, min(80, int(rng.gauss(27, 9)))),
+        'sex': 'M' if rng.random() < 0.85 else 'F',
+    }
+    if victim:
+        person['wound_location'] = rng.choice(WOUND_CHOICES)[0]
+    return person
+
+
+def generate_records(count, seed=0, end_date=None, days=5 * 365):
+    """
+    Yields (line number, record) pairs for `count` incidents
+    spread over the `days` before end_date.
+    """
+    rng = random.Random(seed)
+    end_date = end_date or datetime.date.today()
+    for line in range(1, count + 1):
+        inc_type = rng.choice(INC_TYPES)
+        street = rng.choice(STREETS)
+        is_homicide = rng.random() < HOMICIDE_SHARE
+        victims = [_person(rng, True) for i in range(1 + int(rng.random() < 0.25))]
+        for victim in victims:
+            victim['killed'] = is_homicide
+        suspects = []
+        if rng.random() < ARREST_SHARE:
+            suspects = [_person(rng, False) for i in range(1 + int(rng.random() < 0.2))]
+        lat, lng = _point(rng)
+        victim_name = '%s %s' % (victims[0]['first_name'], victims[0]['last_name'])
+        template = rng.choice(HEADLINES[inc_type])
+        headline = template % ((victim_name, street) if template.startswith('%s') else (street, victim_name))
+        yield line, {
+            'headline': headline,
+            'slug': 'synthetic-%d' % line,
+            'date': (end_date - datetime.timedelta(days=rng.randrange(days))).isoformat(),
+            'time': '%02d:%02d' % (rng.randrange(24), rng.randrange(60)),
+            'type': inc_type,
+            'homicide': is_homicide,
+            'address': '%d %s' % (rng.randrange(100, 2900, 2), street),
+            'latitude': lat,
+            'longitude': lng,
+            'victim_count': len(victims),
+            'killed_count': len(victims) if is_homicide else 0,
+            'suspect_count': len(suspects),
+            'suspects_unknown': not suspects,
+            'summary': '%s. Police are asking anyone with information to call.' % headline,
+            'victims': victims,
+            'suspects': suspects,
+        }
+
+
+def build_archive(count, seed=0, chunk_size=1000, progress=None):
+    """
+    Imports a synthetic archive of `count` incidents.
+    Returns the importer's report.
+    """
+    importer = IncidentImporter(geocoder=LocalGeocoder(), chunk_size=chunk_size,
+        workers=1, progress=progress)
+    return importer.run(generate_records(count, seed))
+
+
+def _misspell(rng, name):
+    """
+    One typo anywhere in a name: a letter dropped, doubled, or
+    swapped with the next. Typos in the first letter put the
+    repeat in another matching block.
+    """
+    if len(name) < 3:
+        return name + name[-1]
+    at = rng.randrange(0, len(name) - 1)
+    kind = rng.choice(('drop', 'double', 'swap'))
+    if kind == 'drop':
+        return name[:at] + name[at + 1:]
+    if kind == 'double':
+        return name[:at] + name[at] + name[at:]
+    return name[:at] + name[at + 1] + name[at] + name[at + 2:]
+
+
+def generate_people(count, duplicate_share=0.2, seed=0):
+    """
+    Returns (people, duplicates) for person-matching benchmarks:
+    `count` person records, a share of them repeats of an earlier
+    one with a misspelled name or an age a year or two off, and the
+    set of (earlier index, repeat index) pairs that are the same person.
+    """
+    rng = random.Random(seed)
+    people, duplicates = [], set()
+    for index in range(count):
+        if people and rng.random() < duplicate_share:
+            original = rng.randrange(len(people))
+            person = dict(people[original])
+            if rng.random() < 0.5:
+                person['last_name'] = _misspell(rng, person['last_name'])
+            elif rng.random() < 0.5:
+                person['first_name'] = _misspell(rng, person['first_name'])
+            person['age'] += rng.choice((0, 1, 2))
+            people.append(person)
+            duplicates.add((original, index))
+        else:
+            people.append(_person(rng, False))
+    return people, duplicates
@@ -0,0 +1,106 @@
+import hashlib
+from django import template
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+from myproject.crime.assets import bundle_paths
+from myproject.crime.caching import PAGE_TIMEOUT, get_versions
+from myproject.crime.instrumentation import cache_event
+from myproject.crime.thumbnails import THUMBNAIL_SIZES, get_variants, photo_field
+
+register = template.Library()
+
+
+class CrimeCacheNode(template.Node):
+    def __init__(self, nodelist, name, scopes):
+        self.nodelist = nodelist
+        self.name = name
+        self.scopes = scopes
+
+    def render(self, context):
+        scopes = [unicode(scope.resolve(context)) for scope in self.scopes]
+        digest = hashlib.md5(smart_str('%s|%s' % (scopes, get_versions(scopes)))).hexdigest()
+        key = 'crime:fragment:%s:%s' % (self.name, digest)
+        value = cache.get(key)
+        cache_event('fragment', value is not None)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(key, value, PAGE_TIMEOUT)
+        return value
+
+
+@register.tag
+def crimecache(parser, token):
+    """
+    Caches a template fragment until one of its scopes changes.
+
+        {% crimecache "incident_detail" incident_scope %}
+            ...
+        {% endcrimecache %}
+
+    The first argument names the fragment; the rest are scope names
+    (see caching.py), e.g. "incident:12" or "stats:week:2012-10-01".
+    """
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError("'%s' takes a fragment name and at least one scope." % bits[0])
+    nodelist = parser.parse(('endcrimecache',))
+    parser.delete_first_token()
+    return CrimeCacheNode(nodelist, bits[1].strip('"\''), [parser.compile_filter(bit) for bit in bits[2:]])
+
+
+@register.simple_tag
+def crimephoto(person, sizes='150px', css_class=''):
+    """
+    Renders a lazy-loading <img> for a victim's or suspect's photo
+    from its precomputed thumbnails:
+
+        {% crimephoto victim "(max-width: 480px) 75px, 150px" %}
+
+    `sizes` is the <img> sizes attribute. Until the thumbnails are
+    rendered, falls back to the original photo at the largest size.
+    """
+    variants = get_variants(person)
+    if variants:
+        src = variants[0]['url']
+        width, height = variants[-1]['width'], variants[-1]['height']
+        srcset = ', '.join('%s %dw' % (variant['url'], variant['width']) for variant in variants)
+    else:
+        photo = getattr(person, photo_field(person))
+        if not photo:
+            return ''
+        src, srcset = photo.url, ''
+        width, height = THUMBNAIL_SIZES[-1]
+    attributes = [
+        ('src', src),
+        ('srcset', srcset),
+        ('sizes', srcset and sizes),
+        ('width', width),
+        ('height', height),
+        ('alt', person.get_full_name()),
+        ('class', css_class),
+        ('loading', 'lazy'),
+    ]
+    return mark_safe(u'<img %s>' % u' '.join(u'%s="%s"' % (name, conditional_escape(value))
+        for name, value in attributes if value))
+
+
+@register.simple_tag
+def crimebundle(name, kind):
+    """
+    Renders the <link> or <script> tags for an asset bundle
+    (see assets.py):
+
+        {% crimebundle "map" "css" %}
+
+    Points at the fingerprinted bundle once build_crime_assets has
+    run, and at the separate source files until then.
+    """
+    if kind == 'css':
+        tag = u'<link rel="stylesheet" href="%s">'
+    else:
+        tag = u'<script src="%s"></script>'
+    return mark_safe(u'\n'.join(tag % conditional_escape(settings.STATIC_URL + path)
+        for path in bundle_paths(name, kind)))
@@ -5,7 +5,68 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import simplejson
+import zlib
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.urlresolvers import reverse
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import unittest
+from myproject.crime.analytics import age_histogram, time_series
+from myproject.crime.clustering import latlng_to_tile, tile_bounds
+from myproject.crime.export import CSV_COLUMNS, export
+from myproject.crime.geo import cells_covering, geohash_encode, haversine
+from myproject.crime.geocoding import (GEOCODE_MAX_ATTEMPTS, GeocoderError, LocalGeocoder, geocode_pending,
+    set_geocoder, store_result)
+from myproject.crime.helpers import person_match_key, soundex
+from myproject.crime.importer import IncidentImporter
+from myproject.crime import assets, bake, benchmark, counters, heatmap, matching, nearby, instrumentation, jobs, synthetic, thumbnails
+from myproject.crime.models import AggregateStats, GeocodeCache, Incident, Job, Suspect, Thumbnail, Victim
+from myproject.crime.pagination import cached_count, seek_page
+from myproject.crime.search import search
+from myproject.crime.stats import get_aggregate_info, rebuild_stats
+
+
+class _QueryBudgetContext(object):
+    def __init__(self, test_case, budget, connection):
+        self.test_case = test_case
+        self.budget = budget
+        self.connection = connection
+
+    def __enter__(self):
+        self.old_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        self.starting_queries = len(self.connection.queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.use_debug_cursor = self.old_debug_cursor
+        if exc_type is not None:
+            return
+        queries = self.connection.queries[self.starting_queries:]
+        self.test_case.assertTrue(len(queries) <= self.budget,
+            "%d queries executed, budget is %d:\n%s" % (len(queries), self.budget,
+                '\n'.join(query['sql'] for query in queries)))
+
+
+class QueryBudgetMixin(object):
+    def assertQueryBudget(self, budget, using=DEFAULT_DB_ALIAS):
+        """
+        Like assertNumQueries, but fails only when the
+        block runs more than `budget` queries.
+        """
+        return _QueryBudgetContext(self, budget, connections[using])
 
 
 class SimpleTest(TestCase):
@@ -14,3 +75,1012 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def make_incident(**kwargs):
+    """
+    Creates an incident with coordinates already filled in,
+    so saving it never reaches the geocoder.
+    """
+    values = {
+        'headline': 'Man shot on Market Street',
+        'inc_date': datetime.date.today(),
+        'inc_type': 'SH',
+        'latitude': '39.7447',
+        'longitude': '-75.5484',
+        'inc_slug': 'man-shot-on-market-street',
+        'is_suspects_unknown': True,
+    }
+    values.update(kwargs)
+    return Incident.objects.create(**values)
+
+
+class AggregateStatsTest(TestCase):
+    def setUp(self):
+        make_incident(is_homicide=True, is_suspects_unknown=False)
+        make_incident(is_homicide=False)
+        make_incident(inc_date=datetime.date.today() - datetime.timedelta(days=60))
+
+    def test_counts_by_time_frame(self):
+        info = get_aggregate_info('all')
+        self.assertEqual(info['total_count'], 3)
+        self.assertEqual(info['homicide_count'], 1)
+        self.assertEqual(info['homicide_success_rate'], 100.0)
+        self.assertEqual(info['shooting_arrest_count'], 0)
+        self.assertEqual(get_aggregate_info('week')['total_count'], 2)
+
+    def test_unknown_time_frame_falls_back_to_all(self):
+        self.assertEqual(get_aggregate_info('None'), get_aggregate_info('all'))
+
+    def test_snapshot_follows_saves_and_deletes(self):
+        rebuild_stats()
+        incident = make_incident(is_homicide=True)
+        self.assertEqual(AggregateStats.objects.get(time_frame='all').homicide_count, 2)
+        incident.is_suspects_unknown = False
+        incident.save()
+        self.assertEqual(AggregateStats.objects.get(time_frame='week').homicide_arrest_count, 2)
+        incident.delete()
+        stats = AggregateStats.objects.get(time_frame='all')
+        self.assertEqual((stats.total_count, stats.homicide_count), (3, 1))
+
+    def test_average_ages_follow_victim_links(self):
+        rebuild_stats()
+        incident = Incident.objects.filter(is_homicide=True)[0]
+        incident.victims.add(Victim.objects.create(first_name='John', last_name='Doe',
+            age=20, sex='M', wound_location='CH', vic_slug='doe-john'))
+        self.assertEqual(get_aggregate_info('week')['vic_avg_age'], 20)
+
+
+def make_victim(last_name, **kwargs):
+    values = {
+        'first_name': 'John',
+        'last_name': last_name,
+        'sex': 'M',
+        'wound_location': 'CH',
+        'vic_slug': last_name.lower(),
+    }
+    values.update(kwargs)
+    return Victim.objects.create(**values)
+
+
+class VictimsPageTest(TestCase):
+    def test_victims_listed_once_by_latest_incident(self):
+        old = make_incident(inc_date=datetime.date.today() - datetime.timedelta(days=30))
+        new = make_incident()
+        repeat, killed, earlier = make_victim('Repeat'), make_victim('Killed', is_killed=True), make_victim('Earlier')
+        old.victims.add(repeat, earlier)
+        new.victims.add(killed, repeat)
+        make_victim('Hidden', is_unidentified=True)
+
+        response = self.client.get(reverse('myproject.crime.views.victims_page'))
+        names = [v.last_name for v in response.context['details'].object_list]
+        self.assertEqual(names, ['Repeat', 'Killed', 'Earlier'])
+
+        response = self.client.get(reverse('myproject.crime.views.victims_page'), {'time_frame': 'week'})
+        names = [v.last_name for v in response.context['details'].object_list]
+        self.assertEqual(names, ['Repeat', 'Killed'])
+
+    def test_ordered_by_time_of_latest_incident(self):
+        today = datetime.date.today()
+        night = make_incident(inc_date=today - datetime.timedelta(days=1), inc_time=datetime.time(23, 0))
+        early, noon = make_incident(inc_time=datetime.time(1, 0)), make_incident(inc_time=datetime.time(12, 0))
+        repeat, other = make_victim('Repeat'), make_victim('Other')
+        night.victims.add(repeat)
+        early.victims.add(repeat)
+        noon.victims.add(other)
+        response = self.client.get(reverse('myproject.crime.views.victims_page'))
+        names = [v.last_name for v in response.context['details'].object_list]
+        self.assertEqual(names, ['Other', 'Repeat'])
+
+
+class GeocodingTest(TestCase):
+    def setUp(self):
+        self.geocoder = LocalGeocoder({
+            '800 N. French Street+Wilmington+DE': ('39.7424', '-75.5466', '800 N French St, Wilmington, DE 19801'),
+        })
+
+    def test_save_queues_miss_and_batch_fills_it(self):
+        incident = make_incident(latitude='', longitude='', address='800 N. French Street')
+        self.assertEqual(incident.latitude, '')
+        self.assertEqual(GeocodeCache.objects.get().status, 'PE')
+
+        geocode_pending(geocoder=self.geocoder, workers=1)
+        incident = Incident.objects.get(pk=incident.pk)
+        self.assertEqual((incident.latitude, incident.longitude), ('39.7424', '-75.5466'))
+
+        again = make_incident(latitude='', longitude='', address='800 North French St')
+        self.assertEqual(again.latitude, '39.7424')
+        self.assertEqual(len(self.geocoder.calls), 1)
+
+    def test_not_found_is_cached(self):
+        make_incident(latitude='', longitude='', address='Nowhere Lane')
+        geocode_pending(geocoder=self.geocoder, workers=1)
+        Job.objects.all().delete()
+        make_incident(latitude='', longitude='', address='Nowhere Lane')
+        self.assertEqual(GeocodeCache.objects.get().status, 'NF')
+        self.assertFalse(Job.objects.exists())
+        geocode_pending(geocoder=self.geocoder, workers=1)
+        self.assertEqual(len(self.geocoder.calls), 1)
+
+    def test_expired_result_is_used_while_refreshed(self):
+        make_incident(latitude='', longitude='', address='800 N. French Street')
+        geocode_pending(geocoder=self.geocoder, workers=1)
+        GeocodeCache.objects.update(expires=datetime.datetime.now() - datetime.timedelta(days=1))
+        again = make_incident(latitude='', longitude='', address='800 N. French Street')
+        self.assertEqual(again.latitude, '39.7424')
+        self.assertEqual(GeocodeCache.objects.get().status, 'PE')
+
+        # A geocoder that stays down doesn't erase the old result.
+        entry = GeocodeCache.objects.get()
+        for attempt in range(GEOCODE_MAX_ATTEMPTS):
+            store_result(entry, GeocoderError('timed out'))
+        entry = GeocodeCache.objects.get()
+        self.assertEqual((entry.status, entry.latitude), ('OK', 39.7424))
+        self.assertTrue(entry.expires > datetime.datetime.now())
+
+
+class MapIncidentsTest(TestCase):
+    def test_only_incidents_in_bbox_and_time_frame(self):
+        inside = make_incident(latitude='39.7447', longitude='-75.5484')
+        make_incident(latitude='39.1582', longitude='-75.5244')  # Dover
+        make_incident(inc_date=datetime.date.today() - datetime.timedelta(days=60))
+        self.assertEqual(inside.geohash, geohash_encode(39.7447, -75.5484))
+
+        url = reverse('myproject.crime.views.map_incidents')
+        response = self.client.get(url, {'bbox': '-75.6,39.7,-75.5,39.8', 'time_frame': 'week'})
+        data = simplejson.loads(response.content)
+        self.assertEqual([row['id'] for row in data['incidents']], [inside.id])
+        self.assertEqual(data['incidents'][0]['lat'], 39.7447)
+
+        self.assertEqual(self.client.get(url, {'bbox': 'everywhere'}).status_code, 400)
+
+
+class MapTileTest(TestCase):
+    def test_clusters_counted_and_invalidated(self):
+        make_incident(is_homicide=True)
+        make_incident(inc_type='ST')
+        zoom = 10
+        x, y = latlng_to_tile(39.7447, -75.5484, zoom)
+        url = reverse('myproject.crime.views.map_tile', kwargs={'zoom': zoom, 'x': x, 'y': y})
+
+        cluster, = simplejson.loads(self.client.get(url).content)['clusters']
+        self.assertEqual((cluster['count'], cluster['homicides']), (2, 1))
+        self.assertEqual(cluster['types'], {'SH': 1, 'ST': 1})
+
+        make_incident()
+        cluster, = simplejson.loads(self.client.get(url).content)['clusters']
+        self.assertEqual(cluster['count'], 3)
+
+    def test_tile_bounds_contain_point(self):
+        x, y = latlng_to_tile(39.7447, -75.5484, 14)
+        west, south, east, north = tile_bounds(14, x, y)
+        self.assertTrue(west <= -75.5484 < east and south <= 39.7447 < north)
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.market = make_incident(headline='Man shot on Market Street', summary='Police found a man wounded.')
+        self.kirkwood = make_incident(headline='Teen stabbed in Hilltop', summary='Near Market Street.')
+        self.kirkwood.victims.add(make_victim('Kirkwood', first_name='Andre'))
+
+    def test_ranked_by_field_weight(self):
+        self.assertEqual(search('market street'), [self.market.id, self.kirkwood.id])
+        self.assertEqual(search('market hilltop'), [self.kirkwood.id])
+        self.assertEqual(search('the'), [])
+
+    def test_victim_names_and_prefixes(self):
+        self.assertEqual(search('andre kirkwood'), [self.kirkwood.id])
+        self.assertEqual(search('kirk'), [])
+        self.assertEqual(search('kirk', prefix=True), [self.kirkwood.id])
+
+    def test_index_follows_people_edits(self):
+        victim = self.kirkwood.victims.get()
+        victim.last_name = 'Smith'
+        victim.save()
+        self.assertEqual(search('kirkwood'), [])
+        self.assertEqual(search('smith'), [self.kirkwood.id])
+        victim.delete()
+        self.assertEqual(search('smith'), [])
+
+    def test_search_page(self):
+        url = reverse('myproject.crime.views.search_page')
+        response = self.client.get(url, {'query': 'Market'})
+        self.assertEqual(list(response.context['details'].object_list), [self.market, self.kirkwood])
+
+
+class SearchTransactionTest(TransactionTestCase):
+    def test_index_rolls_back_with_the_save(self):
+        try:
+            with transaction.commit_on_success():
+                make_incident()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(Incident.objects.count(), 0)
+        self.assertEqual(search('market'), [])
+
+
+class IncidentQuerySetTest(TestCase):
+    def setUp(self):
+        today = datetime.date.today()
+        for days, time in ((0, None), (0, datetime.time(22, 15)), (0, datetime.time(9)),
+                (1, None), (1, None), (1, datetime.time(1, 30)), (40, datetime.time(12)),
+                (400, None)):
+            make_incident(inc_date=today - datetime.timedelta(days=days), inc_time=time)
+
+    def test_time_frames_and_ranges(self):
+        today = datetime.date.today()
+        self.assertEqual(Incident.objects.in_time_frame('week').count(), 6)
+        self.assertEqual(Incident.objects.in_time_frame('six_months').count(), 7)
+        self.assertEqual(Incident.objects.in_time_frame('bogus').count(), 8)
+        self.assertEqual(Incident.objects.between(today - datetime.timedelta(days=40),
+            today - datetime.timedelta(days=1)).count(), 4)
+
+    def test_seek_pages_match_offset_pages(self):
+        expected = list(Incident.objects.latest_first())
+        seen, cursor = [], None
+        while True:
+            page = seek_page(Incident.objects.latest_first(), cursor, 3)
+            seen.extend(page.object_list)
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, expected)
+
+    def test_bad_cursor_starts_over(self):
+        page = seek_page(Incident.objects.latest_first(), 'not-a-cursor', 3)
+        self.assertFalse(page.has_previous())
+        self.assertEqual(page.object_list, list(Incident.objects.latest_first()[:3]))
+
+
+class PageCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.incident = make_incident()
+        # Too far away to be listed as nearby on the incident's page.
+        self.other = make_incident(headline='Woman stabbed on Fourth Street', latitude='39.7647')
+        self.url = reverse('myproject.crime.views.incident_page',
+            args=[self.incident.id, self.incident.inc_slug])
+
+    def test_cached_until_incident_changes(self):
+        self.assertTrue(self.client.get(self.url).context is not None)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertTrue(response.context is None)
+
+        self.other.headline = 'Woman stabbed on Fifth Street'
+        self.other.save()
+        self.assertTrue(self.client.get(self.url).context is None)
+
+        self.incident.headline = 'Man shot on King Street'
+        self.incident.save()
+        self.assertTrue(self.client.get(self.url).context is not None)
+
+    def test_index_follows_people_edits(self):
+        victim = make_victim('Doe')
+        self.incident.victims.add(victim)
+        index = reverse('myproject.crime.views.index')
+        self.client.get(index)
+        self.assertTrue(self.client.get(index).context is None)
+        victim.is_killed = True
+        victim.save()
+        self.assertTrue(self.client.get(index).context is not None)
+
+    def test_conditional_get(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.incident.victims.add(make_victim('Doe'))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        # Edits within the same second as Last-Modified still show.
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 200)
+
+
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    """
+    Every view must render in a fixed number of queries,
+    however many incidents, victims and suspects it lists.
+    """
+    BUDGETS = (
+        ('', {}, 6),
+        ('map/', {}, 3),
+        ('victims/', {}, 6),
+        ('suspects/', {}, 6),
+        ('search/', {'query': 'market'}, 8),
+    )
+
+    def setUp(self):
+        for i in range(12):
+            incident = make_incident(inc_date=datetime.date.today() - datetime.timedelta(days=i))
+            incident.victims.add(make_victim('Victim%d' % i), make_victim('Other%d' % i))
+            incident.suspects.add(Suspect.objects.create(first_name='Sam', last_name='Suspect%d' % i,
+                sex='M', suspect_slug='suspect-%d' % i))
+        rebuild_stats()
+
+    def test_listing_budgets(self):
+        root = reverse('myproject.crime.views.search_page')[:-len('search/')]
+        for path, params, budget in self.BUDGETS:
+            cache.clear()
+            with self.assertQueryBudget(budget):
+                self.assertEqual(self.client.get(root + path, params).status_code, 200)
+
+    def test_index_links_next_page_by_cursor(self):
+        cache.clear()
+        url = reverse('myproject.crime.views.index')
+        cursor = self.client.get(url).context['details'].next_cursor
+        details = self.client.get(url, {'after': cursor}).context['details']
+        self.assertEqual(list(details.object_list), list(Incident.objects.latest_first()[10:]))
+
+    def test_incident_page_budget(self):
+        cache.clear()
+        incident = Incident.objects.all()[0]
+        url = reverse('myproject.crime.views.incident_page', args=[incident.id, incident.inc_slug])
+        with self.assertQueryBudget(4):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.incident = make_incident(headline=u'Man shot near Caf\xe9', is_homicide=True)
+        self.incident.victims.add(make_victim('Doe', wound_location='HE', is_killed=True))
+        make_incident(latitude='', longitude='', address='')
+
+    def test_formats_use_choice_labels(self):
+        rows = list(csv.reader(''.join(export('csv', chunk_size=1)).splitlines()))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][CSV_COLUMNS.index('headline')], 'Man shot near Caf\xc3\xa9')
+        self.assertEqual(rows[1][CSV_COLUMNS.index('type')], 'Shooting')
+        self.assertEqual(rows[1][CSV_COLUMNS.index('victims')], 'Doe, John')
+
+        first = simplejson.loads(''.join(export('ndjson')).splitlines()[0])
+        self.assertEqual(first['victims'][0]['wound_location'], 'Head')
+
+        features = simplejson.loads(''.join(export('geojson')))['features']
+        self.assertEqual(features[0]['geometry']['coordinates'], [-75.5484, 39.7447])
+        self.assertEqual(features[1]['geometry'], None)
+
+    def test_gzipped_download(self):
+        url = reverse('myproject.crime.views.export_incidents', args=['ndjson'])
+        response = self.client.get(url, {'time_frame': 'week'}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        lines = zlib.decompress(response.content, zlib.MAX_WBITS | 16).splitlines()
+        self.assertEqual(len(lines), 2)
+
+
+class ImporterTest(TestCase):
+    def setUp(self):
+        self.geocoder = LocalGeocoder({
+            '800 N. French Street+Wilmington+DE': ('39.7424', '-75.5466', '800 N French St, Wilmington, DE 19801'),
+        })
+        self.existing = make_victim('Doe', vic_slug='doe-john')
+        today = datetime.date.today().isoformat()
+        self.records = list(enumerate([
+            {'headline': 'Man shot on French Street', 'date': today, 'type': 'Shooting',
+             'address': '800 N. French Street', 'victims': [{'first_name': 'John', 'last_name': 'Doe'}]},
+            {'headline': 'Second shooting on French St', 'date': today, 'type': 'SH', 'homicide': True,
+             'address': '800 North French St', 'victims': 'Doe, John; Roe, Richard', 'suspects': 'Poe, Pete'},
+            {'headline': 'Bad record', 'date': today, 'type': 'Burglary'},
+        ], 1))
+
+    def test_import_links_people_geocodes_once_and_refreshes_stats(self):
+        report = IncidentImporter(geocoder=self.geocoder, chunk_size=2, workers=1).run(self.records)
+        self.assertEqual(report.imported, 2)
+        self.assertEqual([line for line, error in report.errors], [3])
+        self.assertEqual(len(self.geocoder.calls), 1)
+
+        incidents = Incident.objects.order_by('id')
+        self.assertEqual([incident.lat for incident in incidents], [39.7424, 39.7424])
+        self.assertEqual(Victim.objects.count(), 2)
+        self.assertEqual(list(self.existing.incident_set.order_by('id')), list(incidents))
+        self.assertEqual(Suspect.objects.get().incident_set.get(), incidents[1])
+        self.assertEqual(get_aggregate_info('week')['homicide_count'], 1)
+        self.assertEqual(search('roe'), [incidents[1].id])
+        self.assertEqual([(incident.victim_count, incident.suspect_count, incident.is_suspects_unknown)
+            for incident in incidents], [(1, 0, True), (2, 1, False)])
+
+        # Creating through the ORM still works after the explicit ids.
+        make_incident()
+
+    def test_rerun_skips_imported_records(self):
+        IncidentImporter(geocoder=self.geocoder, workers=1).run(self.records)
+        report = IncidentImporter(geocoder=self.geocoder, workers=1).run(self.records)
+        self.assertEqual((report.imported, report.skipped), (0, 2))
+        self.assertEqual(Incident.objects.count(), 2)
+
+    def test_resumed_import_finishes_earlier_chunks(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        checkpoint = os.path.join(directory, 'checkpoint')
+
+        def interrupt(report):
+            raise KeyboardInterrupt
+
+        importer = IncidentImporter(geocoder=self.geocoder, chunk_size=1, workers=1,
+            checkpoint=checkpoint, progress=interrupt)
+        self.assertRaises(KeyboardInterrupt, importer.run, self.records)
+        IncidentImporter(geocoder=self.geocoder, chunk_size=1, workers=1, checkpoint=checkpoint).run(self.records)
+        incidents = list(Incident.objects.order_by('id'))
+        self.assertEqual([incident.victim_count for incident in incidents], [1, 2])
+        self.assertEqual(sorted(search('doe')), [incident.id for incident in incidents])
+        self.assertEqual(get_aggregate_info('week')['homicide_count'], 1)
+
+
+class AnalyticsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.today = datetime.date.today()
+        self.last_month = self.today.replace(day=1) - datetime.timedelta(days=1)
+        make_incident(inc_date=self.last_month, is_homicide=True, is_suspects_unknown=False)
+        make_incident(inc_date=self.last_month)
+        make_incident()
+
+    def test_monthly_series(self):
+        series = time_series('month', self.last_month)
+        self.assertEqual([bucket['total'] for bucket in series], [2, 1])
+        self.assertEqual((series[0]['homicides'], series[0]['arrests']), (1, 1))
+        self.assertEqual((series[0]['closed'], series[1]['closed']), (True, False))
+        self.assertEqual(sum(group['count'] for group in series[0]['groups']), 2)
+
+    def test_closed_buckets_follow_edits(self):
+        time_series('month', self.last_month)
+        incident = make_incident(inc_date=self.last_month)
+        self.assertEqual(time_series('month', self.last_month)[0]['total'], 3)
+        incident.delete()
+        self.assertEqual(time_series('month', self.last_month)[0]['total'], 2)
+
+    def test_age_histogram_and_endpoint(self):
+        Incident.objects.all()[0].victims.add(make_victim('Doe', age=23), make_victim('Roe', age=29))
+        self.assertEqual(age_histogram(Victim)['bins'], [{'from': 20, 'to': 29, 'count': 2}])
+
+        url = reverse('myproject.crime.views.analytics_data')
+        data = simplejson.loads(self.client.get(url, {'period': 'week', 'time_frame': 'all'}).content)
+        self.assertEqual(sum(bucket['total'] for bucket in data['series']), 3)
+        self.assertEqual(sum(row['wounded'] for row in data['wounds']), 2)
+        self.assertEqual(self.client.get(url, {'period': 'hour'}).status_code, 400)
+
+    def test_endpoint_with_dates_follows_older_edits(self):
+        url = reverse('myproject.crime.views.analytics_data')
+        params = {'period': 'month', 'time_frame': 'week', 'start': '2010-01-01'}
+        before = simplejson.loads(self.client.get(url, params).content)
+        make_incident(inc_date=datetime.date(2010, 6, 1)).victims.add(make_victim('Doe', age=23))
+        after = simplejson.loads(self.client.get(url, params).content)
+        self.assertEqual(sum(bucket['total'] for bucket in after['series']),
+            sum(bucket['total'] for bucket in before['series']) + 1)
+        # The dates replace the time frame for the people too.
+        self.assertEqual(sum(row['wounded'] for row in after['wounds']), 1)
+        self.assertEqual(after['victim_ages']['bins'], [{'from': 20, 'to': 29, 'count': 1}])
+
+
+class ThumbnailTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage, thumbnails.default_storage = thumbnails.default_storage, FileSystemStorage(self.directory)
+        self.eager, jobs.JOBS_EAGER = jobs.JOBS_EAGER, True
+        photo = thumbnails.StringIO()
+        thumbnails.Image.new('RGB', (600, 900), 'white').save(photo, 'JPEG')
+        thumbnails.default_storage.save('victim_photos/doe.jpg', ContentFile(photo.getvalue()))
+
+    def tearDown(self):
+        thumbnails.default_storage, jobs.JOBS_EAGER = self.storage, self.eager
+        shutil.rmtree(self.directory)
+
+    def test_variants_follow_cropping(self):
+        victim = make_victim('Doe', victim_photo='victim_photos/doe.jpg', cropping='0,0,300,400')
+        variants = thumbnails.get_variants(victim)
+        self.assertEqual([variant['width'] for variant in variants], [75, 150, 300])
+        old_names = set(Thumbnail.objects.values_list('image', flat=True))
+
+        victim.cropping = '0,100,300,500'
+        victim.save()
+        self.assertEqual(Thumbnail.objects.filter(cropping='0,0,300,400').count(), 0)
+        self.assertEqual(Thumbnail.objects.count(), 3)
+        self.assertFalse(any(thumbnails.default_storage.exists(name) for name in old_names
+            if not Thumbnail.objects.filter(image=name).exists()))
+
+    def test_pages_follow_rendered_variants(self):
+        cache.clear()
+        jobs.JOBS_EAGER = False
+        victim = make_victim('Doe', victim_photo='victim_photos/doe.jpg', cropping='0,0,300,400')
+        incident = make_incident()
+        incident.victims.add(victim)
+        self.assertEqual(thumbnails.get_variants(victim), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(thumbnails.get_variants(victim), [])
+
+        url = reverse('myproject.crime.views.incident_page', args=[incident.id, incident.inc_slug])
+        self.client.get(url)
+        self.assertTrue(self.client.get(url).context is None)
+        thumbnails.update_photo(thumbnails.photo_state(victim))
+        self.assertTrue(self.client.get(url).context is not None)
+        self.assertEqual(len(thumbnails.get_variants(victim)), 3)
+
+
+FLAKY_CALLS = []
+
+
+def flaky_task(failures):
+    """
+    Job that fails the first `failures` times it runs.
+    """
+    FLAKY_CALLS.append(failures)
+    if len(FLAKY_CALLS) <= failures:
+        raise IOError('service unavailable')
+
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        del FLAKY_CALLS[:]
+
+    def test_keys_make_enqueue_idempotent(self):
+        jobs.enqueue('myproject.crime.tests.flaky_task', 0)
+        jobs.enqueue('myproject.crime.tests.flaky_task', 0)
+        self.assertEqual(Job.objects.count(), 1)
+        self.assertTrue(jobs.run(jobs.claim('test')))
+        self.assertEqual(Job.objects.get().status, 'DO')
+        self.assertEqual(jobs.claim('test'), None)
+
+    def test_failures_back_off_then_give_up(self):
+        jobs.enqueue('myproject.crime.tests.flaky_task', 10)
+        job = jobs.claim('test')
+        self.assertFalse(jobs.run(job))
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), ('QU', 1))
+        self.assertTrue(job.run_after > datetime.datetime.now())
+        self.assertEqual(jobs.claim('test'), None)
+
+        yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
+        Job.objects.update(run_after=datetime.datetime.now(), attempts=job.max_attempts - 1, updated=yesterday)
+        self.assertFalse(jobs.run(jobs.claim('test')))
+        self.assertEqual(Job.objects.get().status, 'FA')
+        self.assertEqual(jobs.status()['counts']['failed'], 1)
+        self.assertTrue(Job.objects.get().updated > yesterday + datetime.timedelta(hours=1))
+
+    def test_save_queues_geocoding(self):
+        set_geocoder(LocalGeocoder({
+            '800 N. French Street+Wilmington+DE': ('39.7424', '-75.5466', '800 N French St, Wilmington, DE 19801'),
+        }))
+        try:
+            incident = make_incident(latitude='', longitude='', address='800 N. French Street')
+            make_incident(latitude='', longitude='', address='800 N. French Street')
+            self.assertEqual(Job.objects.get().key, 'geocode')
+            jobs.run(jobs.claim('test'))
+        finally:
+            set_geocoder(None)
+        self.assertEqual(Incident.objects.get(pk=incident.pk).lat, 39.7424)
+
+
+class BenchmarkTest(TestCase):
+    def test_synthetic_archive_is_seeded(self):
+        first = list(synthetic.generate_records(20, seed=3))
+        self.assertEqual(first, list(synthetic.generate_records(20, seed=3)))
+        self.assertNotEqual(first, list(synthetic.generate_records(20, seed=4)))
+
+        report = synthetic.build_archive(40, seed=3)
+        self.assertEqual((report.imported, report.errors), (40, []))
+        self.assertTrue(Victim.objects.count() > 0)
+
+    def test_run_and_compare(self):
+        synthetic.build_archive(30)
+        results = benchmark.run(repeat=2, views=['index', 'incident_page'])
+        self.assertEqual(sorted(results['views']), ['incident_page', 'index'])
+        self.assertTrue(results['views']['index']['warm']['queries'] <
+            results['views']['index']['cold']['queries'])
+
+        self.assertEqual(benchmark.compare(results, results), [])
+        slower = simplejson.loads(simplejson.dumps(results))
+        slower['views']['index']['cold']['p95_ms'] = results['views']['index']['cold']['p95_ms'] * 2 + 1
+        self.assertEqual(len(benchmark.compare(slower, results)), 1)
+        self.assertEqual(benchmark.percentile([4, 1, 3, 2], 0.5), 2)
+
+
+@override_settings(MIDDLEWARE_CLASSES=tuple(settings.MIDDLEWARE_CLASSES) +
+    ('myproject.crime.instrumentation.InstrumentationMiddleware',))
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        instrumentation.reset()
+        make_incident()
+
+    def tearDown(self):
+        instrumentation.METRICS_TOKEN = None
+
+    def test_views_and_caches_are_recorded(self):
+        url = reverse('myproject.crime.views.index')
+        self.client.get(url)
+        self.client.get(url)
+        snapshot = instrumentation.snapshot()
+        self.assertEqual(snapshot['views']['views.index']['requests'], 2)
+        self.assertTrue(snapshot['views']['views.index']['queries_per_request'] > 0)
+        self.assertEqual(snapshot['caches']['page'], {'hit': 1, 'miss': 1})
+
+    def test_fingerprint(self):
+        self.assertEqual(instrumentation.fingerprint(
+            "SELECT * FROM crime_incident WHERE id IN (1, 2, 3) AND headline = 'it''s'"),
+            "SELECT * FROM crime_incident WHERE id IN (...) AND headline = ?")
+
+    def test_metrics_endpoint_needs_token(self):
+        url = reverse('myproject.crime.views.metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.get(reverse('myproject.crime.views.index'))
+        instrumentation.METRICS_TOKEN = 'secret'
+        self.assertEqual(self.client.get(url, {'token': 'secret'}).status_code, 403)
+        response = self.client.get(url, {'format': 'prometheus'}, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('crime_request_duration_ms_count{view="views.index"} 1' in response.content)
+
+
+class ApiTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        today = datetime.date.today()
+        self.incidents = [make_incident(inc_date=today - datetime.timedelta(days=i), is_homicide=i == 1)
+            for i in range(5)]
+        self.incidents[0].victims.add(make_victim('Doe'), make_victim('Roe'))
+        self.url = reverse('myproject.crime.views.api_incidents')
+
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        return response, simplejson.loads(response.content)
+
+    def test_sparse_fields_embed_and_cursor(self):
+        with self.assertQueryBudget(3):
+            response, data = self.get(self.url, fields='id,date,victims', embed='victims', limit='3')
+        self.assertEqual(sorted(data['data'][0]), ['date', 'id', 'victims'])
+        self.assertEqual([victim['last_name'] for victim in data['data'][0]['victims']], ['Doe', 'Roe'])
+        self.assertEqual(data['data'][1]['victims'], [])
+
+        response, rest = self.get(self.url, fields='id', limit='3', after=data['next'])
+        ids = [row['id'] for row in data['data'] + rest['data']]
+        self.assertEqual(ids, [incident.id for incident in self.incidents])
+        self.assertEqual(rest['next'], None)
+
+    def test_filters_errors_and_etag(self):
+        response, data = self.get(self.url, is_homicide='true', fields='id')
+        self.assertEqual(data['data'], [{'id': self.incidents[1].id}])
+        self.assertEqual(self.get(self.url, fields='password')[0].status_code, 400)
+        self.assertEqual(self.get(self.url, inc_type='XX')[0].status_code, 400)
+
+        params = {'is_homicide': 'true', 'fields': 'id'}
+        again = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+
+    def test_people(self):
+        url = reverse('myproject.crime.views.api_people', args=['victims'])
+        response, data = self.get(url, fields='last_name,incidents')
+        self.assertEqual(data['data'], [
+            {'last_name': 'Roe', 'incidents': [self.incidents[0].id]},
+            {'last_name': 'Doe', 'incidents': [self.incidents[0].id]},
+        ])
+
+
+class AdminTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        User.objects.create_superuser('editor', 'editor@example.com', 'secret')
+        self.client.login(username='editor', password='secret')
+        rebuild_stats()
+        self.incidents = [make_incident(), make_incident(is_suspects_unknown=False),
+            make_incident(is_homicide=True)]
+        make_victim('Doe', first_name='Jane')
+        make_victim('Dodd')
+        make_victim('Roe')
+
+    def test_cached_counts_follow_saves(self):
+        self.assertEqual(cached_count(Incident.objects.all()), 3)
+        with self.assertQueryBudget(0):
+            self.assertEqual(cached_count(Incident.objects.all()), 3)
+        make_incident()
+        self.assertEqual(cached_count(Incident.objects.all()), 4)
+
+        response = self.client.get(reverse('admin:crime_victim_changelist'), {'q': 'do'})
+        self.assertEqual(response.context['cl'].result_count, 2)
+
+    def test_autocomplete_pages(self):
+        url = reverse('admin:crime_incident_autocomplete', args=['victims'])
+        data = simplejson.loads(self.client.get(url, {'q': 'Doe, J'}).content)
+        self.assertEqual([person['text'].split(' (')[0] for person in data['results']], ['Doe, Jane'])
+        data = simplejson.loads(self.client.get(url, {'q': 'd'}).content)
+        self.assertEqual((len(data['results']), data['more']), (2, False))
+
+    def test_mark_as_homicide_keeps_stats(self):
+        with self.assertQueryBudget(15):
+            self.client.post(reverse('admin:crime_incident_changelist'), {
+                'action': 'mark_as_homicide',
+                '_selected_action': [incident.id for incident in self.incidents],
+            })
+        self.assertEqual(Incident.objects.filter(is_homicide=True).count(), 3)
+        before = get_aggregate_info('all')
+        rebuild_stats()
+        self.assertEqual(get_aggregate_info('all'), before)
+        self.assertEqual(before['homicide_count'], 3)
+
+
+class CounterTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        rebuild_stats()
+        self.incident = make_incident(is_suspects_unknown=True)
+
+    def test_counters_follow_people(self):
+        killed = make_victim('Doe', is_killed=True)
+        self.incident.victims.add(killed, make_victim('Roe', is_unidentified=True))
+        suspect = Suspect.objects.create(first_name='Sam', last_name='Smith', sex='M', suspect_slug='smith')
+        self.incident.suspects.add(suspect)
+        incident = Incident.objects.get(pk=self.incident.pk)
+        self.assertEqual((incident.victim_count, incident.killed_count, incident.suspect_count), (2, 1, 1))
+        self.assertEqual((incident.is_victims_unknown, incident.is_suspects_unknown), (False, False))
+        self.assertEqual(get_aggregate_info('all')['tot_arrest_count'], 1)
+
+        killed.is_killed = False
+        killed.save()
+        suspect.delete()
+        incident = Incident.objects.get(pk=self.incident.pk)
+        self.assertEqual((incident.killed_count, incident.suspect_count, incident.is_suspects_unknown), (0, 0, True))
+        self.assertEqual(get_aggregate_info('all')['tot_arrest_count'], 0)
+
+    def test_filtered_counts_follow_counters(self):
+        identified = Incident.objects.filter(is_victims_unknown=False)
+        self.assertEqual(cached_count(identified), 0)
+        self.incident.victims.add(make_victim('Doe'))
+        self.assertEqual(cached_count(identified), 1)
+
+    def test_verify_and_repair(self):
+        self.incident.victims.add(make_victim('Doe'))
+        Incident.objects.filter(pk=self.incident.pk).update(victim_count=5)
+        with self.assertQueryBudget(4):
+            self.assertEqual(len(counters.verify_counters()), 1)
+        counters.verify_counters(repair=True)
+        self.assertEqual(Incident.objects.get(pk=self.incident.pk).victim_count, 1)
+        self.assertEqual(counters.verify_counters(), [])
+
+
+class NearbyTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.today = datetime.date.today()
+        self.center = make_incident()
+        # About 110 m, 330 m and 2.2 km north, and one close by but a year earlier.
+        self.close = make_incident(latitude='39.7457')
+        self.blocks = make_incident(latitude='39.7477')
+        self.far = make_incident(latitude='39.7647')
+        self.old = make_incident(latitude='39.7448', inc_date=self.today - datetime.timedelta(days=365))
+
+    def test_haversine_and_cells(self):
+        self.assertAlmostEqual(haversine(39.7447, -75.5484, 39.7457, -75.5484), 111.2, 1)
+        cells = cells_covering(39.7447, -75.5484, 400)
+        self.assertEqual(len(cells), 9)
+        self.assertTrue(geohash_encode(39.7477, -75.5484).startswith(tuple(cells)))
+
+    def test_within_and_nearest_match_brute_force(self):
+        start = self.today - datetime.timedelta(days=90)
+        with self.assertQueryBudget(1):
+            rows = nearby.within(self.center.lat, self.center.lng, 400, start, exclude=self.center.id)
+        self.assertEqual([row['id'] for row in rows], [self.close.id, self.blocks.id])
+        rows = nearby.nearest(self.center.lat, self.center.lng, 3, exclude=self.center.id)
+        self.assertEqual([row['id'] for row in rows], [self.old.id, self.close.id, self.blocks.id])
+        self.assertEqual(rows, nearby.brute_force(self.center.lat, self.center.lng, k=3, exclude=self.center.id))
+        self.assertEqual([row['id'] for row in nearby.near_incident(self.center)], [self.close.id, self.blocks.id])
+
+    def test_endpoint(self):
+        url = reverse('myproject.crime.views.nearby_incidents')
+        data = simplejson.loads(self.client.get(url, {'id': self.center.id, 'k': '1'}).content)
+        self.assertEqual([incident['id'] for incident in data['incidents']], [self.old.id])
+        data = simplejson.loads(self.client.get(url, {'id': self.center.id, 'days': '30', 'radius': '3000'}).content)
+        self.assertEqual([incident['distance'] for incident in data['incidents']], [111, 334, 2224])
+        self.assertEqual(self.client.get(url, {'lat': 'north'}).status_code, 400)
+
+    def test_benchmark_agrees_with_brute_force(self):
+        synthetic.build_archive(60, seed=5)
+        results = benchmark.nearby_queries(samples=5, radius=1000, days=365)
+        self.assertEqual(sorted(results), ['nearest', 'nearest_brute_force', 'within', 'within_brute_force'])
+
+
+@unittest.skipUnless(heatmap.available(), 'NumPy is not installed')
+class HeatmapTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        make_incident()
+        make_incident(latitude='39.7457', is_homicide=True)
+
+    def test_density_integrates_to_incident_count(self):
+        grid, values, count = heatmap.get_density(heatmap.Filters())
+        self.assertEqual(count, 2)
+        self.assertEqual(values.shape, (grid.rows, grid.cols))
+        self.assertAlmostEqual(float(values.sum()) * (grid.cell_size / 1000.0) ** 2, 2, 3)
+        grid, values, count = heatmap.get_density(heatmap.Filters(is_homicide=True))
+        self.assertEqual(count, 1)
+
+    def test_new_incidents_are_added_to_cached_grid(self):
+        filters = heatmap.Filters()
+        before = heatmap.get_density(filters)[1]
+        make_incident(latitude='39.7500')
+        with self.assertQueryBudget(1):
+            grid, values, count = heatmap.get_density(filters)
+        self.assertEqual(count, 3)
+        self.assertTrue(values.sum() > before.sum())
+
+        Incident.objects.all()[0].delete()
+        self.assertEqual(heatmap.get_density(filters)[2], 2)
+
+    def test_incidents_committed_out_of_id_order_are_added(self):
+        filters = heatmap.Filters()
+        heatmap.get_density(filters)
+        last_id = Incident.objects.order_by('-id')[0].id
+        make_incident(id=last_id + 10, latitude='39.7500')
+        self.assertEqual(heatmap.get_density(filters)[2], 3)
+        # Its id was handed out first, but it was saved after the grid read.
+        make_incident(id=last_id + 5, latitude='39.7510')
+        self.assertEqual(heatmap.get_density(filters)[2], 4)
+        self.assertEqual(heatmap.get_density(filters)[2], 4)
+
+    def test_endpoints(self):
+        url = reverse('myproject.crime.views.map_heatmap')
+        meta = simplejson.loads(self.client.get(url, {'cell': '200', 'bandwidth': '400'}).content)
+        self.assertEqual(meta['incidents'], 2)
+        response = self.client.get(url[:-len('.json')] + '/0/0.bin', {'cell': '200', 'bandwidth': '400'})
+        rows, cols = [int(part) for part in response['X-Heatmap-Shape'].split(',')]
+        self.assertEqual(len(response.content), rows * cols)
+        tile = simplejson.loads(self.client.get(url[:-len('.json')] + '/0/0.json').content)
+        self.assertEqual(len(tile['values']), heatmap.TILE_CELLS)
+        self.assertEqual(self.client.get(url, {'cell': '5'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'cell': '25'}).status_code, 400)
+
+
+class BakeTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        rebuild_stats()
+        self.output = tempfile.mkdtemp()
+        self.incident = make_incident()
+        # Too far away to be listed as nearby on the other's page.
+        self.other = make_incident(latitude='39.7647', inc_slug='man-shot-on-king-street')
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def incident_file(self, incident):
+        return os.path.join(self.output, incident.get_absolute_url().strip('/'), 'index.html')
+
+    def test_bake_renders_only_stale_pages(self):
+        report = bake.bake(self.output, workers=1)
+        self.assertEqual(report.errors, [])
+        self.assertEqual(report.rendered, report.pages)
+        self.assertTrue(os.path.exists(self.incident_file(self.incident)))
+        index = reverse('myproject.crime.views.index').strip('/')
+        self.assertTrue(os.path.exists(os.path.join(self.output, index, 'index.time_frame=week.html')))
+        self.assertEqual(bake.bake(self.output, workers=1).rendered, 0)
+
+        # A new headline changes the incident's page and the incident listings, nothing else.
+        self.incident.headline = 'Man shot on Market Street, dies'
+        self.incident.save()
+        stale = [page for page in bake.site_pages() if 'incident:%s' % self.incident.id in page.scopes or
+            any(scope.startswith('incidents:') for scope in page.scopes)]
+        report = bake.bake(self.output, workers=1)
+        self.assertEqual(report.rendered, len(stale))
+        self.assertTrue('dies' in open(self.incident_file(self.incident)).read())
+
+        self.other.delete()
+        report = bake.bake(self.output, workers=1)
+        self.assertEqual(report.removed, 1)
+        self.assertFalse(os.path.exists(self.incident_file(self.other)))
+
+    def test_failed_page_loses_its_file(self):
+        bake.bake(self.output, workers=1)
+        filename = self.incident_file(self.incident)[len(self.output) + 1:]
+        url = reverse('myproject.crime.views.incident_page', args=[self.incident.id, self.incident.inc_slug])
+        Incident.objects.filter(id=self.incident.id).delete()
+        self.assertEqual(bake.render_page((url, {}, filename, self.output)), (filename, 404, None))
+        self.assertFalse(os.path.exists(self.incident_file(self.incident)))
+
+
+def make_suspect(first_name, last_name, **kwargs):
+    values = {
+        'first_name': first_name,
+        'last_name': last_name,
+        'sex': 'M',
+        'suspect_slug': ('%s-%s' % (last_name, first_name)).lower(),
+    }
+    values.update(kwargs)
+    return Suspect.objects.create(**values)
+
+
+class MatchingTest(QueryBudgetMixin, TestCase):
+    def test_keys_and_similarity(self):
+        self.assertEqual((soundex('Robert'), soundex('Rupert'), soundex('Ashcraft')), ('R163', 'R163', 'A261'))
+        self.assertEqual(person_match_key('John', "O'Willson", 'M'), 'O425JM')
+        self.assertEqual(make_suspect('Marcus', 'Willson').match_key, make_suspect('Mark', 'Wilson').match_key)
+        self.assertAlmostEqual(matching.jaro_winkler('MARTHA', 'MARHTA'), 0.9611, 4)
+        self.assertAlmostEqual(matching.jaro_winkler('DWAYNE', 'DUANE'), 0.84, 4)
+
+    def test_propose_and_merge(self):
+        rebuild_stats()
+        first, second = make_incident(), make_incident(inc_slug='second')
+        wilson = make_suspect('Marcus', 'Wilson', age=24)
+        willson = make_suspect('Marcus', 'Willson', age=25, about='Arrested on King Street.')
+        make_suspect('Marcus', 'Wilson', age=40)
+        make_suspect('Maria', 'Wilson', sex='F', age=24)
+        first.suspects.add(wilson, willson)
+        second.suspects.add(willson)
+
+        with self.assertQueryBudget(1):
+            matches = matching.propose_matches(Suspect)
+        self.assertEqual([(match.keep['id'], match.other['id']) for match in matches], [(wilson.id, willson.id)])
+
+        groups = matching.group_matches(matches)
+        self.assertEqual(matching.merge_people(Suspect, groups), [first.id, second.id])
+        self.assertFalse(Suspect.objects.filter(id=willson.id).exists())
+        self.assertEqual(list(second.suspects.all()), [wilson])
+        self.assertEqual(Incident.objects.get(pk=first.pk).suspect_count, 1)
+        self.assertEqual(Suspect.objects.get(id=wilson.id).about, 'Arrested on King Street.')
+        self.assertEqual(search('willson'), [])
+        self.assertEqual(matching.propose_matches(Suspect), [])
+
+    def test_merged_victim_keeps_death(self):
+        rebuild_stats()
+        wounded, killed = make_victim('Wilson', age=24), make_victim('Wilson', age=24, is_killed=True, wound_location='HE')
+        make_incident(inc_date=datetime.date.today() - datetime.timedelta(days=60)).victims.add(wounded)
+        later = make_incident(inc_slug='later')
+        later.victims.add(killed)
+
+        groups = matching.group_matches(matching.propose_matches(Victim))
+        self.assertEqual(groups, [(wounded.id, [killed.id])])
+        matching.merge_people(Victim, groups)
+        victim = Victim.objects.get(id=wounded.id)
+        self.assertEqual((victim.is_killed, victim.wound_location), (True, 'HE'))
+        self.assertEqual(Incident.objects.get(pk=later.pk).killed_count, 1)
+
+    def test_killed_victim_is_not_matched_to_later_incident(self):
+        killed, wounded = make_victim('Wilson', age=24, is_killed=True), make_victim('Wilson', age=24)
+        make_incident(inc_date=datetime.date.today() - datetime.timedelta(days=60)).victims.add(killed)
+        make_incident(inc_slug='later').victims.add(wounded)
+        self.assertEqual(matching.propose_matches(Victim), [])
+
+    def test_groups_check_each_member_against_the_person_kept(self):
+        today = datetime.date.today()
+        row = {'first_name': 'John', 'last_name': 'Wilson', 'first': 'JOHN', 'last': 'WILSON', 'age': 24}
+        killed = dict(row, id=1, is_killed=True, last_date=today - datetime.timedelta(days=60))
+        unknown = dict(row, id=2, is_killed=False, last_date=None)
+        later = dict(row, id=3, is_killed=False, last_date=today)
+        matches = [matching.Match(1.0, killed, unknown), matching.Match(1.0, unknown, later)]
+        self.assertEqual(matching.group_matches(matches), [(1, [2])])
+
+    def test_benchmark_blocks_most_pairs(self):
+        results = benchmark.person_matching(300, seed=0)
+        self.assertTrue(results['comparisons'] < results['all_pairs'] / 100)
+        self.assertTrue(results['blocked_recall'] > 0.8)
+        self.assertTrue(results['recall'] <= results['blocked_recall'])
+        self.assertTrue(results['precision'] > 0.9)
+
+
+class AssetBundleTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, content in (
+                ('css/site.css', '/* site */\n.logo {\n  background: url("../img/logo.png");\n}\n'),
+                ('js/a.js', 'var a = 1'),
+                ('js/b.js', 'var b = 2;')):
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+        self.bundles = {'page': {'css': ['css/site.css'], 'js': ['js/a.js', 'js/b.js']}}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_build_fingerprints_and_compresses(self):
+        manifest = assets.build(self.bundles, self.directory)
+        css_path = os.path.join(self.directory, manifest['page.css'])
+        self.assertTrue(manifest['page.css'].startswith('bundles/page.'))
+        self.assertEqual(open(css_path).read(), '.logo{background:url(../img/logo.png)}\n')
+        self.assertEqual(gzip.open(css_path + '.gz').read(), open(css_path).read())
+        self.assertEqual(assets.bundle_paths('page', 'js', self.directory), [manifest['page.js']])
+
+        # A changed file gets a new name; the previous build's stays for one more build.
+        with open(os.path.join(self.directory, 'js/b.js'), 'w') as f:
+            f.write('var b = 3;')
+        second = assets.build(self.bundles, self.directory)
+        self.assertNotEqual(second['page.js'], manifest['page.js'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, manifest['page.js'])))
+        assets.build(self.bundles, self.directory)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, manifest['page.js'])))
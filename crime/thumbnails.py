@@ -0,0 +1,190 @@
+"""
+Precomputed thumbnails for victim and suspect photos.
+
+When a photo or its cropping changes, a job is queued (see jobs.py)
+that renders the crop at every size in THUMBNAIL_SIZES, outside the
+admin request and page renders, and saves it under a name made from
+a hash of the image data, so the files never change and can be served
+with far-future cache headers. Thumbnail rows record which variants
+belong to which photo and cropping; variants for an old cropping are
+deleted once the new ones exist. The {% crimephoto %} tag reads the
+variants to emit width, height and srcset.
+"""
+import hashlib
+import os
+from cStringIO import StringIO
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from myproject.crime import caching, jobs
+from myproject.crime.models import Incident, Suspect, Thumbnail, Victim
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+# Settings, with their defaults. Sizes keep the 3:4 ratio of the cropping fields.
+THUMBNAIL_SIZES = getattr(settings, 'CRIME_THUMBNAIL_SIZES', ((75, 100), (150, 200), (300, 400)))
+THUMBNAIL_QUALITY = getattr(settings, 'CRIME_THUMBNAIL_QUALITY', 85)
+VARIANTS_TIMEOUT = 60 * 60 * 24
+
+
+PERSON_MODELS = {'victim': Victim, 'suspect': Suspect}
+
+
+def photo_field(person):
+    """
+    Returns the name of the photo field of a Victim or Suspect.
+    """
+    if isinstance(person, Victim) or person is Victim:
+        return 'victim_photo'
+    return 'suspect_photo'
+
+
+def photo_state(person):
+    """
+    Returns the (photo file name, cropping) pair thumbnails depend on.
+    """
+    photo = getattr(person, photo_field(person))
+    return (photo.name if photo else ''), (person.cropping or '')
+
+
+def _crop_box(cropping, image, ratio):
+    """
+    Parses an "x1,y1,x2,y2" cropping. Without one, crops the
+    largest centered box with the thumbnails' aspect ratio.
+    """
+    try:
+        box = tuple(int(value) for value in cropping.split(','))
+        if len(box) == 4 and box[2] > box[0] and box[3] > box[1]:
+            return box
+    except ValueError:
+        pass
+    width, height = image.size
+    if width > height * ratio:
+        crop_width = int(height * ratio)
+        left = (width - crop_width) // 2
+        return left, 0, left + crop_width, height
+    crop_height = int(width / ratio)
+    top = (height - crop_height) // 2
+    return 0, top, width, top + crop_height
+
+
+def _variants_key(source, cropping):
+    return 'crime:thumbs:%s' % hashlib.md5('%s|%s' % (source.encode('utf-8'), cropping)).hexdigest()
+
+
+def render_variants(source, cropping):
+    """
+    Renders and stores every thumbnail size for a photo and cropping.
+    Returns the Thumbnail rows, smallest first.
+    """
+    original = default_storage.open(source)
+    try:
+        image = Image.open(original)
+        image.load()
+    finally:
+        original.close()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    width, height = THUMBNAIL_SIZES[-1]
+    cropped = image.crop(_crop_box(cropping, image, float(width) / height))
+
+    directory = os.path.join(os.path.dirname(source), 'thumbs')
+    thumbnails = []
+    for width, height in THUMBNAIL_SIZES:
+        output = StringIO()
+        cropped.resize((width, height), Image.ANTIALIAS).save(
+            output, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+        data = output.getvalue()
+        name = os.path.join(directory, '%s_%dx%d.jpg' % (hashlib.sha1(data).hexdigest()[:16], width, height))
+        if not default_storage.exists(name):
+            name = default_storage.save(name, ContentFile(data))
+        thumbnail, created = Thumbnail.objects.get_or_create(
+            source=source, cropping=cropping, width=width,
+            defaults={'height': height, 'image': name})
+        if not created and thumbnail.image != name:
+            thumbnail.image = name
+            thumbnail.save()
+        thumbnails.append(thumbnail)
+    cache.delete(_variants_key(source, cropping))
+    return thumbnails
+
+
+def delete_variants(source, cropping, owner=None):
+    """
+    Deletes the stored thumbnails of a photo and cropping, unless
+    someone other than owner, a ("victim" or "suspect", pk) pair,
+    still shows the same photo with the same crop.
+    """
+    if not source:
+        return
+    for model in (Victim, Suspect):
+        others = model.objects.filter(**{photo_field(model): source, 'cropping': cropping})
+        if owner and PERSON_MODELS[owner[0]] is model:
+            others = others.exclude(pk=owner[1])
+        if others.exists():
+            return
+    stale = Thumbnail.objects.filter(source=source, cropping=cropping)
+    for name in stale.values_list('image', flat=True):
+        if not Thumbnail.objects.filter(image=name).exclude(source=source, cropping=cropping).exists():
+            default_storage.delete(name)
+    stale.delete()
+    cache.delete(_variants_key(source, cropping))
+
+
+def _photo_changed(source, cropping):
+    """
+    Drops the cached pages showing a photo with a cropping: the
+    pages of its people's incidents, and the people listings.
+    """
+    for model, listing in ((Victim, 'victims'), (Suspect, 'suspects')):
+        people = model.objects.filter(**{photo_field(model): source, 'cropping': cropping})
+        incidents = Incident.objects.filter(**{listing + '__in': people}).values_list('id', 'inc_date')
+        if incidents:
+            caching.bump(*['incident:%s' % id for id, inc_date in incidents])
+            caching.bump_frames(listing, [inc_date for id, inc_date in incidents])
+
+
+def update_photo(new_state, old_state=None, owner=None):
+    """
+    Brings the thumbnails in line with a changed photo or cropping:
+    renders the new variants, then removes the ones they replace.
+    Takes the states rather than the person, since the person may
+    have changed again by the time the job runs.
+    """
+    if new_state[0]:
+        render_variants(*new_state)
+        _photo_changed(*new_state)
+    if old_state and list(old_state) != list(new_state):
+        delete_variants(old_state[0], old_state[1], owner)
+
+
+def schedule(new_state, old_state=None, owner=None):
+    """
+    Queues update_photo() as a background job.
+    """
+    jobs.enqueue('myproject.crime.thumbnails.update_photo', new_state, old_state, owner)
+
+
+def get_variants(person):
+    """
+    Returns a list of {url, width, height} for a person's photo,
+    smallest first. Empty if they have no photo or its thumbnails
+    haven't been rendered yet.
+    """
+    source, cropping = photo_state(person)
+    if not source:
+        return []
+    key = _variants_key(source, cropping)
+    variants = cache.get(key)
+    if variants is None:
+        variants = [{
+            'url': default_storage.url(thumbnail.image),
+            'width': thumbnail.width,
+            'height': thumbnail.height,
+        } for thumbnail in Thumbnail.objects.filter(source=source, cropping=cropping).order_by('width')]
+        # An empty list is cached too; render_variants() deletes it.
+        cache.set(key, variants, VARIANTS_TIMEOUT)
+    return variants
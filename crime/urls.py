@@ -6,10 +6,26 @@ urlpatterns = patterns('myproject.crime.views',  # Common Prefix
     url(r'^$', 'index'),
     # MAP PAGE
     url(r'^map/$', 'index', {'map': True}),
+    url(r'^map/incidents.json$', 'map_incidents'),
+    url(r'^map/tiles/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+).json$', 'map_tile'),
+    url(r'^map/heatmap\.json$', 'map_heatmap'),
+    url(r'^map/heatmap/(?P<row>\d+)/(?P<col>\d+)\.(?P<format>json|bin)$', 'map_heatmap'),
+    url(r'^nearby\.json$', 'nearby_incidents'),
     # SEARCH PAGE
     url(r'^search/$', 'search_page'),
     # INCIDENT PAGE
     url(r'^(?P<Incident_id>\d+)/(?P<Incident_inc_slug>[-\w]+)/$', 'incident_page'),
+    # EXPORTS
+    url(r'^export/incidents\.(?P<format>csv|ndjson|geojson)$', 'export_incidents'),
+    # ANALYTICS
+    url(r'^analytics\.json$', 'analytics_data'),
+    # BACKGROUND JOBS
+    url(r'^jobs/status\.json$', 'jobs_status'),
+    # INSTRUMENTATION
+    url(r'^metrics$', 'metrics'),
+    # JSON API
+    url(r'^api/incidents\.json$', 'api_incidents'),
+    url(r'^api/(?P<listing>victims|suspects)\.json$', 'api_people'),
     # VICTIMS PAGE
     url(r'^victims/$', 'victims_page'),
     # SUSPECTS PAGE
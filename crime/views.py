@@ -1,60 +1,66 @@
 import datetime
-from django.db.models import Q, Avg
-from django.shortcuts import render_to_response
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connection
+from django.db.models import Q
+from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
+from django.utils.cache import patch_cache_control
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
 # from django.http import HttpResponseRedirect
+import simplejson
+from myproject.crime import analytics, api, heatmap, instrumentation, jobs, nearby
 from myproject.crime.models import Incident, Suspect, Victim
 from myproject.crime.forms import *
+from myproject.crime.caching import cache_page, frame_scope
+from myproject.crime.clustering import MAX_ZOOM, get_tile
+from myproject.crime.export import CONTENT_TYPES as EXPORT_CONTENT_TYPES, export, gzip_stream
+from myproject.crime.geo import parse_bbox
+from myproject.crime.helpers import TIME_FRAMES, get_since_date, parse_date
+from myproject.crime.pagination import encode_cursor, seek_page
+from myproject.crime.search import search
+from myproject.crime.stats import get_aggregate_info
 
 
-def _monthdelta(date, delta):
-    m, y = (date.month + delta) % 12, date.year + ((date.month) + delta - 1) // 12
-    if not m:
-        m = 12
-    d = min(date.day, [31, 29 if y % 4 == 0 and not y % 400 == 0 else 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31][m - 1])
-    return date.replace(day=d, month=m, year=y)
-
-
-def _getAggregateInfo():
-    """
-    Returns a dictionary of stats from the data,
-    including success rates and average ages.
-    """
-    homicide_count = Incident.objects.filter(is_homicide=True).count()
-    homicide_arrest_count = Incident.objects.filter(is_homicide=True, is_suspects_unknown=False).count()
-    homicide_success_rate = homicide_arrest_count * 100.00 / homicide_count
-    # Success rate for non-homicides
-    shooting_count = Incident.objects.filter(is_homicide=False).count()
-    shooting_arrest_count = Incident.objects.filter(is_homicide=False, is_suspects_unknown=False).count()
-    shooting_success_rate = shooting_arrest_count * 100.00 / shooting_count
-    # Success rate for all incidents
-    total_count = Incident.objects.all().count()
-    tot_arrest_count = Incident.objects.filter(is_suspects_unknown=False).count()
-    tot_success_rate = tot_arrest_count * 100.00 / total_count
-
-    agg_info = {
-        'sus_avg_age': Suspect.objects.all().aggregate(Avg('age')).values()[0],
-        'vic_avg_age': Victim.objects.all().aggregate(Avg('age')).values()[0],
-        'homicide_count': homicide_count,
-        'homicide_arrest_count': homicide_arrest_count,
-        'homicide_success_rate': homicide_success_rate,
-        'shooting_count': shooting_count,
-        'shooting_arrest_count': shooting_arrest_count,
-        'shooting_success_rate': shooting_success_rate,
-        'total_count': total_count,
-        'tot_arrest_count': tot_arrest_count,
-        'tot_success_rate': tot_success_rate
-    }
-    return agg_info
+# Columns the incident listings and the map show. The rest
+# (summary, numeric coordinates) stay in the database.
+LISTING_FIELDS = (
+    'headline', 'inc_slug', 'inc_date', 'inc_time', 'inc_type', 'is_homicide',
+    'is_approximate_address', 'address', 'city', 'state', 'formatted_address',
+    'latitude', 'longitude', 'victim_count', 'killed_count', 'suspect_count',
+    'is_victims_unknown', 'is_suspects_unknown',
+)
+
+
+# Rows per page of the main listing, and of the victim and suspect pages.
+INDEX_PAGE_SIZE = 10
+PEOPLE_PAGE_SIZE = 15
+
 
+# The main listing shows each incident's victims and suspects too.
+INDEX_LISTINGS = ('incidents', 'victims', 'suspects')
 
+
+def _listing_scopes(*listings):
+    """
+    Cache scopes for a listing page: its rows and the
+    sidebar stats, both for the requested time frame.
+    """
+    def scopes(request, *args, **kwargs):
+        time_frame = str(request.GET.get('time_frame'))
+        return [frame_scope(listing, time_frame) for listing in listings] + [frame_scope('stats', time_frame)]
+    return scopes
+
+
+@cache_page('index', _listing_scopes(*INDEX_LISTINGS))
 def index(request, map=False):
     """
     Main page. Includes map of incidents, headlines
     of recent incidents and photos of recent victims.
     Can be viewed at:
-        /crime/  -- MAIN (can take "page" variable for pagination)
+        /crime/  -- MAIN (can take "page" variable for pagination, or
+                    "after" with the details.next_cursor of the page before)
         /crime/map/  -- MAP
     Both returned pages accest a "time_frame" variable to limit
     the scope of the incidents. Appropriate GET values are:
@@ -64,46 +70,39 @@ def index(request, map=False):
         - six_months
         - year
     """
-    # TIME FRAME FILTER
-    today = datetime.date.today()
-    since_date = None
-
     try:
         time_frame = str(request.GET.get('time_frame'))
     except ValueError:
         time_frame = 'all'
+    since_date = get_since_date(time_frame)
+    incidents = Incident.objects.in_time_frame(time_frame).latest_first().only(*LISTING_FIELDS)
 
-    if time_frame == 'all':
-        incidents = Incident.objects.all().order_by('-inc_date')
-    elif time_frame == 'week':
-        since_date = today - datetime.timedelta(weeks=1)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date')
-    elif time_frame == 'one_month':
-        since_date = _monthdelta(today, -1)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date')
-    elif time_frame == 'six_months':
-        since_date = _monthdelta(today, -6)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date')
-    elif time_frame == 'year':
-        since_date = today.replace(year=today.year - 1)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date')
-    else:
-        incidents = Incident.objects.all().order_by('-inc_date')
-
-    agg_info = _getAggregateInfo()
+    agg_info = get_aggregate_info(time_frame)
 
     # CHECK FOR MAP, APPLY
     if not map:  # For the normal main page.
         pagination = True
-        paginator = Paginator(incidents, 10)
-        try:
-            page = int(request.GET.get('page', '1'))
-        except ValueError:
-            page = 1
-        try:
-            details = paginator.page(page)
-        except (EmptyPage, InvalidPage):
-            details = paginator.page(paginator.num_pages)
+        # Two extra queries per page load the people for every row.
+        incidents = incidents.prefetch_related('victims', 'suspects')
+        if 'after' in request.GET:
+            details = seek_page(incidents, request.GET['after'], INDEX_PAGE_SIZE)
+        else:
+            paginator = Paginator(incidents, INDEX_PAGE_SIZE)
+            try:
+                page = int(request.GET.get('page', '1'))
+            except ValueError:
+                page = 1
+            try:
+                details = paginator.page(page)
+            except (EmptyPage, InvalidPage):
+                details = paginator.page(paginator.num_pages)
+            # Lets the template link to the next page by cursor.
+            # A sliced queryset can't be indexed from the end.
+            rows = list(details.object_list)
+            details.object_list = rows
+            details.next_cursor = None
+            if details.has_next() and rows:
+                details.next_cursor = encode_cursor(rows[-1])
 
         variables = RequestContext(request, {
             'details': details,
@@ -124,42 +123,204 @@ def index(request, map=False):
         return render_to_response('crime/map.html', variables)
 
 
-def victims_page(request):
-    today = datetime.date.today()
-    since_date = None
+# Most markers the map endpoint returns for one viewport.
+MAP_MARKER_LIMIT = 2000
+
+
+@cache_page('map_incidents', _listing_scopes('incidents'))
+def map_incidents(request):
+    """
+    JSON list of the incidents inside the map viewport.
+    Can be viewed at /crime/map/incidents.json and takes:
+        - bbox: "west,south,east,north" (required)
+        - time_frame: same values as the main page
+    """
+    bbox = parse_bbox(request.GET.get('bbox'))
+    if bbox is None:
+        return HttpResponseBadRequest('bbox must be "west,south,east,north"')
+    west, south, east, north = bbox
+
+    incidents = Incident.objects.in_time_frame(str(request.GET.get('time_frame')))
+    incidents = incidents.filter(lat__range=(south, north))
+    if west <= east:
+        incidents = incidents.filter(lng__range=(west, east))
+    else:  # The box crosses the antimeridian.
+        incidents = incidents.filter(Q(lng__gte=west) | Q(lng__lte=east))
+    rows = list(incidents.latest_first().values(
+        'id', 'inc_slug', 'headline', 'inc_date', 'inc_type', 'is_homicide', 'lat', 'lng'
+    )[:MAP_MARKER_LIMIT + 1])
+
+    data = {
+        'truncated': len(rows) > MAP_MARKER_LIMIT,
+        'incidents': [_marker(row) for row in rows[:MAP_MARKER_LIMIT]],
+    }
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
 
+def _marker(row):
+    """
+    An incident's values() row as the map and nearby endpoints send it.
+    """
+    marker = {
+        'id': row['id'],
+        'url': Incident(id=row['id'], inc_slug=row['inc_slug']).get_absolute_url(),
+        'headline': row['headline'],
+        'date': row['inc_date'].isoformat(),
+        'type': row['inc_type'],
+        'homicide': row['is_homicide'],
+        'lat': row['lat'],
+        'lng': row['lng'],
+    }
+    if 'distance' in row:
+        marker['distance'] = int(round(row['distance']))
+    return marker
+
+
+def _heatmap_filters(GET):
+    """
+    Reads the heatmap parameters into heatmap.Filters;
+    raises ValueError for bad ones.
+    """
+    inc_types = [code for code in GET.get('inc_type', '').split(',') if code]
+    is_homicide = {'': None, 'true': True, 'false': False}[GET.get('is_homicide', '')]
+    cell_size = int(GET.get('cell', heatmap.CELL_SIZE))
+    bandwidth = int(GET.get('bandwidth', heatmap.BANDWIDTH))
+    if not heatmap.MIN_CELL_SIZE <= cell_size <= heatmap.MAX_CELL_SIZE:
+        raise ValueError('cell must be %d to %d meters' % (heatmap.MIN_CELL_SIZE, heatmap.MAX_CELL_SIZE))
+    if not cell_size <= bandwidth <= heatmap.MAX_BANDWIDTH:
+        raise ValueError('bandwidth must be from the cell size to %d meters' % heatmap.MAX_BANDWIDTH)
+    if heatmap.Grid(cell_size).nbytes > heatmap.MAX_GRID_BYTES:
+        raise ValueError('cell is too small for the heatmap area')
+    return heatmap.Filters(str(GET.get('time_frame')), _parse_date(GET.get('start')),
+        _parse_date(GET.get('end')), inc_types, is_homicide, cell_size, bandwidth)
+
+
+def map_heatmap(request, row=None, col=None, format='json'):
+    """
+    Incident density for a heatmap overlay on the map, in incidents
+    per square kilometer over a grid of square cells.
+    /crime/map/heatmap.json describes the grid: its bounds, size,
+    the highest density and how many tiles of cells it's split into.
+    /crime/map/heatmap/<ROW>/<COL>.json is one tile's densities, rows
+    north to south; .bin is the same as bytes (0-255) to multiply by
+    the grid's "scale", with the tile's shape and bounds in headers.
+    All take:
+        - time_frame, start, end: same as the main page
+        - inc_type: comma-separated type codes
+        - is_homicide: true or false
+        - cell, bandwidth: cell width and kernel bandwidth in meters
+    """
+    if not heatmap.available():
+        return HttpResponse('The heatmap needs NumPy installed.', status=501)
+    try:
+        filters = _heatmap_filters(request.GET)
+    except (KeyError, ValueError) as e:
+        return HttpResponseBadRequest('Bad heatmap parameters: %s' % e)
+    grid, values, count = heatmap.get_density(filters)
+    peak = float(values.max()) if values.size else 0.0
+    scale = peak / 255 or 1.0
+
+    if row is None:
+        tile_rows, tile_cols = grid.tile_counts()
+        data = {
+            'bounds': grid.bounds,
+            'cell': grid.cell_size,
+            'bandwidth': filters.bandwidth,
+            'rows': grid.rows,
+            'cols': grid.cols,
+            'tile_cells': heatmap.TILE_CELLS,
+            'tile_rows': tile_rows,
+            'tile_cols': tile_cols,
+            'incidents': count,
+            'max': round(peak, 3),
+            'scale': scale,
+        }
+        return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
+    row, col = int(row), int(col)
+    tile_rows, tile_cols = grid.tile_counts()
+    if row >= tile_rows or col >= tile_cols:
+        raise Http404
+    cells = heatmap.tile(grid, values, row, col)
+    if format == 'bin':
+        quantized = (cells / scale).round().clip(0, 255).astype('uint8')
+        response = HttpResponse(quantized.tostring(), content_type='application/octet-stream')
+        response['X-Heatmap-Shape'] = '%d,%d' % cells.shape
+        response['X-Heatmap-Scale'] = repr(scale)
+        response['X-Heatmap-Bounds'] = ','.join(repr(value) for value in grid.tile_bounds(row, col))
+        return response
+    data = {
+        'row': row,
+        'col': col,
+        'bounds': grid.tile_bounds(row, col),
+        'values': [[round(float(value), 3) for value in line] for line in cells],
+    }
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
+
+def map_tile(request, zoom, x, y):
+    """
+    Clustered incidents for one map tile.
+    Can be viewed at /crime/map/tiles/<Z>/<X>/<Y>.json
+    and takes the same "time_frame" values as the main page.
+    """
+    zoom, x, y = int(zoom), int(x), int(y)
+    if zoom > MAX_ZOOM or x >= 2 ** zoom or y >= 2 ** zoom:
+        raise Http404
+    tile = get_tile(zoom, x, y, str(request.GET.get('time_frame')))
+    response = HttpResponse(simplejson.dumps(tile, separators=(',', ':')), mimetype='application/json')
+    patch_cache_control(response, public=True, max_age=300)
+    return response
+
+
+# The latest of a column over a person's incidents; "i" and "l"
+# alias the incident and link tables.
+LATEST_INCIDENT_SQL = (
+    'SELECT MAX(%(i)s.%(column)s) FROM %(incident)s %(i)s INNER JOIN %(link)s %(l)s '
+    'ON %(l)s.incident_id = %(i)s.id WHERE %(l)s.%(person_column)s = %(person)s.id')
+
+
+def by_latest_incident(people, since_date=None):
+    """
+    Limits people to those with an incident on or after since_date,
+    each once, with the date and time of their latest incident as
+    latest_date and latest_time. latest_time is the time of an
+    incident on latest_date, not the latest time of any incident.
+    """
+    model = people.model
+    field = model._meta.module_name
+    through = getattr(Incident, field + 's').through
+    links = through.objects.all()
+    if since_date:
+        links = links.filter(incident__inc_date__gte=since_date)
+    qn = connection.ops.quote_name
+    names = {
+        'incident': qn(Incident._meta.db_table),
+        'link': qn(through._meta.db_table),
+        'person_column': qn(through._meta.get_field(field).column),
+        'person': qn(model._meta.db_table),
+    }
+    latest_date = LATEST_INCIDENT_SQL % dict(names, column='inc_date', i='i', l='l')
+    latest_time = '%s AND i.inc_date = (%s)' % (LATEST_INCIDENT_SQL % dict(names, column='inc_time', i='i', l='l'),
+        LATEST_INCIDENT_SQL % dict(names, column='inc_date', i='i2', l='l2'))
+    return people.filter(id__in=links.values(field)).extra(
+        select={'latest_date': latest_date, 'latest_time': latest_time})
+
+
+@cache_page('victims', _listing_scopes('victims'))
+def victims_page(request):
     try:
         time_frame = str(request.GET.get('time_frame'))
     except ValueError:
         time_frame = 'all'
+    since_date = get_since_date(time_frame)
 
-    if time_frame == 'all':
-        incidents = Incident.objects.all().order_by('-inc_date', '-inc_time')
-    elif time_frame == 'week':
-        since_date = today - datetime.timedelta(weeks=1)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date', '-inc_time')
-    elif time_frame == 'one_month':
-        since_date = _monthdelta(today, -1)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date', '-inc_time')
-    elif time_frame == 'six_months':
-        since_date = _monthdelta(today, -6)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date', '-inc_time')
-    elif time_frame == 'year':
-        since_date = today.replace(year=today.year - 1)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date', '-inc_time')
-    else:
-        incidents = Incident.objects.all().order_by('-inc_date', '-inc_time')
-
-    victims_details = []
-    for incident in incidents:
-        victims = incident.victims.filter(is_unidentified=False).order_by('is_killed')
-        for victim in victims:
-            if victim in victims_details:
-                pass
-            else:
-                victims_details.append(victim)
+    # One row per victim, ordered by their most recent incident.
+    victims = by_latest_incident(Victim.objects.filter(is_unidentified=False), since_date)
+    victims_details = victims.order_by('-latest_date', '-latest_time', 'is_killed', 'id'
+    ).prefetch_related('incident_set')
 
-    paginator = Paginator(victims_details, 15)
+    paginator = Paginator(victims_details, PEOPLE_PAGE_SIZE)
     try:
         page = int(request.GET.get('page', '1'))
     except ValueError:
@@ -169,7 +330,7 @@ def victims_page(request):
     except (EmptyPage, InvalidPage):
         details = paginator.page(paginator.num_pages)
 
-    agg_info = _getAggregateInfo()
+    agg_info = get_aggregate_info(time_frame)
 
     variables = RequestContext(request, {
         'details': details,
@@ -180,42 +341,20 @@ def victims_page(request):
     return render_to_response('crime/victims.html', variables)
 
 
+@cache_page('suspects', _listing_scopes('suspects'))
 def suspects_page(request):
-    today = datetime.date.today()
-    since_date = None
-
     try:
         time_frame = str(request.GET.get('time_frame'))
     except ValueError:
         time_frame = 'all'
+    since_date = get_since_date(time_frame)
 
-    if time_frame == 'all':
-        incidents = Incident.objects.all().order_by('-inc_date', '-inc_time')
-    elif time_frame == 'week':
-        since_date = today - datetime.timedelta(weeks=1)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date', '-inc_time')
-    elif time_frame == 'one_month':
-        since_date = _monthdelta(today, -1)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date', '-inc_time')
-    elif time_frame == 'six_months':
-        since_date = _monthdelta(today, -6)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date', '-inc_time')
-    elif time_frame == 'year':
-        since_date = today.replace(year=today.year - 1)
-        incidents = Incident.objects.filter(inc_date__gte=since_date).order_by('-inc_date', '-inc_time')
-    else:
-        incidents = Incident.objects.all().order_by('-inc_date', '-inc_time')
-
-    suspect_details = []
-    for incident in incidents:
-        suspects = incident.suspects.all().order_by('-arrest_date')
-        for suspect in suspects:
-            if suspect in suspect_details:
-                pass
-            else:
-                suspect_details.append(suspect)
+    # One row per suspect, ordered by their most recent incident.
+    suspects = by_latest_incident(Suspect.objects.all(), since_date)
+    suspect_details = suspects.order_by('-latest_date', '-latest_time', '-arrest_date', 'id'
+    ).prefetch_related('incident_set')
 
-    paginator = Paginator(suspect_details, 15)
+    paginator = Paginator(suspect_details, PEOPLE_PAGE_SIZE)
     try:
         page = int(request.GET.get('page', '1'))
     except ValueError:
@@ -225,7 +364,7 @@ def suspects_page(request):
     except (EmptyPage, InvalidPage):
         details = paginator.page(paginator.num_pages)
 
-    agg_info = _getAggregateInfo()
+    agg_info = get_aggregate_info(time_frame)
 
     variables = RequestContext(request, {
         'details': details,
@@ -236,25 +375,235 @@ def suspects_page(request):
     return render_to_response('crime/suspects.html', variables)
 
 
+# Saving an incident also bumps the pages that list it as nearby.
+@cache_page('incident', lambda request, Incident_id, Incident_inc_slug: [
+    'incident:%s' % Incident_id, frame_scope('stats', 'all')])
 def incident_page(request, Incident_id, Incident_inc_slug):
     """
-    Includes details about a specific incident.
+    Includes details about a specific incident, and the other
+    incidents within a few blocks and months of it.
     Can be viewed at /crime/<INCIDENT_ID>/<INCIDENT_SLUG>/
     """
-    incident = Incident.objects.get(id=Incident_id)
-    agg_info = _getAggregateInfo()
+    incident = get_object_or_404(Incident.objects.prefetch_related('victims', 'suspects'), id=Incident_id)
+    agg_info = get_aggregate_info()
     variables = RequestContext(request, {
         'incident': incident,
+        'incident_scope': 'incident:%s' % incident.id,
+        'nearby': [_marker(row) for row in nearby.near_incident(incident)],
         'agg_info': agg_info
     })
     return render_to_response('crime/incident_page.html', variables)
 
 
+# Limits on what one nearby.json request can ask for.
+NEARBY_MAX_K = 50
+NEARBY_MAX_RADIUS = 5000
+
+
+@cache_page('nearby', lambda request: [frame_scope('incidents', 'all')])
+def nearby_incidents(request):
+    """
+    JSON list of the incidents near a point, closest first, each
+    with its distance in meters.
+    Can be viewed at /crime/nearby.json and takes:
+        - id: an incident to search around (and leave out), or
+        - lat, lng: a point
+        - radius: meters; every incident within it, up to "k"
+        - k: the k nearest instead, when there's no radius (default 5)
+        - days: days either side of the incident's date, or
+        - start, end: YYYY-MM-DD dates
+    """
+    GET = request.GET
+    exclude = None
+    start, end = _parse_date(GET.get('start')), _parse_date(GET.get('end'))
+    try:
+        if GET.get('id'):
+            incident = get_object_or_404(Incident.objects.only('id', 'inc_date', 'lat', 'lng'), id=int(GET['id']))
+            if incident.lat is None:
+                return HttpResponse(simplejson.dumps({'incidents': []}), mimetype='application/json')
+            lat, lng, exclude = incident.lat, incident.lng, incident.id
+            if GET.get('days'):
+                window = datetime.timedelta(days=int(GET['days']))
+                start, end = incident.inc_date - window, incident.inc_date + window
+        else:
+            lat, lng = float(GET['lat']), float(GET['lng'])
+        k = max(min(int(GET.get('k', nearby.NEARBY_LIMIT)), NEARBY_MAX_K), 1)
+        radius = GET.get('radius') and min(float(GET['radius']), NEARBY_MAX_RADIUS)
+    except (KeyError, ValueError, OverflowError):
+        return HttpResponseBadRequest('Give an incident id, or lat and lng; k, radius and days must be numbers.')
+    if radius:
+        rows = nearby.within(lat, lng, radius, start, end, exclude, limit=k)
+    else:
+        rows = nearby.nearest(lat, lng, k, start, end, exclude)
+    data = {'incidents': [_marker(row) for row in rows]}
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
+
+def _parse_date(value):
+    # Malformed dates in the query string are ignored.
+    try:
+        return parse_date(value)
+    except ValueError:
+        return None
+
+
+def export_incidents(request, format):
+    """
+    The whole archive (or a slice of it) for download.
+    Can be viewed at /crime/export/incidents.<csv|ndjson|geojson> and takes:
+        - time_frame: same values as the main page
+        - start, end: YYYY-MM-DD dates
+    The response is streamed, and gzipped if the client accepts it.
+    """
+    incidents = Incident.objects.in_time_frame(str(request.GET.get('time_frame'))).between(
+        _parse_date(request.GET.get('start')), _parse_date(request.GET.get('end')))
+    content = export(format, incidents)
+    gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if gzipped:
+        content = gzip_stream(content)
+    response = HttpResponse(content, content_type=EXPORT_CONTENT_TYPES[format])
+    response['Content-Disposition'] = 'attachment; filename=incidents.%s' % format
+    response['Vary'] = 'Accept-Encoding'
+    if gzipped:
+        response['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _analytics_scopes(request):
+    time_frame = str(request.GET.get('time_frame'))
+    if request.GET.get('start') or request.GET.get('end'):
+        # Explicit dates can reach outside the time frame.
+        time_frame = 'all'
+    return [frame_scope(listing, time_frame) for listing in ('incidents', 'victims', 'suspects')]
+
+
+@cache_page('analytics', _analytics_scopes)
+def analytics_data(request):
+    """
+    JSON for the trend charts.
+    Can be viewed at /crime/analytics.json and takes:
+        - period: day, week or month (default)
+        - time_frame: same values as the main page, default year
+        - start, end: YYYY-MM-DD dates, instead of a time frame,
+          for the series, the age histograms and the wounds
+        - width: years per age histogram bin
+    """
+    period = request.GET.get('period', 'month')
+    time_frame = request.GET.get('time_frame', 'year')
+    if time_frame not in TIME_FRAMES:
+        time_frame = 'all'
+    start, end = _parse_date(request.GET.get('start')), _parse_date(request.GET.get('end'))
+    try:
+        width = max(int(request.GET.get('width', analytics.AGE_BIN_WIDTH)), 1)
+        series = analytics.time_series(period, start or get_since_date(time_frame), end)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    data = {
+        'period': period,
+        'time_frame': time_frame,
+        'series': series,
+        'victim_ages': analytics.age_histogram(Victim, time_frame, width, start, end),
+        'suspect_ages': analytics.age_histogram(Suspect, time_frame, width, start, end),
+        'wounds': analytics.wound_breakdown(time_frame, start, end),
+    }
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
+
+@staff_member_required
+def jobs_status(request):
+    """
+    Background job queue health for editors: counts by status,
+    how long the oldest due job has waited, and recent failures.
+    Can be viewed at /crime/jobs/status.json
+    """
+    response = HttpResponse(simplejson.dumps(jobs.status()), mimetype='application/json')
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def metrics(request):
+    """
+    Per-view timings, query counts and cache hit rates of the
+    process that serves the request (see instrumentation.py).
+    Can be viewed at /crime/metrics by staff, or with the
+    CRIME_METRICS_TOKEN as "Authorization: Bearer <token>" (never
+    in the URL, which ends up in access logs). Takes
+    format=prometheus for the Prometheus text format, which is also
+    sent to clients that only accept text/plain.
+    """
+    user = getattr(request, 'user', None)
+    token = instrumentation.METRICS_TOKEN
+    scheme, _, given = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if scheme != 'Bearer':
+        given = ''
+    if not (user and user.is_active and user.is_staff) and not (token and constant_time_compare(given, token)):
+        return HttpResponseForbidden('Staff login or metrics token required.')
+    accept = request.META.get('HTTP_ACCEPT', '')
+    if request.GET.get('format') == 'prometheus' or (accept.startswith('text/plain') and 'json' not in accept):
+        response = HttpResponse(instrumentation.prometheus(), content_type='text/plain; version=0.0.4')
+    else:
+        response = HttpResponse(simplejson.dumps(instrumentation.snapshot()), mimetype='application/json')
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _api_scopes(request, *args, **kwargs):
+    # Related people and incidents can appear in any listing.
+    time_frame = str(request.GET.get('time_frame'))
+    return [frame_scope(listing, time_frame) for listing in ('incidents', 'victims', 'suspects')]
+
+
+def _api_response(get_page, request):
+    try:
+        data = get_page(request.GET)
+    except api.ApiError as e:
+        return HttpResponseBadRequest(simplejson.dumps({'error': str(e)}), mimetype='application/json')
+    return HttpResponse(simplejson.dumps(data, separators=(',', ':')), mimetype='application/json')
+
+
+@cache_page('api_incidents', _api_scopes)
+def api_incidents(request):
+    """
+    JSON incidents for client-side listings and the map.
+    Can be viewed at /crime/api/incidents.json and takes:
+        - fields: comma-separated fields, and "victims"/"suspects" for their ids
+        - embed: "victims" and/or "suspects" to nest their records
+        - limit, after: page size and the "next" cursor of the page before
+        - time_frame, start, end, inc_type, is_homicide: filters
+    """
+    return _api_response(api.incidents, request)
+
+
+@cache_page('api_people', _api_scopes)
+def api_people(request, listing):
+    """
+    JSON victims or suspects.
+    Can be viewed at /crime/api/<victims|suspects>.json and takes
+    fields (with "incidents" for their ids), embed=incidents, limit,
+    after, time_frame and, for victims, killed.
+    """
+    return _api_response(lambda params: api.people(listing, params), request)
+
+
+# Results shown per search page, and per type-ahead request.
+SEARCH_PAGE_SIZE = 10
+SEARCH_AJAX_LIMIT = 10
+
+
+@cache_page('search', lambda request: ['search', frame_scope('stats', 'all')])
 def search_page(request):
+    """
+    Search incidents by keyword or by the name of a victim or suspect.
+    Can be viewed at /crime/search/ and takes:
+        - query: the search terms
+        - page: for pagination
+        - ajax: return only the result list, matching the
+          last term as a prefix for type-ahead
+    """
     form = SearchForm()
     show_results = False
     pagination = False
-    agg_info = _getAggregateInfo()
+    agg_info = get_aggregate_info()
 
     variables = RequestContext(request, {
         'form': form,
@@ -269,13 +618,29 @@ def search_page(request):
         if query:
             form = SearchForm({'query': query})
 
-            incidents = Incident.objects.filter(
-                Q(headline__icontains=query) | Q(summary__icontains=query)
-                ).order_by('-inc_date', '-inc_time')
+            if 'ajax' in request.GET:
+                incident_ids = search(query, prefix=True, limit=SEARCH_AJAX_LIMIT)
+            else:
+                incident_ids = search(query)
+            paginator = Paginator(incident_ids, SEARCH_PAGE_SIZE)
+            try:
+                page = int(request.GET.get('page', '1'))
+            except ValueError:
+                page = 1
+            try:
+                details = paginator.page(page)
+            except (EmptyPage, InvalidPage):
+                details = paginator.page(paginator.num_pages)
+            # Swap the page of ids for the incidents, keeping the ranking.
+            incidents = Incident.objects.only(*LISTING_FIELDS).prefetch_related(
+                'victims', 'suspects').in_bulk(details.object_list)
+            details.object_list = [incidents[id] for id in details.object_list if id in incidents]
+            pagination = paginator.num_pages > 1
 
             variables = RequestContext(request, {
                 'form': form,
-                'details': incidents,
+                'details': details,
+                'query': query,
                 'agg_info': agg_info,
                 'show_results': show_results,
                 'pagination': pagination